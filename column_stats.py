@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import math
+import threading
+from typing import Dict, List, Tuple
+
+import duckdb as db
+import pyarrow as pa
+import pyarrow.parquet as pq
+import PySide6.QtCore as qc
+
+from query import Field, Query, Select, expand_files, run_sql, select_files
+from query_cache import query_cache
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+HISTOGRAM_BINS = 20
+
+
+def column_expression(field: Field) -> str:
+    # Expressions are rendered as projected by Select (without their alias), only columns are quoted
+    if field.is_expression:
+        return f"{field:qs}"
+    return f"{field:qj}"
+
+
+def row_group_statistics(files: List[str], column: str) -> Dict:
+    """Row count, null count, min and max of a column, from the parquet footers only.
+
+    Returns None if a row group has no statistics for the column (or a file doesn't have it, e.g. hive partition keys).
+    """
+    stats = {"row_count": 0, "null_count": 0, "minimum": None, "maximum": None}
+    for path in files:
+        metadata = pq.read_metadata(path)
+        index = next(
+            (
+                i
+                for i in range(metadata.num_columns)
+                if metadata.schema.column(i).path == column
+            ),
+            None,
+        )
+        if index is None:
+            return None
+        stats["row_count"] += metadata.num_rows
+        for i in range(metadata.num_row_groups):
+            column_stats = metadata.row_group(i).column(index).statistics
+            if column_stats is None or column_stats.null_count is None:
+                return None
+            stats["null_count"] += column_stats.null_count
+            if not column_stats.has_min_max:
+                # Only nulls in this row group
+                continue
+            if stats["minimum"] is None or column_stats.min < stats["minimum"]:
+                stats["minimum"] = column_stats.min
+            if stats["maximum"] is None or column_stats.max > stats["maximum"]:
+                stats["maximum"] = column_stats.max
+    return stats
+
+
+class ColumnStats(qc.QObject):
+    """Statistics of the columns of the query: row and null counts, distinct values, min, max, approximate quantiles and histogram.
+
+    They are computed over all the rows the query selects, in a background thread when the query can run on another cursor,
+    and cached by fingerprint. When nothing is filtered out, counts, min and max come from the parquet row group statistics.
+    """
+
+    # Fingerprint of the query and column, statistics (None if they could not be computed)
+    stats_ready = qc.Signal(str, object)
+    # Brings the statistics computed in background threads back to the main thread
+    computed = qc.Signal(str, object)
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+        # Statistics being computed: key -> files read
+        self.running: Dict[str, List[str]] = {}
+        self.computed.connect(self.on_computed)
+
+    def base_select(self, fields: List[Field]) -> Select:
+        select = self.query.get_count_select()
+        select.fields = fields
+        return select
+
+    def key(self, field: Field) -> str:
+        return self.base_select(
+            [Field(f"stats({column_expression(field)})", is_expression=True)]
+        ).fingerprint(paged=False)
+
+    def unfiltered_main_files(self, field: Field) -> List[str]:
+        """Files the statistics of the field can be read from, when the query keeps all the rows of its main table"""
+        table = self.query.scanned_main_table()
+        if (
+            field.is_expression
+            or not table
+            or not table.files
+            or field.table is None
+            or field.table.get_alias() != table.get_alias()
+            or self.query.effective_filter()
+            or any(
+                join.join_type.upper() in ("JOIN", "INNER JOIN")
+                for join in self.query.additional_tables.values()
+            )
+        ):
+            return None
+        return expand_files(table.files)
+
+    def request(self, field: Field) -> str:
+        """Computes the statistics of a field, unless cached. Returns the key stats_ready will be emitted with."""
+        key = self.key(field)
+        stats = query_cache.get("column_stats", key)
+        if stats is not None:
+            self.stats_ready.emit(key, stats)
+            return key
+        if key in self.running:
+            return key
+
+        expression = column_expression(field)
+        summary = self.base_select(
+            [
+                Field("COUNT(*)", alias="row_count", is_expression=True),
+                Field(f"COUNT(*) - COUNT({expression})", alias="null_count", is_expression=True),
+                Field(f"approx_count_distinct({expression})", alias="distinct_count", is_expression=True),
+                Field(f"MIN({expression})", alias="minimum", is_expression=True),
+                Field(f"MAX({expression})", alias="maximum", is_expression=True),
+                # NULL for non numeric columns
+                Field(
+                    f"approx_quantile(TRY_CAST({expression} AS DOUBLE), {QUANTILES})",
+                    alias="quantiles",
+                    is_expression=True,
+                ),
+            ]
+        )
+        files = self.unfiltered_main_files(field)
+        # Rendered here: the query may change (or prune its files with the connection) while the thread runs
+        statement = summary.statement()
+        summary.fields = summary.fields[2:3] + summary.fields[5:]
+        # Only the quantiles and the distinct count need a scan when the row group statistics are read
+        scan_statement = summary.statement()
+        values = self.base_select([Field(expression, alias="v", is_expression=True)])
+        # LIMIT NULL: all the rows
+        values.limit = None
+        values_statement = values.statement()
+        conn = self.query.conn
+        in_background = self.query.readable_from_cursor()
+        if in_background:
+            # A connection can't be shared between threads
+            conn = conn.cursor()
+
+        def compute():
+            try:
+                stats = None
+                if files is not None:
+                    try:
+                        stats = row_group_statistics(files, field.name)
+                    except (OSError, pa.ArrowInvalid) as e:
+                        print(e)
+                sql, params = scan_statement if stats is not None else statement
+                stats = {**run_sql(sql, conn, tuple(params), "stats")[0], **(stats or {})}
+                stats["histogram"] = self.histogram(conn, values_statement, stats)
+                return stats
+            except db.Error as e:
+                print(e)
+                return None
+
+        self.running[key] = select_files(values)
+        if in_background:
+            threading.Thread(
+                target=lambda: self.computed.emit(key, compute()), daemon=True
+            ).start()
+        else:
+            self.on_computed(key, compute())
+        return key
+
+    def on_computed(self, key: str, stats: dict):
+        files = self.running.pop(key, [])
+        if stats is not None:
+            # Kept in memory only: values of any type don't fit in the disk cache index
+            query_cache.put("column_stats", key, stats, files=files)
+        self.stats_ready.emit(key, stats)
+
+    def histogram(
+        self, conn: db.DuckDBPyConnection, values_statement: Tuple[str, list], stats: dict
+    ) -> List[tuple]:
+        """Counts in HISTOGRAM_BINS equal width bins between min and max, as (low, high, count), for numeric columns
+
+        Args:
+            values_statement (Tuple[str, list]): the SQL (and its parameters) of the rows of the query, with the column values as v
+        """
+        low, high = stats.get("minimum"), stats.get("maximum")
+        for v in (low, high):
+            if not isinstance(v, (int, float)) or isinstance(v, bool) or not math.isfinite(v):
+                return []
+        width = (high - low) / HISTOGRAM_BINS or 1
+        sql, params = values_statement
+        bins = dict(
+            run_sql(
+                f"SELECT histogram(LEAST(CAST(floor((TRY_CAST(v AS DOUBLE) - {low!r}) / {width!r}) AS INTEGER), {HISTOGRAM_BINS - 1})) AS bins FROM ({sql})",
+                conn,
+                tuple(params),
+                "stats",
+            )[0]["bins"]
+            or []
+        )
+        return [
+            (low + i * width, low + (i + 1) * width, bins.get(i, 0))
+            for i in range(HISTOGRAM_BINS)
+        ]
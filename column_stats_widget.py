@@ -0,0 +1,116 @@
+import PySide6.QtCore as qc
+import PySide6.QtWidgets as qw
+
+from column_stats import QUANTILES, ColumnStats
+from common_widgets.histogram import Histogram
+from query import Query
+from query_monitor import query_monitor
+
+# Wait for the query to settle before computing statistics again (ms)
+REFRESH_DELAY = 500
+
+
+class ColumnStatsWidget(qw.QWidget):
+    """Statistics of a column of the query, over all the rows it selects, to help choosing filter thresholds"""
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+        self.stats = ColumnStats(query, self)
+        self.stats.stats_ready.connect(self.on_stats_ready)
+        # Key of the statistics shown (or being computed)
+        self.key = None
+
+        self.column_combobox = qw.QComboBox()
+        self.column_combobox.currentIndexChanged.connect(self.refresh)
+
+        self.status_label = qw.QLabel("")
+        self.values = {}
+        form = qw.QFormLayout()
+        form.addRow("Column", self.column_combobox)
+        for name, label in (
+            ("row_count", "Rows"),
+            ("null_count", "Nulls"),
+            ("distinct_count", "Distinct values (approx.)"),
+            ("minimum", "Min"),
+            ("maximum", "Max"),
+            ("quantiles", "Quantiles (approx.)"),
+        ):
+            self.values[name] = qw.QLabel("")
+            self.values[name].setTextInteractionFlags(
+                qc.Qt.TextInteractionFlag.TextSelectableByMouse
+            )
+            form.addRow(label, self.values[name])
+
+        self.histogram = Histogram()
+
+        layout = qw.QVBoxLayout()
+        layout.addLayout(form)
+        layout.addWidget(self.histogram)
+        layout.addWidget(self.status_label)
+        layout.addStretch()
+        self.setLayout(layout)
+
+        # Statistics are only computed while shown, once the query stops changing
+        self.refresh_timer = qc.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.query.query_changed.connect(self.on_query_changed)
+
+    def fields(self):
+        # Column filters only apply to plain columns, so do statistics
+        return [f for f in self.query.get_visible_fields() if not f.is_expression]
+
+    def on_query_changed(self):
+        names = [str(f) for f in self.fields()]
+        current = self.column_combobox.currentText()
+        if names != [self.column_combobox.itemText(i) for i in range(self.column_combobox.count())]:
+            self.column_combobox.blockSignals(True)
+            self.column_combobox.clear()
+            self.column_combobox.addItems(names)
+            if current in names:
+                self.column_combobox.setCurrentText(current)
+            self.column_combobox.blockSignals(False)
+        self.refresh_timer.start()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh_timer.start()
+
+    def refresh(self):
+        if not self.isVisible() or not self.query.conn or not self.query.main_table:
+            return
+        if query_monitor.defer(self.refresh):
+            return
+        fields = {str(f): f for f in self.fields()}
+        field = fields.get(self.column_combobox.currentText())
+        if field is None:
+            self.show_stats(None)
+            return
+        key = self.stats.key(field)
+        if key == self.key:
+            return
+        self.key = key
+        self.status_label.setText("Computing...")
+        self.stats.request(field)
+
+    def on_stats_ready(self, key: str, stats: dict):
+        if key != self.key:
+            return
+        if stats is None:
+            # Computed again on the next refresh
+            self.key = None
+            self.status_label.setText("Statistics could not be computed")
+            return
+        self.status_label.setText("")
+        self.show_stats(stats)
+
+    def show_stats(self, stats: dict):
+        stats = stats or {}
+        for name, label in self.values.items():
+            value = stats.get(name)
+            if name == "quantiles" and value:
+                value = ", ".join(f"{int(q * 100)}%: {v:.6g}" for q, v in zip(QUANTILES, value))
+            label.setText("" if value is None else str(value))
+        self.histogram.set_bins(stats.get("histogram") or [])
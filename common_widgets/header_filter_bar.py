@@ -0,0 +1,61 @@
+from typing import Dict, List
+
+import PySide6.QtCore as qc
+import PySide6.QtWidgets as qw
+import shiboken6
+
+
+class HeaderFilterBar(qw.QWidget):
+    """A row of line edits, one per section of a horizontal header, kept aligned with it"""
+
+    # Emitted with the section index and the text, once the user is done typing
+    filter_changed = qc.Signal(int, str)
+
+    def __init__(self, header: qw.QHeaderView, parent=None):
+        super().__init__(parent)
+        self.header = header
+        self.line_edits: List[qw.QLineEdit] = []
+
+        self.header.sectionResized.connect(self.update_geometries)
+        self.header.sectionMoved.connect(self.update_geometries)
+        self.header.geometriesChanged.connect(self.update_geometries)
+
+        self.setFixedHeight(qw.QLineEdit().sizeHint().height())
+
+    def get_texts(self) -> Dict[int, str]:
+        return {i: le.text() for i, le in enumerate(self.line_edits) if le.text()}
+
+    def set_texts(self, texts: Dict[int, str]):
+        """Recreates one line edit per header section, with the given texts (by section)"""
+        for le in self.line_edits:
+            le.deleteLater()
+        self.line_edits = []
+        for section in range(self.header.count()):
+            le = qw.QLineEdit(self)
+            le.setPlaceholderText("Filter...")
+            le.setText(texts.get(section, ""))
+            le.editingFinished.connect(
+                lambda section=section, le=le: self.filter_changed.emit(
+                    section, le.text()
+                )
+            )
+            le.show()
+            self.line_edits.append(le)
+        self.update_geometries()
+
+    def update_geometries(self):
+        # The view may still emit scroll signals while being torn down
+        if not shiboken6.isValid(self.header):
+            return
+        offset = self.header.geometry().left()
+        for section, le in enumerate(self.line_edits):
+            if self.header.isSectionHidden(section):
+                le.hide()
+                continue
+            le.setGeometry(
+                offset + self.header.sectionViewportPosition(section),
+                0,
+                self.header.sectionSize(section),
+                self.height(),
+            )
+            le.show()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+from typing import List, Tuple
+
+import PySide6.QtCore as qc
+import PySide6.QtGui as qg
+import PySide6.QtWidgets as qw
+
+
+class Histogram(qw.QWidget):
+    """Bar chart of bins given as (low, high, count). Hovering a bar shows its bounds and count."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.bins: List[Tuple[float, float, int]] = []
+        self.setMinimumHeight(120)
+        self.setMouseTracking(True)
+
+    def set_bins(self, bins: List[Tuple[float, float, int]]):
+        self.bins = list(bins)
+        self.update()
+
+    def bar_rect(self, index: int, highest: int) -> qc.QRectF:
+        width = self.width() / len(self.bins)
+        height = (self.height() - 1) * self.bins[index][2] / highest
+        return qc.QRectF(index * width, self.height() - height, width - 1, height)
+
+    def paintEvent(self, event: qg.QPaintEvent):
+        if not self.bins:
+            return
+        highest = max(count for _, _, count in self.bins) or 1
+        painter = qg.QPainter(self)
+        color = self.palette().color(qg.QPalette.ColorRole.Highlight)
+        for i in range(len(self.bins)):
+            painter.fillRect(self.bar_rect(i, highest), color)
+
+    def mouseMoveEvent(self, event: qg.QMouseEvent):
+        if not self.bins:
+            return
+        index = min(len(self.bins) - 1, int(event.position().x() * len(self.bins) / max(1, self.width())))
+        low, high, count = self.bins[index]
+        self.setToolTip(f"[{low:.6g}, {high:.6g}[: {count}")
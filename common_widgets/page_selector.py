@@ -14,7 +14,8 @@ class PageSelector(qw.QWidget):
         self.rows_label = qw.QLabel("Rows per page")
         self.rows_lineedit = qw.QLineEdit()
         self.rows_lineedit.setText("10")
-        self.rows_lineedit.setValidator(qg.QIntValidator(1, 100))
+        # Large pages are memory-mapped from disk by the query, see spill.py
+        self.rows_lineedit.setValidator(qg.QIntValidator(1, 100000))
         self.rows_lineedit.textChanged.connect(self.set_rows_per_page)
 
         self.spacer = qw.QSpacerItem(
@@ -79,7 +80,9 @@ class PageSelector(qw.QWidget):
         self.page_lineedit.setValidator(
             qg.QIntValidator(1, self.query.get_page_count())
         )
-        self.page_count_label.setText(f"out of {self.query.get_page_count()}")
+        # Estimated page count, until the exact row count is known (see Query.fetch_count)
+        approximate = "≈" if self.query.row_count_is_approximate else ""
+        self.page_count_label.setText(f"out of {approximate}{self.query.get_page_count()}")
 
         self.page_lineedit.blockSignals(False)
         self.rows_lineedit.blockSignals(False)
@@ -1,4 +1,9 @@
+import atexit
+import copy
+import fnmatch
 import json
+import os
+import threading
 import typing
 from pathlib import Path
 
@@ -28,6 +33,31 @@ def dict_add_value(d: dict, key: str, value: typing.Any):
         d[key] = value
 
 
+def dict_get_value(d: dict, key: str, default: typing.Any = None) -> typing.Any:
+    """Counterpart of dict_add_value: reads a value from an arbitrarly nested dictionary
+
+    Args:
+        d (dict): the dictionnary to read from
+        key (str): a string representing the key to read (may be nested with dots)
+        default (Any, optional): returned if the key is missing. Defaults to None.
+    """
+    for part in key.split("."):
+        if not isinstance(d, dict) or part not in d:
+            return default
+        d = d[part]
+    return d
+
+
+def files_match(paths: typing.Iterable[str], patterns: typing.Iterable[str]) -> bool:
+    """Whether one of the paths is one of the files (or matches one of the glob patterns), relative paths being resolved from the working directory"""
+    paths = [os.path.abspath(p) for p in paths]
+    for pattern in patterns:
+        pattern = os.path.abspath(pattern)
+        if any(p == pattern or fnmatch.fnmatch(p, pattern) for p in paths):
+            return True
+    return False
+
+
 def get_user_prefs_file():
     return (
         Path(
@@ -39,28 +69,153 @@ def get_user_prefs_file():
     ).resolve()
 
 
-def save_user_prefs(prefs: dict):
+class UserPrefs:
+    """The user preferences (config.json), loaded once and served from memory.
 
-    user_prefs = get_user_prefs_file()
-    user_prefs.parent.mkdir(parents=True, exist_ok=True)
-    old_prefs = {}
-    if user_prefs.exists():
-        with open(user_prefs, "r") as f:
-            old_prefs = json.load(f)
+    Writes are batched: they mark the preferences dirty, and the file is written shortly after (or at exit),
+    under a lock file and through an atomic rename. Only the keys changed in this process are written over
+    what's on disk, so that concurrent saves (another instance of the app) don't lose each other's data.
+    """
 
-    old_prefs.update(prefs)
+    # Delay (ms) during which writes are batched before hitting the disk
+    SAVE_DELAY = 500
+
+    def __init__(self):
+        self._prefs = None
+        # Top-level keys changed since the last write
+        self._changed = set()
+        self._lock = threading.RLock()
+        self._save_scheduled = False
+        atexit.register(self.flush)
+
+    def _read_file(self) -> dict:
+        user_prefs = get_user_prefs_file()
+        if user_prefs.exists():
+            try:
+                with open(user_prefs, "r") as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                print(e)
+        return {}
+
+    def _loaded(self) -> dict:
+        if self._prefs is None:
+            self._prefs = self._read_file()
+        return self._prefs
+
+    def all(self) -> dict:
+        """A copy of all the preferences"""
+        with self._lock:
+            return copy.deepcopy(self._loaded())
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        """Reads a preference, nested keys being separated by dots"""
+        with self._lock:
+            return copy.deepcopy(dict_get_value(self._loaded(), key, default))
+
+    def set(self, key: str, value: typing.Any):
+        """Sets a preference, nested keys being separated by dots (see dict_add_value)"""
+        with self._lock:
+            dict_add_value(self._loaded(), key, value)
+            self._changed.add(key.split(".", 1)[0])
+        self._schedule_save()
+
+    def update(self, prefs: dict):
+        """Sets several top-level preferences at once"""
+        with self._lock:
+            self._loaded().update(prefs)
+            self._changed.update(prefs.keys())
+        self._schedule_save()
+
+    def _schedule_save(self):
+        app = qc.QCoreApplication.instance()
+        if app is None:
+            self.flush()
+            return
+        with self._lock:
+            if self._save_scheduled:
+                return
+            self._save_scheduled = True
+        qc.QTimer.singleShot(UserPrefs.SAVE_DELAY, self.flush)
+
+    def flush(self):
+        """Writes the changed preferences now"""
+        with self._lock:
+            self._save_scheduled = False
+            if not self._changed:
+                return
+            user_prefs = get_user_prefs_file()
+            user_prefs.parent.mkdir(parents=True, exist_ok=True)
+
+            lock = qc.QLockFile(str(user_prefs) + ".lock")
+            if not lock.tryLock(1000):
+                print("Could not lock user preferences, writing anyway")
+            try:
+                # Another process may have written since we loaded: merge our changes into the current file
+                on_disk = self._read_file()
+                for key in self._changed:
+                    if key in self._prefs:
+                        on_disk[key] = self._prefs[key]
+                tmp = user_prefs.with_suffix(".json.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(on_disk, f)
+                os.replace(tmp, user_prefs)
+                self._prefs = on_disk
+                self._changed.clear()
+            except OSError as e:
+                print(e)
+            finally:
+                lock.unlock()
+
+
+user_prefs = UserPrefs()
 
-    with open(user_prefs, "w") as f:
-        json.dump(old_prefs, f)
+
+def save_user_prefs(prefs: dict):
+    user_prefs.update(prefs)
 
 
 def load_user_prefs():
-    user_prefs = get_user_prefs_file()
-    prefs = {}
-    if user_prefs.exists():
-        with open(user_prefs, "r") as f:
-            prefs = json.load(f)
-    return prefs
+    return user_prefs.all()
+
+
+# DuckDB settings that may be set per datalake (a missing or empty value keeps DuckDB's default)
+DUCKDB_SETTINGS = ("threads", "memory_limit", "temp_directory")
+
+
+def get_datalake_settings(datalake_path: str) -> dict:
+    """Settings of a datalake (DUCKDB_SETTINGS, and fan_out), from the user preferences"""
+    if not datalake_path:
+        return {}
+    return user_prefs.get("datalake_settings", {}).get(
+        str(Path(datalake_path).resolve()), {}
+    )
+
+
+def save_datalake_settings(datalake_path: str, settings: dict):
+    # Paths contain dots, so datalakes can't be nested keys
+    all_settings = user_prefs.get("datalake_settings", {})
+    all_settings[str(Path(datalake_path).resolve())] = settings
+    user_prefs.set("datalake_settings", all_settings)
+
+
+def duckdb_config(settings: dict) -> dict:
+    """The DuckDB settings among the datalake settings, as a connection config"""
+    return {k: str(settings[k]) for k in DUCKDB_SETTINGS if settings.get(k)}
+
+
+def apply_duckdb_settings(conn: db.DuckDBPyConnection, settings: dict):
+    """Applies the DuckDB settings to an open connection (settings left empty are reset to DuckDB's default)"""
+    config = duckdb_config(settings)
+    for key in DUCKDB_SETTINGS:
+        try:
+            if key in config:
+                value = config[key].replace("'", "''")
+                conn.sql(f"SET {key} = '{value}'")
+            else:
+                conn.sql(f"RESET {key}")
+        except db.Error as e:
+            print(e)
 
 
 def table_exists(conn: db.DuckDBPyConnection, table_name: str) -> bool:
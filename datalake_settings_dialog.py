@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+
+import PySide6.QtWidgets as qw
+
+from query_monitor import query_monitor
+
+
+class DatalakeSettingsDialog(qw.QDialog):
+    """Edits the settings of a datalake: DuckDB threads, memory limit and temp directory, the fan out mode,
+    and the time budget of each class of query"""
+
+    def __init__(self, settings: dict, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Datalake settings")
+
+        self.threads_spinbox = qw.QSpinBox()
+        self.threads_spinbox.setRange(0, 256)
+        # 0 keeps DuckDB's default (one thread per core)
+        self.threads_spinbox.setSpecialValueText("Default")
+        self.threads_spinbox.setValue(int(settings.get("threads") or 0))
+
+        self.memory_limit_lineedit = qw.QLineEdit(settings.get("memory_limit") or "")
+        self.memory_limit_lineedit.setPlaceholderText("Default (e.g. 8GB, 75%)")
+
+        self.temp_directory_lineedit = qw.QLineEdit(
+            settings.get("temp_directory") or ""
+        )
+        self.temp_directory_lineedit.setPlaceholderText("Default")
+        self.temp_directory_button = qw.QPushButton("...")
+        self.temp_directory_button.clicked.connect(self.on_temp_directory_clicked)
+        temp_directory_layout = qw.QHBoxLayout()
+        temp_directory_layout.addWidget(self.temp_directory_lineedit)
+        temp_directory_layout.addWidget(self.temp_directory_button)
+
+        self.fan_out_checkbox = qw.QCheckBox("Query runs in parallel, one per thread")
+        self.fan_out_checkbox.setChecked(bool(settings.get("fan_out")))
+
+        # Past its budget, a statement is stopped (see query_monitor)
+        timeouts = settings.get("query_timeouts") or {}
+        self.timeout_spinboxes = {}
+        for query_class, default in query_monitor.default_timeouts.items():
+            spinbox = qw.QSpinBox()
+            spinbox.setRange(0, 24 * 3600)
+            spinbox.setSuffix(" s")
+            spinbox.setSpecialValueText("None")
+            spinbox.setValue(int(timeouts.get(query_class, default) or 0))
+            self.timeout_spinboxes[query_class] = spinbox
+
+        self.button_box = qw.QDialogButtonBox(
+            qw.QDialogButtonBox.StandardButton.Ok
+            | qw.QDialogButtonBox.StandardButton.Cancel
+        )
+        self.button_box.accepted.connect(self.accept)
+        self.button_box.rejected.connect(self.reject)
+
+        layout = qw.QFormLayout()
+        layout.addRow("Threads", self.threads_spinbox)
+        layout.addRow("Memory limit", self.memory_limit_lineedit)
+        layout.addRow("Temp directory", temp_directory_layout)
+        layout.addRow("Fan out", self.fan_out_checkbox)
+        for query_class, spinbox in self.timeout_spinboxes.items():
+            layout.addRow(f"Time budget ({query_class} queries)", spinbox)
+        layout.addRow(self.button_box)
+        self.setLayout(layout)
+
+    def on_temp_directory_clicked(self):
+        folder = qw.QFileDialog.getExistingDirectory(
+            self, "Temp directory", self.temp_directory_lineedit.text()
+        )
+        if folder:
+            self.temp_directory_lineedit.setText(folder)
+
+    def get_settings(self) -> dict:
+        return {
+            "threads": self.threads_spinbox.value() or None,
+            "memory_limit": self.memory_limit_lineedit.text().strip() or None,
+            "temp_directory": self.temp_directory_lineedit.text().strip() or None,
+            "fan_out": self.fan_out_checkbox.isChecked(),
+            "query_timeouts": {
+                query_class: spinbox.value()
+                for query_class, spinbox in self.timeout_spinboxes.items()
+            },
+        }
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""Maintenance commands on a datalake, run from a terminal:
+
+    python datalake_tools.py /path/to/datalake repartition
+    python datalake_tools.py /path/to/datalake compact --sort-by chromosome position
+    python datalake_tools.py /path/to/datalake index
+    python datalake_tools.py /path/to/datalake decisions
+"""
+
+import argparse
+import os
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import duckdb as db
+
+from decision_lake import DECISION_LAKE, merge_finished_validations
+from hash_index import INDEXED_COLUMNS, build_index, indexed_columns
+from query import Field, FilterExpression, FilterType, Query, expand_files, run_sql_arrow
+from validation_model import initialize_database
+
+# Hive partition keys, from the coarsest to the finest
+PARTITION_KEYS = ["run_name", "sample_name", "chromosome"]
+
+RUN_FILES = "genotypes/runs/*.parquet"
+PARTITIONED_RUNS = "genotypes/partitions"
+AGGREGATES = "aggregates/variants.parquet"
+
+# Row groups small enough for min/max statistics to skip most of a file, large enough to scan fast
+DEFAULT_ROW_GROUP_SIZE = 100_000
+
+
+def parquet_columns(conn: db.DuckDBPyConnection, files: List[str]) -> List[str]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "DESCRIBE SELECT * FROM read_parquet(?, union_by_name = true)", [files]
+        ).fetchall()
+    ]
+
+
+def repartition(
+    conn: db.DuckDBPyConnection,
+    files: List[str],
+    destination: str,
+    keys: List[str] = PARTITION_KEYS,
+):
+    """Rewrites run files as hive partitions (destination/run_name=.../sample_name=.../chromosome=.../data_0.parquet).
+
+    Run files usually have no run_name column: it is then taken from the file name (genotypes/runs/<RUN>.parquet).
+    Keys missing from the files are skipped.
+
+    Args:
+        conn (db.DuckDBPyConnection): the connection to run the copy with
+        files (List[str]): the run files (glob patterns allowed)
+        destination (str): the root folder of the partitions
+        keys (List[str], optional): the partition keys. Defaults to PARTITION_KEYS.
+    """
+    files = expand_files(files)
+    if not files:
+        raise ValueError("No file to repartition")
+    columns = parquet_columns(conn, files)
+
+    derived = ""
+    if "run_name" in keys and "run_name" not in columns:
+        derived = r", regexp_extract(filename, '([^/\\]+)\.parquet$', 1) AS run_name"
+        columns.append("run_name")
+    missing = [k for k in keys if k not in columns]
+    if missing:
+        print(f"Skipping partition keys missing from the files: {', '.join(missing)}")
+    keys = [k for k in keys if k in columns]
+    if not keys:
+        raise ValueError("None of the partition keys are in the files")
+
+    destination = destination.replace("'", "''")
+    conn.execute(
+        f"""COPY (SELECT * EXCLUDE (filename){derived} FROM read_parquet(?, filename = true, union_by_name = true)) TO '{destination}' (FORMAT PARQUET, PARTITION_BY ({', '.join(keys)}), OVERWRITE_OR_IGNORE true, COMPRESSION zstd)""",
+        [files],
+    )
+
+
+def quoted_columns(columns: List[str]) -> str:
+    return ", ".join(f'"{c}"' for c in columns)
+
+
+def benchmark_query(query: Query, path: str, sort_by: List[str]) -> Query:
+    """Sets the query like the ones of the validation steps, selecting a narrow range of the sort key (taken from the middle of the file).
+    The query is muted meanwhile: an update would run it, and fill the caches before it is timed."""
+    conn = query.conn
+    query.mute()
+    query.init_state()
+    query.set_main_files([path])
+    table = query.main_table
+    query.set_fields([Field(name, table) for name in parquet_columns(conn, [path])])
+    row = conn.execute(
+        f"SELECT {quoted_columns(sort_by)} FROM read_parquet(?) LIMIT 1 OFFSET (SELECT COUNT(*) // 2 FROM read_parquet(?))",
+        [path, path],
+    ).fetchone()
+    if row is None:
+        query.unmute()
+        return query
+    conditions = [
+        FilterExpression(field=Field(name, table), operator="=", value=value)
+        for name, value in zip(sort_by[:-1], row[:-1])
+    ]
+    last = Field(sort_by[-1], table)
+    if isinstance(row[-1], (int, float)) and sort_by[-1] != "variant_hash":
+        # A window around a position
+        conditions.append(FilterExpression(field=last, operator=">=", value=row[-1]))
+        conditions.append(
+            FilterExpression(field=last, operator="<", value=row[-1] + 1_000_000)
+        )
+    else:
+        conditions.append(FilterExpression(field=last, operator="=", value=row[-1]))
+    query.set_filter(FilterExpression(FilterType.AND, children=conditions))
+    query.unmute()
+    return query
+
+
+def time_query(query: Query, repeat=3) -> float:
+    """Best time (in seconds) to run the first page and the row count statements (run directly, not through the caches)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for sql, params in (query.select_statement(), query.count_statement()):
+            run_sql_arrow(sql, query.conn, tuple(params))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def compact(
+    conn: db.DuckDBPyConnection,
+    files: List[str],
+    sort_by: List[str],
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+) -> List[Tuple[str, float, float, int, int]]:
+    """Rewrites each file sorted by the given columns, with the given row group size and zstd compression.
+
+    Files are replaced atomically, and their sidecar index, if any, rebuilt (see hash_index).
+    Files missing one of the sort columns are left as they are.
+
+    Returns:
+        List[Tuple[str, float, float, int, int]]: for each file rewritten, its name, scan time before and after, size before and after
+    """
+    report = []
+    # Query is a singleton, set again for each file
+    query = Query(conn)
+    for path in expand_files(files):
+        columns = parquet_columns(conn, [path])
+        if any(c not in columns for c in sort_by):
+            print(f"Skipping {path}: no {', '.join(c for c in sort_by if c not in columns)} column")
+            continue
+
+        before = time_query(benchmark_query(query, path, sort_by))
+        size_before = os.path.getsize(path)
+
+        tmp = path + ".compact.tmp"
+        escaped = tmp.replace("'", "''")
+        conn.execute(
+            f"""COPY (SELECT * FROM read_parquet(?) ORDER BY {quoted_columns(sort_by)}) TO '{escaped}' (FORMAT PARQUET, ROW_GROUP_SIZE {int(row_group_size)}, COMPRESSION zstd)""",
+            [path],
+        )
+        # Read before the file is replaced: the rewritten file outdates its index
+        index_columns = indexed_columns(path)
+        os.replace(tmp, path)
+        if index_columns:
+            build_index(conn, path, index_columns)
+
+        after = time_query(benchmark_query(query, path, sort_by))
+        report.append((path, before, after, size_before, os.path.getsize(path)))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Datalake maintenance")
+    parser.add_argument("datalake", help="the datalake folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    repartition_parser = commands.add_parser(
+        "repartition", help="rewrite the run files as hive partitions"
+    )
+    repartition_parser.add_argument("--files", nargs="+", default=[RUN_FILES])
+    repartition_parser.add_argument("--destination", default=PARTITIONED_RUNS)
+    repartition_parser.add_argument("--keys", nargs="+", default=PARTITION_KEYS)
+
+    compact_parser = commands.add_parser(
+        "compact",
+        help="rewrite the run and aggregate files sorted, with tuned row groups and zstd",
+    )
+    compact_parser.add_argument("--files", nargs="+", default=[RUN_FILES, AGGREGATES])
+    compact_parser.add_argument(
+        "--sort-by",
+        nargs="+",
+        default=["variant_hash"],
+        help="variant_hash, or chromosome position",
+    )
+    compact_parser.add_argument(
+        "--row-group-size", type=int, default=DEFAULT_ROW_GROUP_SIZE
+    )
+
+    index_parser = commands.add_parser(
+        "index",
+        help="build the hash index sidecars, to skip files on hash lookups and joins",
+    )
+    index_parser.add_argument("--files", nargs="+", default=[RUN_FILES, AGGREGATES])
+    index_parser.add_argument("--columns", nargs="+", default=list(INDEXED_COLUMNS))
+
+    decisions_parser = commands.add_parser(
+        "decisions",
+        help="merge the decisions of the finished validations into the decision lake",
+    )
+    decisions_parser.add_argument(
+        "--rebuild", action="store_true", help="rewrite it from all the finished validations"
+    )
+
+    args = parser.parse_args()
+    # Paths are relative to the datalake, as in the viewer
+    os.chdir(args.datalake)
+    conn = db.connect()
+
+    if args.command == "repartition":
+        repartition(conn, args.files, args.destination, args.keys)
+        print(
+            f"Partitions written to {args.destination}, open them with {args.destination}/**/*.parquet"
+        )
+    elif args.command == "compact":
+        report = compact(conn, args.files, args.sort_by, args.row_group_size)
+        print(f"{'file':<50} {'before (ms)':>12} {'after (ms)':>12} {'size before':>12} {'size after':>12}")
+        for path, before, after, size_before, size_after in report:
+            print(
+                f"{path:<50} {before * 1000:>12.1f} {after * 1000:>12.1f} {size_before:>12} {size_after:>12}"
+            )
+    elif args.command == "decisions":
+        conn = initialize_database(Path("validation.db"))
+        merged = merge_finished_validations(conn, rebuild=args.rebuild)
+        print(f"{len(merged)} validations merged into {DECISION_LAKE}")
+    elif args.command == "index":
+        for path in expand_files(args.files):
+            columns = build_index(conn, path, args.columns)
+            print(f"{path}: {', '.join(columns) or 'no hash column'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+from typing import Dict, List, Tuple
+
+import PySide6.QtCore as qc
+
+from query import Query
+from query_cache import query_cache
+from query_monitor import query_monitor
+from step_cache import step_results
+
+# Files worth watching in a datalake
+WATCHED_SUFFIXES = (".parquet",)
+
+
+class DatalakeWatcher(qc.QObject):
+    """Watches the parquet files of the datalake, and refreshes whatever was computed from the ones that change.
+
+    Cached pages and counts read from a changed file are dropped, materialized steps reading it are rebuilt,
+    and the query is only run again if it reads one of the changed files (or one of the rebuilt steps).
+    Only directories are watched (a watch per file would exhaust the system limit on large datalakes): they notify
+    files added, removed or replaced, whose modification times and sizes are then compared with those scanned before.
+    Notifications are debounced, and only the directories notified are scanned again.
+    """
+
+    # Emitted with the files added, removed or modified since the last notification
+    files_changed = qc.Signal(list)
+
+    # Delay (ms) during which notifications are gathered, files being usually written in several chunks
+    DEBOUNCE = 500
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+        self.root = None
+        # Parquet files (with modification time and size) of each watched directory
+        self.tree: Dict[str, Dict[str, Tuple[int, int]]] = {}
+        self.pending = set()
+
+        self.watcher = qc.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+
+        self.timer = qc.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DatalakeWatcher.DEBOUNCE)
+        self.timer.timeout.connect(self.rescan)
+
+        self.query.datalake_changed.connect(self.on_datalake_changed)
+        self.files_changed.connect(self.on_files_changed)
+        if self.query.datalake_path:
+            self.set_root(self.query.datalake_path)
+
+    def on_datalake_changed(self):
+        self.set_root(self.query.datalake_path)
+
+    def set_root(self, path: str):
+        watched = self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+        self.tree = {}
+        self.pending = set()
+        self.root = os.path.abspath(path) if path else None
+        if self.root:
+            self.scan_directory(self.root)
+
+    def on_directory_changed(self, path: str):
+        self.pending.add(path)
+        self.timer.start()
+
+    def file_state(self, path: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def scan_directory(self, directory: str) -> List[str]:
+        """(Re)scans a directory, recursing into the ones not watched yet. Returns the files that changed."""
+        old = self.tree.get(directory, {})
+        if not os.path.isdir(directory):
+            # Removed, along with everything below
+            changed = []
+            for d in [d for d in self.tree if d == directory or d.startswith(directory + os.sep)]:
+                changed.extend(self.tree.pop(d))
+            return changed
+
+        new = {}
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.endswith(WATCHED_SUFFIXES):
+                        new[entry.path] = self.file_state(entry.path)
+        except OSError as e:
+            print(e)
+            return []
+
+        self.tree[directory] = new
+        changed = [f for f in set(old) | set(new) if old.get(f) != new.get(f)]
+        for subdirectory in subdirectories:
+            if subdirectory not in self.tree:
+                changed.extend(self.scan_directory(subdirectory))
+
+        if directory not in self.watcher.directories():
+            self.watcher.addPath(directory)
+        return changed
+
+    def rescan(self):
+        changed = set()
+        pending, self.pending = self.pending, set()
+        for directory in pending:
+            changed.update(self.scan_directory(directory))
+        if changed:
+            self.files_changed.emit(sorted(changed))
+
+    def on_files_changed(self, paths: List[str]):
+        if query_monitor.defer(self.on_files_changed, paths):
+            return
+        query_cache.invalidate_files(paths)
+        rebuilt = step_results.refresh_files(self.query.conn, paths)
+        main_table = self.query.main_table
+        if self.query.depends_on(paths) or (main_table and main_table.name in rebuilt):
+            # Glob patterns may match new partitions
+            self.query.invalidate_statements()
+            self.query.update()
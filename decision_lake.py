@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import json
+import os
+from typing import Dict, List
+
+import duckdb as db
+import pyarrow.parquet as pq
+
+from query import Field, Query, Table
+
+# Relative to the datalake, as the other parquet files
+DECISION_LAKE = "decisions/variants.parquet"
+
+# Alias of the decision lake in the step queries
+PRIOR_ALIAS = "prior"
+
+# Fields of the decision lake shown in the step queries
+PRIOR_FIELDS = ["prior_verdict", "prior_validation", "prior_accepted", "prior_rejected"]
+
+# Parquet metadata key of the validations already merged, with the digest of their decisions when merged
+MERGED_KEY = b"merged_validations"
+
+ROW_GROUP_SIZE = 100_000
+
+
+def merged_validations(path: str = DECISION_LAKE) -> Dict[str, str]:
+    """Digests of the decisions of the validations in the decision lake, by table uuid"""
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (OSError, ValueError):
+        return {}
+    merged = json.loads(metadata.get(MERGED_KEY, b"{}"))
+    # Lakes written before the digests: their validations are merged again
+    return merged if isinstance(merged, dict) else dict.fromkeys(merged)
+
+
+def finished_validations(conn: db.DuckDBPyConnection) -> List[tuple]:
+    """Table uuid, run files and decision digest of the finished validations, oldest first.
+    The digest changes with any decision of the validation (from the decision index)."""
+    return conn.sql(
+        """SELECT v.table_uuid, v.parquet_files,
+            COUNT(d.validation_hash) || ':' || COALESCE(bit_xor(hash(d.validation_hash, d.accepted)), 0) AS digest
+        FROM validations v LEFT JOIN decisions d USING (table_uuid)
+        WHERE v.completed GROUP BY v.table_uuid, v.parquet_files, v.creation_date ORDER BY v.creation_date"""
+    ).fetchall()
+
+
+def merge_finished_validations(
+    conn: db.DuckDBPyConnection, path: str = DECISION_LAKE, rebuild=False
+) -> List[str]:
+    """Merges the decisions of the finished validations not merged yet into the decision lake.
+
+    The lake has one row per variant_hash, sorted by it: how many times the variant was accepted and rejected,
+    and the verdict of the latest validation that decided on it. It is rewritten whole (and atomically),
+    from its previous content and the new validations only. The counts of a validation can't be taken out of it:
+    when the decisions of a merged validation changed since (or it was reopened, or deleted), or when rebuild is set,
+    it is rebuilt from all the finished validations.
+
+    Returns:
+        List[str]: the table uuids of the validations merged
+    """
+    finished = finished_validations(conn)
+    digests = {table_uuid: digest for table_uuid, _, digest in finished}
+    merged = {} if rebuild else merged_validations(path)
+    if any(digests.get(table_uuid) != digest for table_uuid, digest in merged.items()):
+        merged = {}
+        rebuild = True
+    new = [
+        (table_uuid, parquet_files)
+        for table_uuid, parquet_files, _ in finished
+        if table_uuid not in merged
+    ]
+    if not new:
+        if rebuild and os.path.exists(path):
+            # No finished validation left
+            os.remove(path)
+        return []
+
+    # Decisions of each new validation, from the decision index, with the variant hash read from its runs
+    decided = " UNION ALL ".join(
+        """SELECT r.variant_hash, d.accepted, v.validation_name, v.creation_date FROM decisions d
+        JOIN validations v USING (table_uuid)
+        JOIN (SELECT DISTINCT variant_hash, validation_hash FROM read_parquet(?, union_by_name = true)) r USING (validation_hash)
+        WHERE d.table_uuid = ? AND d.accepted IS NOT NULL"""
+        for _ in new
+    )
+    params = [param for table_uuid, files in new for param in (files, table_uuid)]
+    parts = [
+        f"""SELECT variant_hash,
+            arg_max(CASE WHEN accepted THEN 'accepted' ELSE 'rejected' END, creation_date) AS prior_verdict,
+            arg_max(validation_name, creation_date) AS prior_validation,
+            MAX(creation_date) AS prior_date,
+            COUNT(*) FILTER (WHERE accepted) AS prior_accepted,
+            COUNT(*) FILTER (WHERE NOT accepted) AS prior_rejected
+        FROM ({decided}) GROUP BY variant_hash"""
+    ]
+    if merged and os.path.exists(path):
+        parts.append("SELECT * FROM read_parquet(?)")
+        params.append(path)
+
+    table = conn.execute(
+        f"""SELECT variant_hash,
+            arg_max(prior_verdict, prior_date) AS prior_verdict,
+            arg_max(prior_validation, prior_date) AS prior_validation,
+            MAX(prior_date) AS prior_date,
+            SUM(prior_accepted)::BIGINT AS prior_accepted,
+            SUM(prior_rejected)::BIGINT AS prior_rejected
+        FROM ({' UNION ALL '.join(parts)}) GROUP BY variant_hash ORDER BY variant_hash""",
+        params,
+    ).arrow()
+    merged.update({table_uuid: digests[table_uuid] for table_uuid, _ in new})
+    table = table.replace_schema_metadata({MERGED_KEY: json.dumps(merged)})
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    pq.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+    os.replace(tmp, path)
+    return [table_uuid for table_uuid, _ in new]
+
+
+def join_prior_decisions(query: Query, path: str = DECISION_LAKE):
+    """Adds the verdicts of earlier validations to the query, joined on the variant_hash of its main table.
+    Does nothing if no validation was merged yet."""
+    if not os.path.exists(path) or not query.main_table:
+        return
+    table = Table(f"'{path}'", PRIOR_ALIAS)
+    query.add_table(
+        PRIOR_ALIAS,
+        table,
+        Field("variant_hash", query.main_table),
+        Field("variant_hash", table),
+        "LEFT JOIN",
+    )
+    query.set_fields(query.get_fields() + [Field(name, table) for name in PRIOR_FIELDS])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+
+class DiskCache:
+    """Query results kept across sessions, under the app data folder.
+
+    Keys are query fingerprints, which include the state of the files read: entries for modified files are never hit again,
+    and end up evicted. Arrow tables are stored as Arrow IPC files, scalars (counts) inline in the index.
+    The least recently used entries are evicted once the entries exceed max_size bytes, inline ones counting for INLINE_SIZE.
+    The index is written at most every FLUSH_INTERVAL seconds while entries are added, and Arrow files it doesn't list
+    (left by a crash before it was written) are removed when the cache is opened.
+    """
+
+    INDEX = "index.json"
+    # Nominal size (bytes) of an inline entry in the index, so that they are evicted too
+    INLINE_SIZE = 256
+    FLUSH_INTERVAL = 30
+
+    def __init__(self, folder: Path, max_size: int):
+        self.folder = Path(folder)
+        self.max_size = max_size
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.index: Dict[str, dict] = {}
+        self.dirty = False
+        self.last_flush = time.time()
+        try:
+            with open(self.folder / DiskCache.INDEX, "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            # No index (or a corrupted one): start afresh
+            self.index = {}
+        for entry in self.index.values():
+            # Indexes written before inline entries had a size
+            if entry["file"] is None:
+                entry["size"] = DiskCache.INLINE_SIZE
+        self.remove_orphans()
+
+    def remove_orphans(self):
+        """Removes the Arrow files the index doesn't list"""
+        listed = {entry["file"] for entry in self.index.values() if entry["file"]}
+        for path in self.folder.glob("*.arrow*"):
+            if path.name not in listed:
+                path.unlink(missing_ok=True)
+
+    def _entry_key(self, layer: str, key: str) -> str:
+        return f"{layer}-{key}"
+
+    def get(self, layer: str, key: str) -> Any:
+        entry = self.index.get(self._entry_key(layer, key))
+        if entry is None:
+            return None
+        if entry["file"] is None:
+            value = entry["value"]
+        else:
+            try:
+                with pa.memory_map(str(self.folder / entry["file"]), "r") as source:
+                    value = ipc.open_file(source).read_all()
+            except (OSError, pa.ArrowInvalid) as e:
+                print(e)
+                self.remove(layer, key)
+                return None
+        entry["last_access"] = time.time()
+        self.dirty = True
+        return value
+
+    def put(self, layer: str, key: str, value: Any):
+        entry_key = self._entry_key(layer, key)
+        if isinstance(value, pa.Table):
+            filename = f"{entry_key}.arrow"
+            try:
+                tmp = self.folder / (filename + ".tmp")
+                with pa.OSFile(str(tmp), "wb") as sink:
+                    with ipc.new_file(sink, value.schema) as writer:
+                        writer.write_table(value)
+                os.replace(tmp, self.folder / filename)
+            except (OSError, pa.ArrowInvalid) as e:
+                print(e)
+                return
+            entry = {
+                "file": filename,
+                "value": None,
+                "size": (self.folder / filename).stat().st_size,
+            }
+        else:
+            entry = {"file": None, "value": value, "size": DiskCache.INLINE_SIZE}
+        entry["last_access"] = time.time()
+        self.index[entry_key] = entry
+        self.dirty = True
+        self.evict()
+        if time.time() - self.last_flush >= DiskCache.FLUSH_INTERVAL:
+            self.flush()
+
+    def remove(self, layer: str, key: str):
+        entry = self.index.pop(self._entry_key(layer, key), None)
+        if entry and entry["file"]:
+            (self.folder / entry["file"]).unlink(missing_ok=True)
+        self.dirty = True
+
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self.index.values())
+
+    def evict(self):
+        total = self.size()
+        if total <= self.max_size:
+            return
+        for entry_key, entry in sorted(
+            self.index.items(), key=lambda item: item[1]["last_access"]
+        ):
+            if total <= self.max_size:
+                break
+            if entry["file"]:
+                (self.folder / entry["file"]).unlink(missing_ok=True)
+            total -= entry["size"]
+            del self.index[entry_key]
+        self.dirty = True
+
+    def clear(self):
+        for entry in self.index.values():
+            if entry["file"]:
+                (self.folder / entry["file"]).unlink(missing_ok=True)
+        self.index = {}
+        self.dirty = True
+        self.flush()
+
+    def flush(self):
+        """Writes the index (atomically). Access times are only written here, not on every read."""
+        if not self.dirty:
+            return
+        tmp = self.folder / (DiskCache.INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.folder / DiskCache.INDEX)
+        self.dirty = False
+        self.last_flush = time.time()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from typing import Dict, List, Tuple
+
+import duckdb as db
+
+from query import Field, FilterExpression, Query, Select, run_sql_arrow, select_files
+from query_cache import query_cache
+
+# Categorical columns faceted by default, when the main table has them
+DEFAULT_FACETS = ["snpeff_Annotation_Impact", "snpeff_Annotation", "cv_GT", "sample_name"]
+
+# Values shown per facet, the most frequent first
+TOP_K = 10
+
+
+class Facets:
+    """Counts of the most frequent values of categorical columns, over all the rows the query selects.
+
+    Each facet is counted with the query filter minus its own facet filter, so that the values it could add stay listed.
+    Facets sharing the same filter are counted in a single scan (GROUP BY GROUPING SETS), and the counts are cached
+    by fingerprint: when the filter changes, only the facets whose filter actually changed are counted again.
+    """
+
+    def __init__(self, query: Query, columns: List[str] = DEFAULT_FACETS, top_k=TOP_K):
+        self.query = query
+        self.columns = list(columns)
+        self.top_k = top_k
+
+    def available(self) -> List[str]:
+        """The facet columns the main table of the query has"""
+        if not self.query.conn or not self.query.main_table:
+            return []
+        columns = set(self.query.main_table_columns())
+        return [c for c in self.columns if c in columns]
+
+    def rows_select(self, columns: List[str], filter: FilterExpression) -> Select:
+        """All the rows of the query, with only the given columns (aliased f0, f1...)"""
+        # Files are pruned with the filter of the facet: pruned with the effective filter, a partition key facet
+        # would not read the files of the values it leaves out
+        select = self.query.get_count_select(self.query.pruned_main_table(filter))
+        select.fields = [
+            Field(name, self.query.main_table, alias=f"f{i}") for i, name in enumerate(columns)
+        ]
+        select.filter = filter
+        # LIMIT NULL: all the rows
+        select.limit = None
+        return select
+
+    def key(self, column: str, filter: FilterExpression) -> str:
+        select = self.rows_select([column], filter)
+        select.fields[0].alias = f"top_{self.top_k}"
+        return select.fingerprint(paged=False)
+
+    def compute(self) -> Dict[str, dict]:
+        """Counts of each available facet: {column: {"values": [(value, count)], "distinct": count of distinct values}}"""
+        counts = {}
+        # Facets to count, grouped by filter
+        groups: Dict[str, Tuple[FilterExpression, List[Tuple[str, str]]]] = {}
+        for column in self.available():
+            filter = self.query.effective_filter(excluded_facet=column)
+            key = self.key(column, filter)
+            cached = query_cache.get("facets", key)
+            if cached is not None:
+                counts[column] = cached
+                continue
+            groups.setdefault(filter.fingerprint(), (filter, []))[1].append((column, key))
+
+        for filter, columns in groups.values():
+            try:
+                counts.update(self.count(filter, columns))
+            except db.Error as e:
+                print(e)
+        return counts
+
+    def count(self, filter: FilterExpression, columns: List[Tuple[str, str]]) -> Dict[str, dict]:
+        """Counts the top values of the columns (with their cache keys) in one scan"""
+        rows = self.rows_select([column for column, _ in columns], filter)
+        sql, params = rows.statement()
+        aliases = ", ".join(f"f{i}" for i in range(len(columns)))
+        table = run_sql_arrow(
+            f"""SELECT GROUPING_ID({aliases}) AS g, {aliases}, COUNT(*) AS n, COUNT(*) OVER (PARTITION BY GROUPING_ID({aliases})) AS distinct_values
+            FROM ({sql}) GROUP BY GROUPING SETS ({', '.join(f'(f{i})' for i in range(len(columns)))})
+            QUALIFY row_number() OVER (PARTITION BY GROUPING_ID({aliases}) ORDER BY COUNT(*) DESC, {aliases}) <= {int(self.top_k)}
+            ORDER BY g, n DESC""",
+            self.query.conn,
+            tuple(params),
+            "stats",
+        )
+        n = len(columns)
+        counts = {column: {"values": [], "distinct": 0} for column, _ in columns}
+        # The grouping id has a bit set for each column not grouped by, the first column being the highest bit
+        by_grouping_id = {(1 << n) - 1 - (1 << (n - 1 - i)): column for i, (column, _) in enumerate(columns)}
+        for row in table.to_pylist():
+            column = by_grouping_id[row["g"]]
+            index = [c for c, _ in columns].index(column)
+            counts[column]["values"].append((row[f"f{index}"], row["n"]))
+            counts[column]["distinct"] = row["distinct_values"]
+
+        files = select_files(rows)
+        for column, key in columns:
+            query_cache.put("facets", key, counts[column], files=files)
+        return counts
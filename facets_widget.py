@@ -0,0 +1,108 @@
+import PySide6.QtCore as qc
+import PySide6.QtWidgets as qw
+
+from facets import Facets
+from query import Query
+
+# Wait for the query to settle before counting again (ms)
+REFRESH_DELAY = 500
+
+
+class FacetsWidget(qw.QWidget):
+    """Value counts of the categorical columns of the query. Checking values keeps only the rows having one of them."""
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+        self.facets = Facets(query)
+        self.lists = {}
+
+        self.groups_layout = qw.QVBoxLayout()
+        content = qw.QWidget()
+        content_layout = qw.QVBoxLayout(content)
+        content_layout.addLayout(self.groups_layout)
+        content_layout.addStretch()
+        scroll = qw.QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(content)
+
+        self.clear_button = qw.QPushButton("Clear facet filters")
+        self.clear_button.clicked.connect(self.on_clear_clicked)
+
+        layout = qw.QVBoxLayout()
+        layout.addWidget(scroll)
+        layout.addWidget(self.clear_button, alignment=qc.Qt.AlignmentFlag.AlignRight)
+        self.setLayout(layout)
+
+        # Counts are only computed while shown, once the query stops changing
+        self.refresh_timer = qc.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.query.query_changed.connect(self.refresh_timer.start)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh_timer.start()
+
+    def facet_list(self, column: str) -> qw.QListWidget:
+        if column not in self.lists:
+            box = qw.QGroupBox(column)
+            box_layout = qw.QVBoxLayout(box)
+            values = qw.QListWidget()
+            values.itemChanged.connect(
+                lambda item, column=column: self.on_item_changed(column)
+            )
+            box_layout.addWidget(values)
+            self.groups_layout.addWidget(box)
+            self.lists[column] = values
+        return self.lists[column]
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        counts = self.facets.compute()
+        selected = self.query.get_facet_filters()
+        for column, values in self.lists.items():
+            values.parentWidget().setVisible(column in counts)
+        for column, facet in counts.items():
+            values = self.facet_list(column)
+            values.blockSignals(True)
+            values.clear()
+            kept = selected.get(column, [])
+            shown = [value for value, _ in facet["values"]]
+            # Values kept stay listed (and checked), even when no longer among the most frequent
+            rows = facet["values"] + [(value, None) for value in kept if value not in shown]
+            for value, count in rows:
+                item = qw.QListWidgetItem(
+                    f"{value} ({count})" if count is not None else f"{value}"
+                )
+                item.setData(qc.Qt.ItemDataRole.UserRole, value)
+                item.setFlags(item.flags() | qc.Qt.ItemFlag.ItemIsUserCheckable)
+                item.setCheckState(
+                    qc.Qt.CheckState.Checked if value in kept else qc.Qt.CheckState.Unchecked
+                )
+                values.addItem(item)
+            if facet["distinct"] > len(facet["values"]):
+                values.parentWidget().setTitle(
+                    f"{column} (top {len(facet['values'])} of {facet['distinct']})"
+                )
+            else:
+                values.parentWidget().setTitle(column)
+            values.blockSignals(False)
+
+    def on_item_changed(self, column: str):
+        values = self.lists[column]
+        kept = [
+            values.item(i).data(qc.Qt.ItemDataRole.UserRole)
+            for i in range(values.count())
+            if values.item(i).checkState() == qc.Qt.CheckState.Checked
+        ]
+        self.query.set_facet_filter(column, kept)
+
+    def on_clear_clicked(self):
+        self.query.mute()
+        for column in list(self.query.get_facet_filters()):
+            self.query.set_facet_filter(column, [])
+        self.query.unmute()
+        self.query.update()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import duckdb as db
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cachetools import LRUCache
+
+# Hash columns point lookups and joins are made on
+INDEXED_COLUMNS = ("variant_hash", "validation_hash")
+
+# Written next to the parquet file: genotypes/runs/R1.parquet.hashidx
+SUFFIX = ".hashidx"
+
+# About 1% false positives
+BITS_PER_VALUE = 10
+HASH_COUNT = 7
+
+_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def index_path(path: str) -> str:
+    return str(path) + SUFFIX
+
+
+def _source_state(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _bit_positions(values: np.ndarray, log2_bits: int) -> np.ndarray:
+    """Bit positions of each value (one row per hash function), by double hashing of the (already hashed) values"""
+    h1 = values * np.uint64(0x9E3779B97F4A7C15)
+    h2 = (values * np.uint64(0xC2B2AE3D27D4EB4F)) | np.uint64(1)
+    shift = np.uint64(64 - log2_bits)
+    return np.stack(
+        [(h1 + np.uint64(i) * h2) >> shift for i in range(HASH_COUNT)]
+    ).astype(np.int64)
+
+
+def _as_uint64(values: Iterable[int]) -> np.ndarray:
+    return np.array([int(v) & _MASK for v in values], dtype=np.uint64)
+
+
+class BloomFilter:
+    """Set membership of 64 bits integers, with false positives but no false negatives"""
+
+    def __init__(self, bits: np.ndarray, log2_bits: int):
+        self.bits = bits
+        self.log2_bits = log2_bits
+
+    @classmethod
+    def build(cls, values: np.ndarray) -> "BloomFilter":
+        log2_bits = max(6, int(np.ceil(np.log2(max(1, len(values)) * BITS_PER_VALUE))))
+        bits = np.zeros(1 << log2_bits, dtype=bool)
+        if len(values):
+            bits[_bit_positions(values, log2_bits).ravel()] = True
+        return cls(bits, log2_bits)
+
+    def may_contain_any(self, values: np.ndarray) -> bool:
+        if not len(values):
+            return False
+        return bool(self.bits[_bit_positions(values, self.log2_bits)].all(axis=0).any())
+
+
+def build_index(
+    conn: db.DuckDBPyConnection, path: str, columns: Iterable[str] = INDEXED_COLUMNS
+) -> List[str]:
+    """Writes the sidecar index of a parquet file, for those of the columns it has (integer columns only).
+
+    Returns:
+        List[str]: the columns indexed
+    """
+    schema = pq.read_schema(path)
+    rows = {"column": [], "log2_bits": [], "bits": []}
+    for column in columns:
+        if column not in schema.names or not pa.types.is_integer(schema.field(column).type):
+            continue
+        values = (
+            conn.execute(f'SELECT DISTINCT "{column}" AS v FROM read_parquet(?) WHERE v IS NOT NULL', [path])
+            .arrow()
+            .column("v")
+            .to_numpy()
+        )
+        # Widened to 64 bits first (viewing narrower integers would reinterpret their bytes), like the values looked up
+        if values.dtype.kind == "u":
+            values = values.astype(np.uint64, copy=False)
+        else:
+            values = values.astype(np.int64, copy=False).view(np.uint64)
+        bloom = BloomFilter.build(values)
+        rows["column"].append(column)
+        rows["log2_bits"].append(bloom.log2_bits)
+        rows["bits"].append(np.packbits(bloom.bits).tobytes())
+
+    mtime, size = _source_state(path)
+    table = pa.table(rows).replace_schema_metadata(
+        {"source_mtime_ns": str(mtime), "source_size": str(size)}
+    )
+    tmp = index_path(path) + ".tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, index_path(path))
+    return rows["column"]
+
+
+def indexed_columns(path: str) -> List[str]:
+    """The columns the sidecar index of a parquet file has, even an outdated one (empty if it has none)"""
+    try:
+        return pq.read_table(index_path(path), columns=["column"]).column("column").to_pylist()
+    except (OSError, pa.ArrowInvalid):
+        return []
+
+
+# Loaded indexes, by file and file state (so that a rewritten file is never pruned with an outdated index)
+_indexes = LRUCache(maxsize=4096)
+
+
+def load_index(path: str) -> Dict[str, BloomFilter]:
+    """The bloom filters of a parquet file by column, or None if it has no index or an outdated one"""
+    try:
+        state = _source_state(path)
+    except OSError:
+        return None
+    key = (os.path.abspath(path), state)
+    if key in _indexes:
+        return _indexes[key]
+
+    index = None
+    try:
+        table = pq.read_table(index_path(path))
+        metadata = table.schema.metadata or {}
+        if (
+            int(metadata.get(b"source_mtime_ns", -1)),
+            int(metadata.get(b"source_size", -1)),
+        ) == state:
+            index = {
+                row["column"]: BloomFilter(
+                    np.unpackbits(np.frombuffer(row["bits"], dtype=np.uint8)).astype(bool)[: 1 << row["log2_bits"]],
+                    row["log2_bits"],
+                )
+                for row in table.to_pylist()
+            }
+    except (OSError, pa.ArrowInvalid, ValueError):
+        pass
+    _indexes[key] = index
+    return index
+
+
+def files_containing(files: List[str], lookups: Dict[str, Iterable[int]]) -> List[str]:
+    """The files that may have rows matching all the lookups (column -> values). Files without an index are kept."""
+    lookups = {column: _as_uint64(values) for column, values in lookups.items()}
+    kept = []
+    for f in files:
+        index = load_index(f)
+        if index is None or all(
+            column not in index or index[column].may_contain_any(values)
+            for column, values in lookups.items()
+        ):
+            kept.append(f)
+    return kept
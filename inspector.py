@@ -1,8 +1,11 @@
 import PySide6.QtCore as qc
 import PySide6.QtWidgets as qw
 
+from column_stats_widget import ColumnStatsWidget
 from commons import load_user_prefs, save_user_prefs
+from facets_widget import FacetsWidget
 from query import Query
+from slow_query_widget import SlowQueryWidget
 from validation_widget import ValidationWidgetContainer
 
 
@@ -31,6 +34,18 @@ class Inspector(qw.QWidget):
         self.main_widget.addTab(self.validation_widget, "Validation")
         self.tabs["validation"] = self.validation_widget
 
+        self.column_stats_widget = ColumnStatsWidget(self.query)
+        self.main_widget.addTab(self.column_stats_widget, "Column statistics")
+        self.tabs["column_stats"] = self.column_stats_widget
+
+        self.facets_widget = FacetsWidget(self.query)
+        self.main_widget.addTab(self.facets_widget, "Facets")
+        self.tabs["facets"] = self.facets_widget
+
+        self.slow_query_widget = SlowQueryWidget(self.query)
+        self.main_widget.addTab(self.slow_query_widget, "Slow queries")
+        self.tabs["slow_queries"] = self.slow_query_widget
+
         user_prefs = load_user_prefs()
 
         if user_prefs.get("inspector_tab") is not None:
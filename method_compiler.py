@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import copy
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from cachetools import LRUCache, cached
+from cachetools.keys import hashkey
+
+from query import Field, FilterExpression, FilterType, Join, Query, Table
+
+# Key used by the method files to refer to the run files of the validation
+MAIN_TABLE_ALIAS = "main_table"
+
+# Column of the run files identifying a row in the validation tables
+DECISION_KEY = "validation_hash"
+# Columns of the run files recorded with each decision
+DECISION_FIELDS = ("sample_name", "run_name")
+
+
+class MethodError(ValueError):
+    """Raised when a validation method file is malformed"""
+
+
+def _require(definition: dict, key: str, where: str):
+    if not isinstance(definition, dict) or key not in definition:
+        raise MethodError(f"{where}: missing key '{key}'")
+    return definition[key]
+
+
+def _parse_filter(definition, tables: Dict[str, Table], where: str) -> FilterExpression:
+    """Parses the method file filter syntax.
+
+    A filter is either {"$and": [...]}, {"$or": [...]}, a comparison {"field": "alias.name", "operator": ">", "value": 1}
+    (value bound as a parameter), or a raw SQL {"expression": "..."}.
+    """
+    if not definition:
+        return FilterExpression()
+    if isinstance(definition, dict) and "field" in definition:
+        table, _, name = definition["field"].rpartition(".")
+        table = table or MAIN_TABLE_ALIAS
+        if table not in tables:
+            raise MethodError(f"{where}: unknown table '{table}'")
+        try:
+            return FilterExpression(
+                field=Field(name, tables[table]),
+                operator=_require(definition, "operator", where).upper(),
+                value=definition.get("value"),
+            )
+        except (ValueError, TypeError) as e:
+            raise MethodError(f"{where}: {e}") from e
+    if not isinstance(definition, dict) or len(definition) != 1:
+        raise MethodError(f"{where}: a filter must be an object with a single key")
+
+    key, value = next(iter(definition.items()))
+    if key == "expression":
+        if not isinstance(value, str):
+            raise MethodError(f"{where}: filter expressions must be strings")
+        return FilterExpression(expression=value)
+    if key in ("$and", "$or"):
+        if not isinstance(value, list):
+            raise MethodError(f"{where}: '{key}' expects a list of filters")
+        node = FilterExpression(
+            filter_type=FilterType.AND if key == "$and" else FilterType.OR
+        )
+        for i, child in enumerate(value):
+            node.add_child(_parse_filter(child, tables, f"{where}.{key}[{i}]"))
+        return node
+    raise MethodError(f"{where}: unknown filter key '{key}'")
+
+
+class CompiledStep:
+    """A validation step with its tables, joins, fields, filter and order already built.
+
+    Fields refer to the run files through a placeholder table aliased main_table, since Field only renders the alias of its table.
+    """
+
+    def __init__(self, definition: dict, index: int):
+        where = f"step {index + 1}"
+
+        self.index = index
+        self.title: str = _require(definition, "title", where)
+        self.description: str = _require(definition, "description", where)
+
+        # When set, the step starts from the rows that survived the previous step instead of the run files
+        self.refines_previous = bool(definition.get("refines_previous", False))
+        if self.refines_previous and index == 0:
+            raise MethodError(f"{where}: the first step cannot refine a previous one")
+
+        self.tables: Dict[str, Table] = {
+            MAIN_TABLE_ALIAS: Table(MAIN_TABLE_ALIAS, MAIN_TABLE_ALIAS)
+        }
+        self.joins: Dict[str, Join] = {}
+        self.fields: List[Field] = []
+        self.order_by: List[Tuple[Field, str]] = []
+
+        for table_def in _require(definition, "tables", where):
+            alias = _require(table_def, "alias", f"{where}, tables")
+            join_def = _require(table_def, "join", f"{where}, table {alias}")
+            left_table = _require(join_def, "left_table", f"{where}, table {alias}")
+            if left_table not in self.tables:
+                raise MethodError(
+                    f"{where}, table {alias}: unknown left table '{left_table}'"
+                )
+            self.tables[alias] = Table(
+                _require(table_def, "name", f"{where}, table {alias}"),
+                alias,
+                quoted=table_def.get("quoted", False),
+            )
+            self.joins[alias] = Join(
+                self.tables[alias],
+                left_on=Field(
+                    _require(join_def, "left_on", f"{where}, table {alias}"),
+                    self.tables[left_table],
+                ),
+                right_on=Field(
+                    _require(join_def, "right_on", f"{where}, table {alias}"),
+                    self.tables[alias],
+                ),
+            )
+
+        for field_def in _require(definition, "fields", where):
+            table = _require(field_def, "table", f"{where}, fields")
+            if table not in self.tables:
+                raise MethodError(f"{where}, fields: unknown table '{table}'")
+            self.fields.append(
+                Field(
+                    _require(field_def, "name", f"{where}, fields"),
+                    self.tables[table],
+                    is_expression=field_def.get("is_expression", False),
+                )
+            )
+        if not self.fields:
+            raise MethodError(f"{where}: no fields to show")
+
+        # Always fetched, even when hidden, so that decisions can be recorded for the displayed rows.
+        # Only those the run files have are, see apply
+        self.key_fields = [
+            Field(name, self.tables[MAIN_TABLE_ALIAS]) for name in (DECISION_KEY,) + DECISION_FIELDS
+        ]
+
+        self.filter = _parse_filter(
+            definition.get("filters"), self.tables, f"{where}, filters"
+        ).normalize()
+
+        for order_def in definition.get("order", []):
+            table, _, name = _require(order_def, "field", f"{where}, order").rpartition(
+                "."
+            )
+            table = table or MAIN_TABLE_ALIAS
+            if table not in self.tables:
+                raise MethodError(f"{where}, order: unknown table '{table}'")
+            direction = order_def.get("direction", "asc").upper()
+            if direction not in ("ASC", "DESC"):
+                raise MethodError(f"{where}, order: invalid direction '{direction}'")
+            self.order_by.append((Field(name, self.tables[table]), direction))
+
+    def apply(self, query: Query):
+        """Sets the query structure to this step. The caller is responsible for muting the query and updating it."""
+        query.set_additional_tables(dict(self.joins))
+        query.set_fields(list(self.fields))
+        # Run files split by run usually have no run_name column (see repartition)
+        columns = set(query.main_table_columns())
+        query.set_key_fields([f for f in self.key_fields if f.name in columns])
+        # The query filter may be modified in place (add_filter), so it must not be shared with the compiled step
+        query.set_filter(copy.deepcopy(self.filter))
+        query.set_order_by(list(self.order_by))
+
+
+class CompiledMethod:
+    def __init__(self, definition: list, digest: str):
+        if not isinstance(definition, list) or not definition:
+            raise MethodError("A validation method must be a non-empty list of steps")
+        self.digest = digest
+        self.steps = [CompiledStep(step, i) for i, step in enumerate(definition)]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index: int) -> CompiledStep:
+        return self.steps[index]
+
+
+@cached(cache=LRUCache(maxsize=32), key=lambda raw, digest: hashkey(digest))
+def _compile(raw: bytes, digest: str) -> CompiledMethod:
+    try:
+        definition = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise MethodError(f"Invalid JSON: {e}") from e
+    return CompiledMethod(definition, digest)
+
+
+def compile_method(method_path: Path) -> CompiledMethod:
+    """Validates and compiles a validation method file.
+
+    Compiled methods are cached by file content hash, so a method is only parsed again when its file changes.
+
+    Args:
+        method_path (Path): path to the method JSON file
+
+    Raises:
+        MethodError: if the method file is malformed
+
+    Returns:
+        CompiledMethod: the compiled steps
+    """
+    raw = Path(method_path).read_bytes()
+    return _compile(raw, hashlib.sha256(raw).hexdigest())
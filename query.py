@@ -1,26 +1,75 @@
 #!/usr/bin/env python
 
+import copy
+import glob
+import hashlib
 import os
-import pickle
+import random
+import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
 
 import duckdb as db
+import pyarrow as pa
+import pyarrow.parquet as pq
 import PySide6.QtCore as qc
-from cachetools import cached
-
-from commons import duck_db_literal_string_list
-
-
-@cached(cache={})
-def run_sql(query: str, conn: db.DuckDBPyConnection = None) -> Union[List[dict], None]:
+from cachetools import LRUCache
+
+from commons import (
+    duck_db_literal_string_list,
+    files_match,
+    get_datalake_settings,
+    table_exists,
+)
+from hash_index import INDEXED_COLUMNS, files_containing
+from query_cache import query_cache
+from query_monitor import query_monitor
+from slow_query_log import slow_query_log
+from spill import DEFAULT_SPILL_THRESHOLD, release_spill_files, spill_if_large
+
+
+def run_sql(
+    query: str,
+    conn: db.DuckDBPyConnection = None,
+    params: Tuple = (),
+    query_class="page",
+) -> Union[List[dict], None]:
+    res = run_sql_arrow(query, conn, params, query_class)
+    if res is not None:
+        return res.to_pylist()
+
+
+def run_sql_arrow(
+    query: str,
+    conn: db.DuckDBPyConnection = None,
+    params: Tuple = (),
+    query_class="page",
+) -> Union[pa.Table, None]:
+    """Same as run_sql, but keeps the result as an Arrow table (with DuckDB's types, e.g. unsigned hashes).
+
+    The statement goes through the query monitor: it reports progress, and is interrupted past the time budget of its class (page, count, export).
+    Statements slower than the threshold of the slow query log are recorded there, with their plan.
+    """
     if not conn:
         return None
-    res = conn.sql(query)
-    if res:
-        return res.pl().to_dicts()
+
+    def execute():
+        if params:
+            # Bound parameters: the SQL text stays the same from one page to the next
+            res = conn.execute(query, list(params))
+            if res.description:
+                return res.arrow()
+            return None
+        res = conn.sql(query)
+        if res:
+            return res.arrow()
+
+    with slow_query_log.timed(conn, query, query_class, params):
+        return query_monitor.run(conn, execute, query_class)
 
 
 class FilterType(Enum):
@@ -30,14 +79,26 @@ class FilterType(Enum):
 
 
 class Table:
-    def __init__(self, name: str, alias: str, quoted=False) -> None:
+    def __init__(
+        self, name: str, alias: str, quoted=False, files: List[str] = None
+    ) -> None:
         self.name = name
         self.alias = alias
         self.quoted = quoted
+        # The files this table reads from, when its name is a table function over them (read_parquet([...]))
+        self.files = files
 
     def get_alias(self) -> str:
         return self.alias or self.name
 
+    def source_files(self) -> List[str]:
+        """The files this table reads, either given explicitly or from a quoted file name ('aggregates/variants.parquet')"""
+        if self.files:
+            return [str(f) for f in self.files]
+        if not self.quoted and len(self.name) > 2 and self.name[0] == self.name[-1] == "'":
+            return [self.name[1:-1]]
+        return []
+
     def __format__(self, format_spec: str) -> str:
 
         # Use alias or name (a takes precedence over all other format specifiers)
@@ -82,6 +143,9 @@ class Field:
             base = self.name.format(table=f"{self.table:a}" if self.table else "")
             if "a" in format_spec and self.alias:
                 return f"{base} AS {self.alias}"
+            if "s" in format_spec:
+                # Projected expression without its alias, e.g. as the argument of an aggregate
+                return base
 
         if "s" in format_spec:
             base = self.name if "q" not in format_spec else f'"{self.name}"'
@@ -130,61 +194,284 @@ class Join:
         return f"{self.join_type} {self.table:qj} ON {self.left_on:qj} = {self.right_on:qj}"
 
 
+def sql_literal(value: Any) -> str:
+    """Renders a Python value as a SQL literal (only used to display filters, execution binds values as parameters)"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def distinct_values(values: list) -> list:
+    """The values without duplicates, in order. Compared as SQL literals: in Python 1 == True, not in SQL."""
+    distinct = {}
+    for v in values:
+        distinct.setdefault(sql_literal(v), v)
+    return list(distinct.values())
+
+
+def field_key(field: Field) -> Tuple[str, str, bool]:
+    """Identifies a field independently of its Python identity (table alias, name, is_expression)"""
+    return (field.table.get_alias() if field.table else "", field.name, field.is_expression)
+
+
 class FilterExpression:
+    """A filter tree. Nodes are AND/OR of their children, leaves are one of:
+
+    - a comparison of a field to a value (field, operator, value), compiled with the value as a bound parameter
+    - a constant (TRUE/FALSE), mostly produced by normalize
+    - a raw SQL expression, kept for the method files. It is opaque: never simplified, and must come from trusted config
+    """
+
+    # Operators with no value, operators with a list of values, and all the others (one value)
+    UNARY_OPERATORS = ("IS NULL", "IS NOT NULL")
+    LIST_OPERATORS = ("IN", "NOT IN")
+    OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "ILIKE") + UNARY_OPERATORS + LIST_OPERATORS
+
     def __init__(
         self,
         filter_type=FilterType.LEAF,
         expression: str = None,
         parent: "FilterExpression" = None,
+        children: List["FilterExpression"] = None,
+        field: Field = None,
+        operator: str = None,
+        value: Any = None,
+        constant: bool = None,
     ) -> None:
+        if operator is not None and operator not in FilterExpression.OPERATORS:
+            raise ValueError(f"Unknown filter operator {operator}")
+        if operator in FilterExpression.LIST_OPERATORS:
+            value = list(value)
+
         self.filter_type = filter_type
         self.expression = expression
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.constant = constant
         self.children: List["FilterExpression"] = []
         self.parent = parent
         if self.parent:
             self.parent.children.append(self)
+        for child in children or []:
+            self.add_child(child)
 
     def add_child(self, child: "FilterExpression"):
         self.children.append(child)
         child.parent = self
 
+    def is_comparison(self) -> bool:
+        return self.filter_type == FilterType.LEAF and self.field is not None
+
     def __bool__(self) -> bool:
         if self.filter_type == FilterType.LEAF:
-            return bool(self.expression)
+            return (
+                bool(self.expression)
+                or self.field is not None
+                or self.constant is not None
+            )
         else:
             return bool(self.children)
 
+    def __format__(self, format_spec: str) -> str:
+        # P stands for parameterized: values are left as placeholders, see params()
+        if self.filter_type != FilterType.LEAF:
+            # Each child is parenthesized, so that operator precedence is preserved whatever the nesting
+            return f" {self.filter_type.value} ".join(
+                f"({child:{format_spec}})" for child in self.children if child
+            )
+        if self.constant is not None:
+            return "TRUE" if self.constant else "FALSE"
+        if self.field is None:
+            return self.expression or ""
+
+        def value(v):
+            return "?" if "P" in format_spec else sql_literal(v)
+
+        if self.operator in FilterExpression.UNARY_OPERATORS:
+            return f"{self.field:qj} {self.operator}"
+        if self.operator in FilterExpression.LIST_OPERATORS:
+            if not self.value:
+                # x IN () is not valid SQL
+                return "FALSE" if self.operator == "IN" else "TRUE"
+            return f"{self.field:qj} {self.operator} ({', '.join(value(v) for v in self.value)})"
+        if self.operator == "ILIKE":
+            return f"CAST({self.field:qj} AS TEXT) ILIKE {value(self.value)}"
+        return f"{self.field:qj} {self.operator} {value(self.value)}"
+
     def __str__(self) -> str:
+        return self.__format__("")
+
+    def params(self) -> list:
+        """The values to bind to the placeholders of f'{self:P}', in order"""
+        if self.filter_type != FilterType.LEAF:
+            return [p for child in self.children if child for p in child.params()]
+        if not self.is_comparison() or self.operator in FilterExpression.UNARY_OPERATORS:
+            return []
+        if self.operator in FilterExpression.LIST_OPERATORS:
+            return list(self.value)
+        return [self.value]
+
+    def compile(self) -> Tuple[str, list]:
+        """Returns the parameterized SQL of this filter, and its parameters"""
+        return self.__format__("P"), self.params()
+
+    def canonical(self, key=field_key):
+        """A hashable, order-independent representation of this filter (normalize first for equivalent filters to match).
+
+        Args:
+            key (Callable[[Field], Hashable], optional): how fields are identified. Defaults to field_key.
+        """
+        if self.filter_type != FilterType.LEAF:
+            return (
+                self.filter_type.value,
+                tuple(sorted((c.canonical(key) for c in self.children if c), key=repr)),
+            )
+        if self.constant is not None:
+            return ("CONSTANT", self.constant)
+        if self.field is None:
+            return ("EXPRESSION", self.expression or "")
+        value = self.value
+        if self.operator in FilterExpression.LIST_OPERATORS:
+            value = tuple(sorted(distinct_values(value), key=repr))
+        return ("COMPARISON", key(self.field), self.operator, value)
+
+    def fingerprint(self) -> str:
+        """A stable hash of the normalized filter, to be used as (part of) a cache key"""
+        canonical = repr(self.normalize().canonical()).encode()
+        return hashlib.sha256(canonical).hexdigest()[:16]
+
+    def normalize(self) -> "FilterExpression":
+        """Returns an equivalent, simplified filter tree (self is left untouched).
+
+        Nested ANDs (ORs) are flattened, constants are folded, empty leaves and groups are dropped (as when rendered),
+        and equality/IN comparisons on the same field are merged (union under OR, intersection under AND).
+        """
         if self.filter_type == FilterType.LEAF:
-            return self.expression
-        else:
-            if self.parent:
-                return str(self.filter_type).join(
-                    f"({str(child)})" if child else "" for child in self.children
+            if not self:
+                return FilterExpression()
+            if self.operator in FilterExpression.LIST_OPERATORS:
+                values = distinct_values(self.value)
+                if not values:
+                    return FilterExpression(constant=self.operator == "NOT IN")
+                if len(values) == 1:
+                    return FilterExpression(
+                        field=self.field,
+                        operator="=" if self.operator == "IN" else "!=",
+                        value=values[0],
+                    )
+                return FilterExpression(
+                    field=self.field, operator=self.operator, value=values
                 )
+            return FilterExpression(
+                expression=self.expression,
+                field=self.field,
+                operator=self.operator,
+                value=self.value,
+                constant=self.constant,
+            )
+
+        is_and = self.filter_type == FilterType.AND
+        children: List[FilterExpression] = []
+        for child in self.children:
+            child = child.normalize()
+            if not child:
+                continue
+            # Flatten nested nodes of the same type
+            if child.filter_type == self.filter_type:
+                children.extend(child.children)
+            else:
+                children.append(child)
+        if not children:
+            # An empty group is no filter at all, whatever its type: it is left out when rendered
+            return FilterExpression()
+
+        # Constant folding: TRUE is neutral for AND and absorbing for OR, the opposite for FALSE
+        if any(c.constant is (not is_and) for c in children):
+            return FilterExpression(constant=not is_and)
+        children = [c for c in children if c.constant is None]
+
+        # Merge = and IN on the same field
+        merged: Dict[Tuple, FilterExpression] = {}
+        others = []
+        for child in children:
+            if child.is_comparison() and child.operator in ("=", "IN"):
+                values = child.value if child.operator == "IN" else [child.value]
+                key = field_key(child.field)
+                if key not in merged:
+                    merged[key] = FilterExpression(
+                        field=child.field, operator="IN", value=values
+                    )
+                elif is_and:
+                    kept = {sql_literal(v) for v in values}
+                    merged[key].value = [v for v in merged[key].value if sql_literal(v) in kept]
+                else:
+                    merged[key].value = distinct_values(merged[key].value + values)
             else:
-                return str(self.filter_type).join(str(child) for child in self.children)
+                others.append(child)
+        # Normalizing the merged INs turns single values back to =, and empty intersections to FALSE
+        children = others + [m.normalize() for m in merged.values()]
+        if any(c.constant is (not is_and) for c in children):
+            return FilterExpression(constant=not is_and)
+        return _make_node(self.filter_type, children)
 
     def to_json(self):
         if self.filter_type == FilterType.LEAF:
+            if self.constant is not None:
+                return {"constant": self.constant}
+            if self.field is not None:
+                return {
+                    "field": f"{field_key(self.field)[0]}.{self.field.name}",
+                    "is_expression": self.field.is_expression,
+                    "operator": self.operator,
+                    "value": self.value,
+                }
             return self.expression
         else:
             return {
-                "filter_type": self.filter_type,
+                "filter_type": self.filter_type.value,
                 "children": [child.to_json() for child in self.children],
             }
 
     @staticmethod
-    def from_json(json):
-        if isinstance(json, str):
+    def from_json(json, tables: Dict[str, Table] = None):
+        """Rebuilds a filter from to_json output. Fields are bound to tables by alias (created on the fly if not given)"""
+        tables = tables if tables is not None else {}
+        if json is None or isinstance(json, str):
             return FilterExpression(expression=json)
-        else:
+        if "constant" in json:
+            return FilterExpression(constant=json["constant"])
+        if "field" in json:
+            alias, _, name = json["field"].rpartition(".")
+            table = None
+            if alias:
+                table = tables.setdefault(alias, Table(alias, alias))
             return FilterExpression(
-                filter_type=json["filter_type"],
-                children=[
-                    FilterExpression.from_json(child) for child in json["children"]
-                ],
+                field=Field(name, table, is_expression=json.get("is_expression", False)),
+                operator=json["operator"],
+                value=json.get("value"),
             )
+        return FilterExpression(
+            filter_type=FilterType(json["filter_type"]),
+            children=[
+                FilterExpression.from_json(child, tables) for child in json["children"]
+            ],
+        )
+
+
+def _make_node(filter_type: FilterType, children: List[FilterExpression]):
+    if not children:
+        # Only neutral constants were left: TRUE for an AND (no filter at all), FALSE for an OR
+        if filter_type == FilterType.AND:
+            return FilterExpression()
+        return FilterExpression(constant=False)
+    if len(children) == 1:
+        return children[0]
+    return FilterExpression(filter_type=filter_type, children=children)
 
 
 class Select:
@@ -209,34 +496,362 @@ class Select:
     def __format__(self, format_spec: str) -> str:
         filt = ""
         if self.filter:
-            filt = f" WHERE {self.filter}"
+            # Parameterized selects bind filter values too
+            filt = f" WHERE {self.filter:P}" if "P" in format_spec else f" WHERE {self.filter}"
 
         order = ""
         if self.order_by:
-            order = f" ORDER BY {', '.join(map(lambda f:f'{f[0]:q} {f[1]}', self.order_by))}"
+            order = f" ORDER BY {', '.join(map(lambda f:f'{f[0]:qj} {f[1]}', self.order_by))}"
 
         joins = ""
         if self.joins:
             joins = " ".join(map(lambda e: f"{e}", self.joins))
 
-        q = f"SELECT {', '.join(map(lambda f:f'{f:qsa}', self.fields))} FROM {self.main_table:s} {joins}{filt}{order} LIMIT {self.limit} OFFSET {self.offset}"
+        # P stands for parameterized: limit and offset are left as placeholders
+        if "P" in format_spec:
+            page = " LIMIT ? OFFSET ?"
+        else:
+            page = f" LIMIT {self.limit} OFFSET {self.offset}"
+
+        q = f"SELECT {', '.join(map(lambda f:f'{f:qsa}', self.fields))} FROM {self.main_table:s} {joins}{filt}{order}{page}"
 
-        if format_spec == "p":
+        if "p" in format_spec:
             q = f"({q})"
-        print(q)
         return q
 
     def __str__(self):
         return self.__format__("")
 
-    def save(self, filename: Path):
-        with open(filename, "w") as f:
-            pickle.dump(self, f)
+    def fingerprint(self, paged=True) -> str:
+        return fingerprint(self, paged)
 
-    @staticmethod
-    def load(filename: Path):
-        with open(filename, "r") as f:
-            return pickle.load(f)
+    def is_file_backed(self) -> bool:
+        """Whether every table read is a file. Only then does the fingerprint stay valid across sessions
+        (database tables are versioned in memory only)."""
+        return all(table.source_files() for table in select_tables(self))
+
+    def statement(self) -> Tuple[str, list]:
+        """Renders this query with filter values, limit and offset as bound parameters.
+
+        Returns:
+            Tuple[str, list]: the SQL text, and the parameters to execute it with
+        """
+        params = self.filter.params() if self.filter else []
+        return self.__format__("P"), params + [self.limit, self.offset]
+
+
+
+# Tables stored in the database (validation tables, materialized steps) have no file to stat.
+# Their version is bumped on every write, so that fingerprints of queries reading them change.
+_table_versions: Dict[str, int] = {}
+
+
+def bump_table_version(name: str):
+    _table_versions[name] = _table_versions.get(name, 0) + 1
+
+
+def table_identity(table: Table) -> Tuple:
+    """What a table reads, independently of the alias it is given in a query"""
+    return (table.name, table.quoted, _table_versions.get(table.name, 0))
+
+
+def file_state(path: str) -> Tuple[str, int, int]:
+    """Resolved path, modification time and size of a file (-1 if it doesn't exist)"""
+    try:
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (os.path.abspath(path), -1, -1)
+
+
+def select_tables(select: Select) -> List[Table]:
+    return [select.main_table] + [join.table for join in select.joins or []]
+
+
+def select_files(select: Select) -> List[str]:
+    """All the files a select reads from"""
+    return sorted({f for table in select_tables(select) for f in table.source_files()})
+
+
+def select_structure(select: Select, paged=True) -> Tuple:
+    """The canonical form of a select: field order, aliases and rendering details don't matter.
+
+    Args:
+        select (Select): the select to describe
+        paged (bool, optional): whether limit and offset are part of the result. Defaults to True.
+    """
+    aliases = {table.get_alias(): table_identity(table) for table in select_tables(select)}
+
+    def field_identity(field: Field) -> Tuple:
+        table = aliases.get(field.table.get_alias()) if field.table else None
+        return (table, field.name, field.is_expression)
+
+    fields = tuple(
+        sorted(
+            ((f.alias or "", field_identity(f)) for f in select.fields),
+            key=repr,
+        )
+    )
+    joins = tuple(
+        sorted(
+            (
+                (
+                    table_identity(join.table),
+                    join.join_type,
+                    field_identity(join.left_on),
+                    field_identity(join.right_on),
+                )
+                for join in select.joins or []
+            ),
+            key=repr,
+        )
+    )
+    filt = select.filter.normalize().canonical(field_identity) if select.filter else ()
+    order = tuple(
+        (field_identity(field), direction.upper())
+        for field, direction in select.order_by or []
+    )
+    page = (select.limit, select.offset) if paged else ()
+    return (table_identity(select.main_table), fields, joins, filt, order, page)
+
+
+def fingerprint(select: Select, paged=True) -> str:
+    """Hash of the canonical select and of the state of the files it reads, to be used as a cache key.
+
+    Two selects differing only by field order, aliases or filter layout have the same fingerprint,
+    and a fingerprint changes as soon as one of the files read is modified.
+    """
+    files = tuple(file_state(f) for f in select_files(select))
+    canonical = repr((select_structure(select, paged), files)).encode()
+    return hashlib.sha256(canonical).hexdigest()
+
+
+# Row counts from the parquet footers, by file state
+_parquet_row_groups = LRUCache(maxsize=4096)
+
+
+def parquet_row_count(files: List[str]) -> int:
+    """Number of rows of parquet files, read from their metadata (no scan)"""
+    return sum(sum(parquet_row_groups(f)) for f in files)
+
+
+def parquet_row_groups(path: str) -> List[int]:
+    """Number of rows of each row group of a parquet file, read from its metadata"""
+    key = file_state(path)
+    if key not in _parquet_row_groups:
+        metadata = pq.ParquetFile(path).metadata
+        _parquet_row_groups[key] = [
+            metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+        ]
+    return _parquet_row_groups[key]
+
+
+def sample_row_groups(files: List[str], keep: Callable[[str], bool], rows: int) -> pa.Table:
+    """About the given number of rows, taken from row groups picked at random among the files, with only the columns
+    (and hive partition keys) kept. Files are usually clustered (by run, sample...): their first rows are no sample of the rest.
+    Row groups are read directly: DuckDB samples (USING SAMPLE) scan the whole files."""
+    groups = [(f, i) for f in files for i, n in enumerate(parquet_row_groups(f)) if n]
+    # Seeded by the files, so that the same query gets the same estimate
+    random.Random(",".join(files)).shuffle(groups)
+    groups = groups[:COUNT_SAMPLE_ROW_GROUPS]
+    parts = []
+    for path, index in groups:
+        parquet = pq.ParquetFile(path)
+        # Only the first batch of the row group is decoded
+        batch = next(
+            parquet.iter_batches(
+                batch_size=max(1, rows // len(groups)),
+                row_groups=[index],
+                columns=[c for c in parquet.schema_arrow.names if keep(c)],
+            )
+        )
+        part = pa.Table.from_batches([batch])
+        for key, value in partition_values(path).items():
+            if keep(key) and key not in part.column_names:
+                part = part.append_column(key, pa.array([value] * part.num_rows))
+        parts.append(part)
+    if not parts:
+        return None
+    return pa.concat_tables(parts, promote_options="default")
+
+
+def partition_values(path: str) -> Dict[str, str]:
+    """Hive partition keys and values of a file (e.g. .../sample_name=S1/chromosome=2/data_0.parquet)"""
+    values = {}
+    for part in Path(path).parts[:-1]:
+        key, sep, value = part.partition("=")
+        if sep:
+            values[key] = value
+    return values
+
+
+def is_partitioned(files: List[str]) -> bool:
+    return any(partition_values(f) for f in files)
+
+
+def expand_files(files: List[str]) -> List[str]:
+    """Files, with glob patterns (e.g. genotypes/partitions/**/*.parquet) replaced by the files they match"""
+    expanded = []
+    for f in files:
+        f = str(f)
+        if glob.has_magic(f):
+            expanded.extend(sorted(glob.glob(f, recursive=True)))
+        else:
+            expanded.append(f)
+    return expanded
+
+
+def _partition_compare(operator: str, partition_value: str, value: Any) -> bool:
+    """Compares a partition value (a string, in the path) to a filter value. True when it can't tell."""
+    values = value if operator in FilterExpression.LIST_OPERATORS else [value]
+    try:
+        # Compare as the type of the filter value, so that chromosome=10 > 9
+        casts = [
+            type(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else str
+            for v in values
+        ]
+        candidates = [cast(partition_value) for cast in casts]
+    except ValueError:
+        return True
+    pairs = list(zip(candidates, values))
+    if operator == "=":
+        return pairs[0][0] == pairs[0][1]
+    if operator == "!=":
+        return pairs[0][0] != pairs[0][1]
+    if operator == "IN":
+        return any(c == v for c, v in pairs)
+    if operator == "NOT IN":
+        return all(c != v for c, v in pairs)
+    try:
+        if operator == "<":
+            return pairs[0][0] < pairs[0][1]
+        if operator == "<=":
+            return pairs[0][0] <= pairs[0][1]
+        if operator == ">":
+            return pairs[0][0] > pairs[0][1]
+        if operator == ">=":
+            return pairs[0][0] >= pairs[0][1]
+    except TypeError:
+        pass
+    # ILIKE, IS NULL...
+    return True
+
+
+def may_match_partition(
+    filter: FilterExpression, values: Dict[str, str], table_alias: str
+) -> bool:
+    """Whether rows of a partition may match the filter, only False when the partition values alone rule it out"""
+    if not filter:
+        return True
+    if filter.filter_type == FilterType.AND:
+        return all(may_match_partition(c, values, table_alias) for c in filter.children)
+    if filter.filter_type == FilterType.OR:
+        return any(may_match_partition(c, values, table_alias) for c in filter.children)
+    if filter.constant is not None:
+        return filter.constant
+    if (
+        filter.is_comparison()
+        and not filter.field.is_expression
+        and filter.field.name in values
+        and (filter.field.table is None or filter.field.table.get_alias() == table_alias)
+    ):
+        return _partition_compare(filter.operator, values[filter.field.name], filter.value)
+    return True
+
+
+def prune_partitions(
+    files: List[str], filter: FilterExpression, table_alias: str
+) -> List[str]:
+    """The files (glob patterns expanded) in the hive partitions the filter may match"""
+    return [
+        f
+        for f in expand_files(files)
+        if may_match_partition(filter, partition_values(f), table_alias)
+    ]
+
+
+def hash_lookups(filter: FilterExpression, table_alias: str) -> Dict[str, set]:
+    """Values every row must have in the indexed hash columns (see hash_index), from the = and IN terms of a top-level AND"""
+    if not filter:
+        return {}
+    terms = filter.children if filter.filter_type == FilterType.AND else [filter]
+    lookups = {}
+    for term in terms:
+        if (
+            term.is_comparison()
+            and term.operator in ("=", "IN")
+            and not term.field.is_expression
+            and term.field.name in INDEXED_COLUMNS
+            and (term.field.table is None or term.field.table.get_alias() == table_alias)
+        ):
+            values = term.value if term.operator == "IN" else [term.value]
+            if not all(isinstance(v, int) for v in values):
+                continue
+            name = term.field.name
+            lookups[name] = lookups[name] & set(values) if name in lookups else set(values)
+    return lookups
+
+
+# Joined database tables with more distinct keys than this are not used to skip files
+SEMI_JOIN_MAX_KEYS = 100_000
+
+
+def parquet_table(files: List[str], alias: str) -> Table:
+    """A table reading parquet files, with the hive partition keys as columns if the files are partitioned"""
+    options = ", hive_partitioning = true" if is_partitioned(expand_files(files)) else ""
+    return Table(
+        f"read_parquet({duck_db_literal_string_list(files)}{options})",
+        alias,
+        quoted=False,
+        files=files,
+    )
+
+
+# Operators accepted at the start of a column filter, longest first so that >= is not read as >
+COLUMN_FILTER_OPERATORS = [">=", "<=", "!=", "=", ">", "<"]
+
+
+def parse_column_filter(field: Field, text: str) -> FilterExpression:
+    """Turns the text typed in a column filter into a predicate on that column.
+
+    Text starting with a comparison operator (>=, <=, !=, =, >, <) compares the column to the value,
+    any other text is searched (case insensitive) in the column.
+    """
+    text = text.strip()
+    for operator in COLUMN_FILTER_OPERATORS:
+        if text.startswith(operator):
+            value = text[len(operator) :].strip()
+            for cast in (int, float):
+                try:
+                    value = cast(value)
+                    break
+                except ValueError:
+                    pass
+            return FilterExpression(field=field, operator=operator, value=value)
+    return FilterExpression(field=field, operator="ILIKE", value=f"%{text}%")
+
+
+# Prefix of the aliases given to key fields, so they can be told apart from the displayed columns
+KEY_PREFIX = "__key_"
+
+# Alias of the row count of the whole result, in single pass pages (see Query.fetch_page)
+TOTAL_COLUMN = "__total"
+
+# Above this many rows in the main table files, counts are estimated first and computed in the background
+APPROXIMATE_COUNT_ABOVE = 1_000_000
+# Rows the selectivity of the filter is measured on, to estimate counts
+COUNT_SAMPLE_ROWS = 100_000
+# Row groups the rows are taken from, at most
+COUNT_SAMPLE_ROW_GROUPS = 32
+# Name the sample is registered under
+COUNT_SAMPLE_TABLE = "__count_sample"
+
+
+class CountNotifier(qc.QObject):
+    """Brings the counts computed in background threads back to the main thread"""
+
+    # Count fingerprint, count
+    count_ready = qc.Signal(str, object)
 
 
 class Query(qc.QObject):
@@ -265,6 +880,21 @@ class Query(qc.QObject):
             sys.exit(1)
 
         self.datalake_path = None
+        # Pages bigger than this (in bytes) are memory-mapped from disk instead of held in memory
+        self.spill_threshold = DEFAULT_SPILL_THRESHOLD
+        # Names of the fields the user chose not to see. Kept across steps, since it's a display preference
+        self.hidden_fields = set()
+        # Single pass: when the row count is not known yet, it is computed along with the page (see fetch_page)
+        self.single_pass = True
+        # Counts being computed in the background, by count fingerprint: whether they are persistent, and the files read
+        self.background_counts: Dict[str, Tuple[bool, List[str]]] = {}
+        self.count_notifier = CountNotifier(self)
+        self.count_notifier.count_ready.connect(self.on_count_ready)
+        # Fan out mode: multi-file selects run one file per thread, results are merged (see run_page)
+        self.fan_out = False
+        self.fan_out_workers = None
+        # Columns of the main tables, by table identity (see main_table_columns)
+        self._main_table_columns = LRUCache(maxsize=64)
         self.init_state()
 
         self.fields_changed.connect(self.update)
@@ -288,33 +918,110 @@ class Query(qc.QObject):
 
         self.current_page = 1
         self.page_count = 1
+        # Whether row_count (and page_count) are estimates, the exact count being computed in the background
+        self.row_count_is_approximate = False
 
-        self.data = []
+        # The current page (visible columns, then key columns), as an Arrow table
+        self.page: pa.Table = None
         self.header = []
 
+        # Set from the table header, by field name. They come on top of filter and order_by
+        self.column_filters: Dict[str, str] = {}
+        self.sort_order: List[Tuple[str, str]] = []
+        # Set from the facets, by column name of the main table: the values kept
+        self.facet_filters: Dict[str, list] = {}
+        # Set from the datalake search (see search_index), on top of the filter, with the text searched
+        self.search_filter = FilterExpression()
+        self.search_text = ""
+        # Set from the validation widget: the rows tagged, or decided in any validation (see decisions_filter)
+        self.decision_filter = FilterExpression()
+
+        # Fields always fetched (to record decisions for instance), but not shown
+        self.key_fields: List[Field] = []
+
         self.current_validation_name = None
 
+        self.invalidate_statements()
+
+    def invalidate_statements(self):
+        """Forgets the rendered SQL, must be called whenever the query structure (not the page) changes"""
+        self._select_templates = {}
+        self._count_template = None
+        self._scanned_main_table = None
+
     # Unused
     def add_field(self, field: Union[str, Field]):
         if isinstance(field, str):
             field = Field(field, None)
         self.fields.append(field)
+        self.invalidate_statements()
         self.fields_changed.emit()
 
         return self
 
-    # Unused
     def get_fields(self) -> List[Field]:
         return self.fields
 
     def set_fields(self, fields: List[Field]):
         self.fields = fields
+        self.invalidate_statements()
+        self.fields_changed.emit()
+
+        return self
+
+    def get_visible_fields(self) -> List[Field]:
+        return [f for f in self.fields if str(f) not in self.hidden_fields]
+
+    def is_field_hidden(self, name: str) -> bool:
+        return name in self.hidden_fields
+
+    def set_field_hidden(self, name: str, hidden: bool):
+        """Hides a field from the projection. Showing it again fetches it with the next update."""
+        if hidden == (name in self.hidden_fields):
+            return self
+        if hidden:
+            self.hidden_fields.add(name)
+        else:
+            self.hidden_fields.discard(name)
+        self.invalidate_statements()
+        self.fields_changed.emit()
+
+        return self
+
+    def set_hidden_fields(self, names: Iterable[str]):
+        self.hidden_fields = set(names)
+        self.invalidate_statements()
+        self.fields_changed.emit()
+
+        return self
+
+    def set_key_fields(self, fields: List[Field]):
+        """Sets the fields identifying a row, they are projected whether visible or not"""
+        self.key_fields = fields
+        self.invalidate_statements()
         self.fields_changed.emit()
 
         return self
 
+    def get_row_key(self, row: int) -> Dict:
+        """Returns the key fields values of a row of the current page, by field name"""
+        if self.page is None or row < 0 or row >= self.page.num_rows:
+            return {}
+        return {
+            name[len(KEY_PREFIX) :]: self.page.column(name)[row].as_py()
+            for name in self.page.column_names
+            if name.startswith(KEY_PREFIX)
+        }
+
+    def projected_fields(self) -> List[Field]:
+        """Fields actually selected: the visible ones, then the key fields under a prefixed alias"""
+        return self.get_visible_fields() + [
+            Field(f.name, f.table, alias=f"{KEY_PREFIX}{f}") for f in self.key_fields
+        ]
+
     def clear_fields(self):
         self.fields.clear()
+        self.invalidate_statements()
         return self
 
     # Unused
@@ -323,6 +1030,7 @@ class Query(qc.QObject):
 
     def set_filter(self, filter: FilterExpression):
         self.filter = filter
+        self.invalidate_statements()
         self.filters_changed.emit()
 
         return self
@@ -332,6 +1040,7 @@ class Query(qc.QObject):
             parent.add_child(new_filter)
         else:
             self.filter.add_child(new_filter)
+        self.invalidate_statements()
         self.filters_changed.emit()
 
         return self
@@ -341,10 +1050,115 @@ class Query(qc.QObject):
 
     def set_order_by(self, order_by: List[List[Union[Field, str]]]):
         self.order_by = order_by
+        self.invalidate_statements()
+        self.order_by_changed.emit()
+
+        return self
+
+    def get_column_filters(self) -> Dict[str, str]:
+        return self.column_filters
+
+    def set_column_filter(self, name: str, text: str):
+        """Filters the whole dataset on a column, text being parsed by parse_column_filter. Empty text removes the filter."""
+        if text:
+            self.column_filters[name] = text
+        elif name in self.column_filters:
+            del self.column_filters[name]
+        else:
+            return self
+        self.invalidate_statements()
+        self.filters_changed.emit()
+
+        return self
+
+    def get_facet_filters(self) -> Dict[str, list]:
+        return self.facet_filters
+
+    def set_facet_filter(self, name: str, values: list):
+        """Keeps the rows whose column (of the main table) has one of the values. No value removes the filter."""
+        if values:
+            self.facet_filters[name] = list(values)
+        elif name in self.facet_filters:
+            del self.facet_filters[name]
+        else:
+            return self
+        self.invalidate_statements()
+        self.filters_changed.emit()
+
+        return self
+
+    def get_search_filter(self) -> FilterExpression:
+        return self.search_filter
+
+    def get_search_text(self) -> str:
+        return self.search_text
+
+    def set_search_filter(self, filter: FilterExpression, text: str = ""):
+        self.search_filter = filter or FilterExpression()
+        self.search_text = text if filter else ""
+        self.invalidate_statements()
+        self.filters_changed.emit()
+
+        return self
+
+    def get_decision_filter(self) -> FilterExpression:
+        return self.decision_filter
+
+    def set_decision_filter(self, filter: FilterExpression):
+        """Unlike the query filter, kept when the validation goes to another step"""
+        self.decision_filter = filter or FilterExpression()
+        self.invalidate_statements()
+        self.filters_changed.emit()
+
+        return self
+
+    def get_sort_order(self) -> List[Tuple[str, str]]:
+        return self.sort_order
+
+    def set_sort_order(self, sort_order: List[Tuple[str, str]]):
+        """Sorts by field names (with ASC or DESC), before the order_by of the query"""
+        self.sort_order = sort_order
+        self.invalidate_statements()
         self.order_by_changed.emit()
 
         return self
 
+    def effective_filter(self, excluded_facet: str = None) -> FilterExpression:
+        """The query filter, ANDed with the column filters of the fields currently selected, the facet filters, the search filter
+        and the decision filter, normalized
+
+        Args:
+            excluded_facet (str, optional): a facet whose filter is left out, to count the values it could keep. Defaults to None.
+        """
+        fields = {str(f): f for f in self.fields if not f.is_expression}
+        column_filters = [
+            parse_column_filter(fields[name], text)
+            for name, text in self.column_filters.items()
+            if name in fields
+        ]
+        if self.main_table:
+            column_filters += [
+                FilterExpression(field=Field(name, self.main_table), operator="IN", value=values)
+                for name, values in self.facet_filters.items()
+                if name != excluded_facet
+            ]
+        root = FilterExpression(filter_type=FilterType.AND, children=column_filters)
+        if self.search_filter:
+            root.add_child(copy.copy(self.search_filter))
+        if self.decision_filter:
+            root.add_child(copy.copy(self.decision_filter))
+        if self.filter:
+            root.add_child(copy.copy(self.filter))
+        return root.normalize()
+
+    def effective_order_by(self) -> List[Tuple[Field, str]]:
+        fields = {str(f): f for f in self.fields if not f.is_expression}
+        return [
+            (fields[name], direction)
+            for name, direction in self.sort_order
+            if name in fields
+        ] + list(self.order_by)
+
     def get_limit(self) -> int:
         return self.limit
 
@@ -396,8 +1210,18 @@ class Query(qc.QObject):
     def get_page_count(self):
         return self.page_count
 
-    def get_data(self):
-        return self.data
+    def get_data(self) -> List[list]:
+        """The current page as rows. This copies the whole page into Python objects, prefer get_cell for display."""
+        if self.page is None:
+            return []
+        return [list(row.values()) for row in self.page.select(self.header).to_pylist()]
+
+    def get_loaded_row_count(self) -> int:
+        return self.page.num_rows if self.page is not None else 0
+
+    def get_cell(self, row: int, column: int):
+        """A value of the current page, read straight from the Arrow buffers (which may be memory-mapped)"""
+        return self.page.column(column)[row].as_py()
 
     def get_header(self):
         return self.header
@@ -413,11 +1237,14 @@ class Query(qc.QObject):
     def set_main_files(self, files: List[Path]):
         if not files:
             return self
-        self.main_table = Table(
-            f"read_parquet({duck_db_literal_string_list(files)})",
-            "main_table",
-            quoted=False,
-        )
+        self.main_table = parquet_table(files, "main_table")
+        self.invalidate_statements()
+        self.from_changed.emit()
+        return self
+
+    def set_main_table(self, table: Table):
+        self.main_table = table
+        self.invalidate_statements()
         self.from_changed.emit()
         return self
 
@@ -430,11 +1257,13 @@ class Query(qc.QObject):
 
     def add_join(self, join: Join):
         self.additional_tables[join.table.get_alias()] = join
+        self.invalidate_statements()
         self.from_changed.emit()
         return self
 
     def clear_additional_tables(self):
         self.additional_tables.clear()
+        self.invalidate_statements()
         self.from_changed.emit()
         return self
 
@@ -447,39 +1276,416 @@ class Query(qc.QObject):
         join_type: str = "JOIN",
     ):
         self.additional_tables[name] = Join(table, left_on, right_on, join_type)
+        self.invalidate_statements()
         self.from_changed.emit()
         return self
 
+    def scanned_main_table(self) -> Table:
+        """The main table, reading only the files that may have matching rows.
+
+        Files are skipped when they are in hive partitions the filter rules out (see prune_partitions),
+        or when their hash index (see hash_index) has none of the hashes looked up by the filter or by the inner joins on small database tables.
+        """
+        table = self.main_table
+        if not table or not table.files:
+            return table
+        # Joined tables are read to prune files: their writes must be seen
+        key = tuple(table_identity(join.table) for join in self.additional_tables.values())
+        if self._scanned_main_table is None or self._scanned_main_table[0] != key:
+            scanned = self.pruned_main_table(self.effective_filter())
+            if self._scanned_main_table is not None:
+                # The statements were rendered with the previous files
+                self._select_templates = {}
+                self._count_template = None
+            self._scanned_main_table = (key, scanned)
+        return self._scanned_main_table[1]
+
+    def pruned_main_table(self, filter: FilterExpression) -> Table:
+        """The main table, reading only the files that may have rows matching the filter (see scanned_main_table).
+        Not cached: for filters other than the effective one, e.g. the facets, which leave their own filter out."""
+        table = self.main_table
+        if not table or not table.files:
+            return table
+        files = expand_files(table.files)
+        pruned = files
+        if is_partitioned(files):
+            pruned = prune_partitions(pruned, filter, table.get_alias())
+        lookups = self.hash_lookups(filter)
+        if lookups:
+            pruned = files_containing(pruned, lookups)
+        if pruned == files:
+            return table
+        # read_parquet needs at least one file: no file left means an empty result anyway
+        return parquet_table(pruned or files[:1], table.get_alias())
+
+    def hash_lookups(self, filter: FilterExpression = None) -> Dict[str, set]:
+        """Hashes the main table rows must have (see hash_lookups), also taking the keys of the small database tables it is inner joined with
+
+        Args:
+            filter (FilterExpression, optional): the filter the rows must match. Defaults to the effective filter.
+        """
+        alias = self.main_table.get_alias()
+        lookups = hash_lookups(self.effective_filter() if filter is None else filter, alias)
+        for join in self.additional_tables.values():
+            if (
+                join.join_type.upper() not in ("JOIN", "INNER JOIN")
+                or join.left_on.name not in INDEXED_COLUMNS
+                or join.left_on.table is None
+                or join.left_on.table.get_alias() != alias
+                or join.table.source_files()
+                or not self.conn
+            ):
+                continue
+            try:
+                values = run_sql_arrow(
+                    f"SELECT DISTINCT {join.right_on:qj} AS v FROM {join.table:s} WHERE v IS NOT NULL LIMIT {SEMI_JOIN_MAX_KEYS + 1}",
+                    self.conn,
+                )
+            except db.Error as e:
+                print(e)
+                continue
+            if values is None or values.num_rows > SEMI_JOIN_MAX_KEYS:
+                continue
+            values = {v for v in values.column("v").to_pylist() if isinstance(v, int)}
+            name = join.left_on.name
+            lookups[name] = lookups[name] & values if name in lookups else values
+        return lookups
+
+    def get_select(
+        self, main_table: Table = None, limit=None, offset=None, with_total=False
+    ) -> Select:
+        fields = self.projected_fields()
+        if with_total:
+            # Computed over the whole result before the limit applies: the page and the count come from one scan
+            fields = fields + [
+                Field("COUNT(*) OVER ()", alias=TOTAL_COLUMN, is_expression=True)
+            ]
+        return Select(
+            fields=fields,
+            main_table=main_table or self.scanned_main_table(),
+            additional_tables=list(self.additional_tables.values()),
+            filters=self.effective_filter(),
+            order_by=self.effective_order_by(),
+            limit=self.limit if limit is None else limit,
+            offset=self.offset if offset is None else offset,
+        )
+
     def select_query(self):
         if not self.main_table:
             return ""
 
-        q = Select(
-            fields=self.fields,
-            main_table=self.main_table,
-            additional_tables=list(self.additional_tables.values()),
-            filters=self.filter,
-            order_by=self.order_by,
-            limit=self.limit,
-            offset=self.offset,
-        )
-        return str(q)
+        return str(self.get_select())
 
-    def count_query(self):
+    def select_statement(self, with_total=False) -> Tuple[str, list]:
+        """Same as select_query, but with the page as bound parameters.
+
+        The SQL text is rendered once per query structure, changing page only changes the parameters.
+
+        Args:
+            with_total (bool, optional): also return the row count of the whole result, in every row (TOTAL_COLUMN). Defaults to False.
+        """
+        if not self.main_table:
+            return "", []
+
+        # Drops the templates if the files to read changed
+        self.scanned_main_table()
+        if with_total not in self._select_templates:
+            sql, params = self.get_select(with_total=with_total).statement()
+            # The last two parameters are the page, the others are filter values
+            self._select_templates[with_total] = (sql, params[:-2])
+        sql, filter_params = self._select_templates[with_total]
+        return sql, filter_params + [self.limit, self.offset]
+
+    def get_count_select(self, main_table: Table = None) -> Select:
         field = Field("COUNT(*)", alias="count_star", is_expression=True)
 
-        q = Select(
+        return Select(
             fields=[field],
-            main_table=self.main_table,
+            main_table=main_table or self.scanned_main_table(),
             additional_tables=list(self.additional_tables.values()),
-            filters=self.filter,
+            filters=self.effective_filter(),
+        )
+
+    def count_query(self):
+        return str(self.get_count_select())
+
+    def count_statement(self) -> Tuple[str, list]:
+        self.scanned_main_table()
+        if self._count_template is None:
+            self._count_template = self.get_count_select().statement()
+        return self._count_template
+
+    def projected_names(self) -> List[str]:
+        """Names of the columns the page select returns"""
+        return [f.alias or f.name for f in self.projected_fields()]
+
+    def fetch_page(self) -> pa.Table:
+        """Runs the page select, unless an equivalent query was already run on the same files (see Select.fingerprint)"""
+        select = self.get_select()
+        key = select.fingerprint()
+        persistent = select.is_file_backed()
+        table = query_cache.get("pages", key, persistent)
+        if table is None:
+            count_select = self.get_count_select()
+            count_key = count_select.fingerprint(paged=False)
+            if (
+                self.single_pass
+                and self.fan_out_files() is None
+                and not self.counts_in_background()
+                and query_cache.get("counts", count_key, persistent) is None
+            ):
+                sql, params = self.select_statement(with_total=True)
+                table = run_sql_arrow(sql, self.conn, tuple(params))
+                if table is not None:
+                    # An empty page (past the last row) says nothing about the count
+                    if table.num_rows:
+                        query_cache.put(
+                            "counts",
+                            count_key,
+                            table.column(TOTAL_COLUMN)[0].as_py(),
+                            persistent,
+                            files=select_files(count_select),
+                        )
+                    table = table.drop_columns([TOTAL_COLUMN])
+            else:
+                table = self.run_page()
+            # Spill before caching, so that the cache doesn't hold large pages in memory either
+            table = spill_if_large(table, self.spill_threshold)
+            query_cache.put(
+                "pages", key, table, persistent, files=select_files(select)
+            )
+        if table is None:
+            return None
+
+        # Cached tables may come from the same query with its fields in another order
+        names = self.projected_names()
+        if len(set(names)) == len(names) and set(names) == set(table.column_names):
+            table = table.select(names)
+        return table
+
+    def main_table_columns(self) -> List[str]:
+        """Names of the columns of the main table"""
+        table = self.main_table
+        if not self.conn or not table:
+            return []
+        key = table_identity(table)
+        if key not in self._main_table_columns:
+            try:
+                res = run_sql_arrow(f"DESCRIBE SELECT * FROM {table:s}", self.conn)
+            except db.Error as e:
+                print(e)
+                return []
+            self._main_table_columns[key] = res.column("column_name").to_pylist()
+        return self._main_table_columns[key]
+
+    def readable_from_cursor(self) -> bool:
+        """Whether the query can run on another cursor of the connection, from a background thread:
+        the main table must read files, and every other table be a file or a table (temp tables are not visible there)"""
+        table = self.scanned_main_table()
+        if not self.conn or not table or not table.files:
+            return False
+        cursor = self.conn.cursor()
+        return all(
+            join.table.source_files() or table_exists(cursor, join.table.name)
+            for join in self.additional_tables.values()
+        )
+
+    def counts_in_background(self) -> bool:
+        """Whether counts are first estimated, then computed in the background: the main table files must be large,
+        and the query readable from another cursor"""
+        table = self.scanned_main_table()
+        if not self.conn or not table or not table.files or self.fan_out_files():
+            return False
+        try:
+            if parquet_row_count(expand_files(table.files)) <= APPROXIMATE_COUNT_ABOVE:
+                return False
+        except (OSError, pa.ArrowInvalid):
+            return False
+        return self.readable_from_cursor()
+
+    def estimate_count(self) -> Tuple[int, bool]:
+        """Estimates the row count, from the parquet metadata and the selectivity of the query on random row groups.
+
+        Returns:
+            Tuple[int, bool]: the estimate, and whether it is exact (no filter and no join: the metadata is enough)
+        """
+        table = self.scanned_main_table()
+        files = expand_files(table.files)
+        total = parquet_row_count(files)
+        if not self.effective_filter() and not self.additional_tables:
+            return total, True
+        # Only the columns the count refers to are read (a superset: any quoted or bare identifier of its SQL)
+        sql, _ = self.get_count_select().statement()
+        names = set(re.findall(r"\w+", sql)) | {n.replace('""', '"') for n in re.findall(r'"((?:[^"]|"")*)"', sql)}
+        sample = sample_row_groups(files, names.__contains__, COUNT_SAMPLE_ROWS)
+        if sample is None or not sample.num_rows:
+            return total, False
+        self.conn.register(COUNT_SAMPLE_TABLE, sample)
+        try:
+            sql, params = self.get_count_select(
+                Table(COUNT_SAMPLE_TABLE, table.get_alias())
+            ).statement()
+            matching = run_sql(sql, self.conn, tuple(params), "count")[0]["count_star"]
+        finally:
+            self.conn.unregister(COUNT_SAMPLE_TABLE)
+        return round(matching * total / sample.num_rows), False
+
+    def count_in_background(self, select: Select, key: str, persistent: bool):
+        if key in self.background_counts:
+            return
+        self.background_counts[key] = (persistent, select_files(select))
+        sql, params = select.statement()
+        # A connection can't be shared between threads
+        cursor = self.conn.cursor()
+        notifier = self.count_notifier
+
+        def run():
+            try:
+                count = run_sql(sql, cursor, tuple(params), "count")[0]["count_star"]
+            except db.Error as e:
+                print(e)
+                count = None
+            notifier.count_ready.emit(key, count)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def on_count_ready(self, key: str, count: int):
+        persistent, files = self.background_counts.pop(key, (False, []))
+        if count is None:
+            return
+        query_cache.put("counts", key, count, persistent, files=files)
+        # The query may have changed meanwhile
+        if (
+            not self.row_count_is_approximate
+            or not self.main_table
+            or self.get_count_select().fingerprint(paged=False) != key
+        ):
+            return
+        self.row_count_is_approximate = False
+        self.set_row_count(count)
+        self.query_changed.emit()
+
+    def set_row_count(self, count: int):
+        self.row_count = count
+        self.page_count = max(1, -(-count // self.limit))
+
+    def fetch_count(self) -> int:
+        select = self.get_count_select()
+        key = select.fingerprint(paged=False)
+        persistent = select.is_file_backed()
+        count = query_cache.get("counts", key, persistent)
+        self.row_count_is_approximate = False
+        if count is None and self.counts_in_background():
+            count, exact = self.estimate_count()
+            if not exact:
+                # Shown right away, refined once the exact count is known
+                self.row_count_is_approximate = True
+                self.count_in_background(select, key, persistent)
+                return count
+            query_cache.put("counts", key, count, persistent, files=select_files(select))
+        if count is None:
+            count = self.run_count()
+            query_cache.put(
+                "counts", key, count, persistent, files=select_files(select)
+            )
+        return count
+
+    def set_datalake_settings(self, settings: dict):
+        """Applies the settings of a datalake (see commons.get_datalake_settings) the query uses"""
+        self.fan_out = bool(settings.get("fan_out"))
+        self.fan_out_workers = int(settings["threads"]) if settings.get("threads") else None
+        query_monitor.set_timeouts(settings.get("query_timeouts") or {})
+        return self
+
+    def fan_out_files(self) -> List[str]:
+        """The files to query one by one in fan out mode, or None if the select should run as a whole"""
+        if not self.fan_out or not self.conn:
+            return None
+        table = self.scanned_main_table()
+        if not table or not table.files:
+            return None
+        files = expand_files(table.files)
+        if len(files) <= 1:
+            return None
+        # Each file runs on its own cursor, which can't see the temp tables joined (step results for instance)
+        return files if self.readable_from_cursor() else None
+
+    def order_columns(self) -> List[Tuple[str, str]]:
+        """The page columns (and directions) the rows are sorted by, or None if one of the sort fields is not in the page"""
+        names = {field_key(f): f.alias or f.name for f in self.projected_fields()}
+        columns = []
+        for field, direction in self.effective_order_by():
+            if field_key(field) not in names:
+                return None
+            columns.append((names[field_key(field)], direction))
+        return columns
+
+    def run_fanned_out(self, selects: List[Select]) -> List[pa.Table]:
+        """Runs the selects in parallel, each on its own cursor (a DuckDB connection can't be shared between threads)"""
+
+        def run(select: Select) -> pa.Table:
+            sql, params = select.statement()
+            return run_sql_arrow(sql, self.conn.cursor(), tuple(params))
+
+        with ThreadPoolExecutor(max_workers=self.fan_out_workers or os.cpu_count()) as pool:
+            return list(pool.map(run, selects))
+
+    def run_page(self) -> pa.Table:
+        """Runs the page select. In fan out mode, each file returns its own first rows, which are then sorted and paged together."""
+        files = self.fan_out_files()
+        names = self.projected_names()
+        order = self.order_columns()
+        if files is None or order is None or len(set(names)) != len(names):
+            sql, params = self.select_statement()
+            return run_sql_arrow(sql, self.conn, tuple(params))
+
+        alias = self.main_table.get_alias()
+        parts = self.run_fanned_out(
+            [
+                self.get_select(parquet_table([f], alias), self.offset + self.limit, 0)
+                for f in files
+            ]
+        )
+        merged = pa.concat_tables(
+            [t for t in parts if t is not None], promote_options="default"
+        )
+        if not order:
+            return merged.slice(self.offset, self.limit)
+        order_by = ", ".join(
+            '"{}" {}'.format(name.replace('"', '""'), direction) for name, direction in order
+        )
+        cursor = self.conn.cursor()
+        cursor.register("fan_out_page", merged)
+        return cursor.execute(
+            f"SELECT * FROM fan_out_page ORDER BY {order_by} LIMIT ? OFFSET ?",
+            [self.limit, self.offset],
+        ).arrow()
+
+    def run_count(self) -> int:
+        """Runs the count select (in fan out mode, the sum of the counts of each file)"""
+        files = self.fan_out_files()
+        if files is None:
+            sql, params = self.count_statement()
+            return run_sql(sql, self.conn, tuple(params), "count")[0]["count_star"]
+        alias = self.main_table.get_alias()
+        parts = self.run_fanned_out(
+            [self.get_count_select(parquet_table([f], alias)) for f in files]
+        )
+        return sum(t.column("count_star")[0].as_py() for t in parts if t is not None)
+
+    def depends_on(self, paths: List[str]) -> bool:
+        """Whether the current query reads one of the given files"""
+        if not self.main_table:
+            return False
+        # The main table files may be glob patterns, matching files the current select doesn't read yet
+        return files_match(
+            paths, select_files(self.get_select()) + self.main_table.source_files()
         )
-        return str(q)
 
     def is_valid(self):
         return (
             bool(self.main_table)
-            and bool(self.fields)
+            and bool(self.get_visible_fields())
             and self.datalake_path
             and self.conn
         )
@@ -491,15 +1697,21 @@ class Query(qc.QObject):
             return "Please select a main table"
         if not self.fields:
             return "Please select some fields"
+        if not self.get_visible_fields():
+            return "Please show at least one field"
         if not self.conn:
             return "Please connect to the database"
 
     def update(self):
+        if query_monitor.defer(self.update):
+            return
         self.blockSignals(True)
         self.header = []
-        self.data = []
+        self.page = None
+        release_spill_files()
         self.row_count = 0
         self.page_count = 1
+        self.row_count_is_approximate = False
         # Query is not valid, do nothing. Previous lines are for cleanup
         if not self.is_valid():
             self.blockSignals(False)
@@ -508,35 +1720,41 @@ class Query(qc.QObject):
             return
         # Running the query might throw an exception, we catch it and print it
         try:
-            dict_data = run_sql(self.select_query(), self.conn)
+            page = self.fetch_page()
         except db.Error as e:
             print(e)
             print(self.select_query())
             self.blockSignals(False)
             self.query_changed.emit()
-            # Return early, dict_data is not set
+            # Return early, page is not set
             return
 
         # We have data, let's save it
-        if dict_data:
-            self.header = list(dict_data[0].keys())
-            self.data = [list(row.values()) for row in dict_data]
+        if page is not None and page.num_rows:
+            # Key columns come last, after the visible ones
+            self.header = [k for k in page.column_names if not k.startswith(KEY_PREFIX)]
+            self.page = page
         # There is no data, we can return early (after resetting the page count and row count)
         else:
+            # Keep the header, so the user still sees (and can clear) the column filters
+            self.header = [str(f) for f in self.get_visible_fields()]
             self.row_count = 0
             self.page_count = 1
             self.set_page(1)
             self.blockSignals(False)
             self.query_changed.emit()
             return
-        self.row_count = run_sql(self.count_query(), self.conn)[0]["count_star"]
+        try:
+            self.set_row_count(self.fetch_count())
+        except db.Error as e:
+            print(e)
+            # Count stopped (see query_monitor): only the rows up to this page are known
+            self.set_row_count(self.offset + page.num_rows)
         print(self.row_count)
         # print caller function (using python reflection)
         print(sys._getframe().f_back.f_code.co_name)
-        self.page_count = self.row_count // self.limit
-        if self.row_count % self.limit > 0:
-            self.page_count = self.page_count + 1
-        if self.current_page > self.page_count:
+        # An estimate may be too low: wait for the exact count before moving back
+        if not self.row_count_is_approximate and self.current_page > self.page_count:
             self.set_page(self.page_count)
             self.update()  # TODO: Fix edge case
         self.blockSignals(False)
@@ -544,6 +1762,7 @@ class Query(qc.QObject):
 
     def set_additional_tables(self, tables: dict):
         self.additional_tables = tables
+        self.invalidate_statements()
         self.from_changed.emit()
         return self
 
@@ -552,43 +1771,116 @@ class Query(qc.QObject):
             return self
         os.chdir(path)
         self.datalake_path = path
+        self.set_datalake_settings(get_datalake_settings(path))
+        self.datalake_changed.emit()
         self.query_changed.emit()
         return self
 
-    def save(self, filename: Path):
-        with open(filename, "wb") as f:
-            pickle.dump(
+    def to_json(self) -> dict:
+        """The query state as plain JSON types. Tables are stored once, and referred to by alias."""
+        tables = {}
+
+        def table_json(table: Table):
+            if table is None:
+                return None
+            # Fields only render the alias of their table, so the first table registered under an alias is enough
+            tables.setdefault(
+                table.get_alias(),
                 {
-                    "fields": self.fields,
-                    "main_table": self.main_table,
-                    "additional_tables": self.additional_tables,
-                    "filter": self.filter,
-                    "order_by": self.order_by,
-                    "limit": self.limit,
-                    "offset": self.offset,
-                    "datalake_path": self.datalake_path,
-                    "current_validation_name": self.current_validation_name,
+                    "name": table.name,
+                    "alias": table.alias,
+                    "quoted": table.quoted,
+                    "files": [str(f) for f in table.files] if table.files else None,
                 },
-                f,
             )
+            return table.get_alias()
 
-    @staticmethod
-    def load(filename: Path) -> "Query":
-        with open(filename, "rb") as f:
-            self_dic = pickle.load(f)
-            q = Query()
-            q.mute()
-            # q.set_fields(self_dic["fields"])
-            # q.main_table = self_dic["main_table"]
-            # q.set_additional_tables(self_dic["additional_tables"])
-            # q.set_filter(self_dic["filter"])
-            # q.set_order_by(self_dic["order_by"])
-            # q.set_limit(self_dic["limit"])
-            # q.set_offset(self_dic["offset"])
-            q.set_datalake_path(self_dic["datalake_path"])
-            # q.set_table_validation_name(self_dic["current_validation_name"])
-            q.unmute()
-            return q
+        def field_json(field: Field):
+            return {
+                "name": field.name,
+                "table": table_json(field.table),
+                "alias": field.alias,
+                "is_expression": field.is_expression,
+            }
+
+        return {
+            "datalake_path": self.datalake_path,
+            "main_table": table_json(self.main_table),
+            "joins": {
+                name: {
+                    "table": table_json(join.table),
+                    "left_on": field_json(join.left_on),
+                    "right_on": field_json(join.right_on),
+                    "join_type": join.join_type,
+                }
+                for name, join in self.additional_tables.items()
+            },
+            "fields": [field_json(f) for f in self.fields],
+            "key_fields": [field_json(f) for f in self.key_fields],
+            "filter": self.filter.to_json(),
+            "order_by": [[field_json(f), d] for f, d in self.order_by],
+            "sort_order": [list(s) for s in self.sort_order],
+            "column_filters": self.column_filters,
+            "facet_filters": self.facet_filters,
+            "search_filter": self.search_filter.to_json(),
+            "search_text": self.search_text,
+            "decision_filter": self.decision_filter.to_json(),
+            "hidden_fields": sorted(self.hidden_fields),
+            "limit": self.limit,
+            "current_page": self.current_page,
+            "page_count": self.page_count,
+            "current_validation_name": self.current_validation_name,
+            "tables": tables,
+        }
+
+    def restore(self, state: dict):
+        """Restores a state saved by to_json, without running anything (the caller mutes and updates the query)"""
+        tables = {
+            alias: Table(t["name"], t["alias"], quoted=t["quoted"], files=t["files"])
+            for alias, t in state["tables"].items()
+        }
+
+        def field_from_json(f: dict) -> Field:
+            return Field(
+                f["name"],
+                tables.get(f["table"]),
+                alias=f["alias"],
+                is_expression=f["is_expression"],
+            )
+
+        if state["datalake_path"]:
+            self.set_datalake_path(state["datalake_path"])
+        self.init_state()
+        self.main_table = tables.get(state["main_table"])
+        self.additional_tables = {
+            name: Join(
+                tables[j["table"]],
+                field_from_json(j["left_on"]),
+                field_from_json(j["right_on"]),
+                j["join_type"],
+            )
+            for name, j in state["joins"].items()
+        }
+        self.fields = [field_from_json(f) for f in state["fields"]]
+        self.key_fields = [field_from_json(f) for f in state["key_fields"]]
+        self.filter = FilterExpression.from_json(state["filter"], tables)
+        self.order_by = [(field_from_json(f), d) for f, d in state["order_by"]]
+        self.sort_order = [tuple(s) for s in state["sort_order"]]
+        self.column_filters = dict(state["column_filters"])
+        self.facet_filters = dict(state.get("facet_filters", {}))
+        if state.get("search_filter"):
+            self.search_filter = FilterExpression.from_json(state["search_filter"], tables)
+            self.search_text = state.get("search_text", "")
+        if state.get("decision_filter"):
+            self.decision_filter = FilterExpression.from_json(state["decision_filter"], tables)
+        self.hidden_fields = set(state["hidden_fields"])
+        self.limit = state["limit"]
+        self.current_page = state["current_page"]
+        self.page_count = state["page_count"]
+        self.offset = (self.current_page - 1) * self.limit
+        self.current_validation_name = state["current_validation_name"]
+        self.invalidate_statements()
+        return self
 
 
 if __name__ == "__main__":
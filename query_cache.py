@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+from typing import Any, Dict, Iterable, Set, Tuple
+
+from cachetools import LRUCache
+
+from commons import files_match
+from disk_cache import DiskCache
+
+
+class QueryCache:
+    """Caches of query results, one in-memory LRU per layer (pages, counts...), all keyed by query fingerprint.
+
+    When a disk cache is set, persistent entries also go to disk, and memory misses fall back to it.
+    Entries may be registered with the files they were computed from, to be dropped when those files change.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.layers: Dict[str, LRUCache] = {}
+        self.disk: DiskCache = None
+        # Entries (layer, key) computed from each file (or glob pattern)
+        self.file_keys: Dict[str, Set[Tuple[str, str]]] = {}
+        # Keys of the persistent entries of each layer: their fingerprints stay valid in another process
+        self.persistent_keys: Dict[str, Set[str]] = {}
+
+    def set_disk_cache(self, disk: DiskCache):
+        self.disk = disk
+
+    def layer(self, name: str) -> LRUCache:
+        if name not in self.layers:
+            self.layers[name] = LRUCache(maxsize=self.maxsize)
+        return self.layers[name]
+
+    def get(self, layer: str, key: str, persistent=False) -> Any:
+        value = self.layer(layer).get(key)
+        if value is None and persistent and self.disk:
+            value = self.disk.get(layer, key)
+            if value is not None:
+                self.layer(layer)[key] = value
+                self.persistent_keys.setdefault(layer, set()).add(key)
+        return value
+
+    def persistent_items(self, layer: str) -> Dict[str, Any]:
+        """The persistent entries of a layer still in memory"""
+        cache = self.layer(layer)
+        keys = self.persistent_keys.get(layer, set())
+        # Entries evicted from the LRU are forgotten here too
+        keys &= set(cache.keys())
+        return {key: cache[key] for key in keys}
+
+    def put(
+        self,
+        layer: str,
+        key: str,
+        value: Any,
+        persistent=False,
+        files: Iterable[str] = (),
+    ):
+        self.layer(layer)[key] = value
+        if persistent:
+            self.persistent_keys.setdefault(layer, set()).add(key)
+            if self.disk:
+                self.disk.put(layer, key, value)
+        else:
+            self.persistent_keys.get(layer, set()).discard(key)
+        for f in files:
+            self.file_keys.setdefault(os.path.abspath(f), set()).add((layer, key))
+
+    def invalidate_files(self, paths: Iterable[str]):
+        """Drops the entries computed from any of the given files, in memory and on disk"""
+        paths = list(paths)
+        for pattern in list(self.file_keys):
+            if not files_match(paths, [pattern]):
+                continue
+            for layer, key in self.file_keys.pop(pattern):
+                self.layer(layer).pop(key, None)
+                self.persistent_keys.get(layer, set()).discard(key)
+                if self.disk:
+                    self.disk.remove(layer, key)
+
+    def clear(self, layer: str = None):
+        if layer is None:
+            self.layers.clear()
+            self.file_keys.clear()
+            self.persistent_keys.clear()
+        elif layer in self.layers:
+            self.layers[layer].clear()
+            self.persistent_keys.pop(layer, None)
+
+
+query_cache = QueryCache()
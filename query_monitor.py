@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from typing import Callable, Dict, List
+
+import duckdb as db
+import PySide6.QtCore as qc
+import PySide6.QtWidgets as qw
+
+# Time budget (in seconds) of each class of query, 0 for none: long statements over large datalakes are legitimate,
+# budgets are opted in by the query_timeouts preference, or per datalake in its settings
+DEFAULT_TIMEOUTS = {"page": 0, "count": 0, "stats": 0, "export": 0}
+
+# Runs shorter than this (ms) don't show any progress, to avoid flickering
+SHOW_PROGRESS_AFTER = 300
+
+# Input events swallowed while a query runs
+USER_INPUT_EVENTS = (
+    qc.QEvent.Type.MouseButtonPress,
+    qc.QEvent.Type.MouseButtonRelease,
+    qc.QEvent.Type.MouseButtonDblClick,
+    qc.QEvent.Type.KeyPress,
+    qc.QEvent.Type.KeyRelease,
+    qc.QEvent.Type.Wheel,
+    qc.QEvent.Type.ShortcutOverride,
+)
+
+
+class QueryMonitor(qc.QObject):
+    """Runs the statements issued from the main thread in a worker thread, so that the UI can show their progress and stop them.
+
+    Each statement belongs to a class (page, count, stats, export) with its own time budget: past it, the connection is interrupted.
+    While a statement runs, user input only reaches the widgets allowed (the cancel button). Other events are processed:
+    the code they trigger must not use the connection meanwhile, see defer.
+    Statements issued from other threads (background counts, fan out) run as is.
+
+    DuckDB only reports the progress of a statement from 1.0 (query_progress): before, progress is always -1,
+    and only tells that the statement still runs.
+    """
+
+    # Query class
+    started = qc.Signal(str)
+    # Percentage, or -1 when DuckDB can't tell (always, before DuckDB 1.0)
+    progress = qc.Signal(float)
+    finished = qc.Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # From the preferences, and those of the datalake on top (see set_timeouts)
+        self.default_timeouts: Dict[str, float] = dict(DEFAULT_TIMEOUTS)
+        self.timeouts: Dict[str, float] = dict(DEFAULT_TIMEOUTS)
+        self.allowed_widgets: List[qw.QWidget] = []
+        self.conn: db.DuckDBPyConnection = None
+        self.worker: threading.Thread = None
+        self.cancelled = False
+        # Calls deferred until the statement running is done
+        self.deferred: List[Callable] = []
+
+    def set_timeouts(self, timeouts: Dict[str, float]):
+        """Budgets of the datalake opened, by query class. Classes it leaves out keep the default budget."""
+        self.timeouts = {**self.default_timeouts, **timeouts}
+
+    def allow_input(self, widget: qw.QWidget):
+        self.allowed_widgets.append(widget)
+
+    def eventFilter(self, obj: qc.QObject, event: qc.QEvent) -> bool:
+        # Input reaches the window before the widget under the cursor: only filter it at the widget level
+        if event.type() not in USER_INPUT_EVENTS or not obj.isWidgetType():
+            return False
+        while obj is not None:
+            if obj in self.allowed_widgets:
+                return False
+            obj = obj.parent()
+        return True
+
+    def defer(self, fn: Callable, *args) -> bool:
+        """For the slots using the connection directly (not through run): called from an event processed while a statement runs,
+        fn(*args) is queued to run once it is done, and True returned (the slot should then return). Otherwise returns False."""
+        if self.worker is None or threading.current_thread() is not threading.main_thread():
+            return False
+        self.deferred.append(lambda: fn(*args))
+        return True
+
+    def wait(self):
+        """Waits for the statement running, if any, before using the connection directly from the main thread"""
+        if self.worker is not None and threading.current_thread() is threading.main_thread():
+            self.worker.join()
+
+    def run_deferred(self):
+        deferred, self.deferred = self.deferred, []
+        for fn in deferred:
+            fn()
+
+    def cancel(self):
+        """Interrupts the statement running, if any"""
+        if self.conn is not None:
+            self.cancelled = True
+            self.conn.interrupt()
+
+    def query_progress(self, conn: db.DuckDBPyConnection) -> float:
+        # Not available before DuckDB 1.0
+        query_progress = getattr(conn, "query_progress", None)
+        if query_progress is None:
+            return -1
+        try:
+            return query_progress()
+        except db.Error:
+            return -1
+
+    def run(self, conn: db.DuckDBPyConnection, fn: Callable, query_class="page"):
+        """Runs fn (which executes a statement on conn) and returns its result, raising db.InterruptException
+        if it was cancelled or ran out of time"""
+        app = qc.QCoreApplication.instance()
+        if app is None or threading.current_thread() is not threading.main_thread():
+            return fn()
+        if self.worker is not None:
+            # Issued from an event processed while waiting for another statement (e.g. a timer): run it once that one is done
+            self.worker.join()
+            return fn()
+
+        outcome = {}
+
+        def work():
+            try:
+                outcome["result"] = fn()
+            except Exception as e:
+                outcome["error"] = e
+
+        self.conn = conn
+        self.cancelled = False
+        timeout = self.timeouts.get(query_class) or 0
+        worker = self.worker = threading.Thread(target=work, daemon=True)
+        start = time.monotonic()
+        shown = False
+        interrupted_after = None
+        app.installEventFilter(self)
+        try:
+            worker.start()
+            while worker.is_alive():
+                worker.join(0.02)
+                elapsed = time.monotonic() - start
+                if not shown and elapsed * 1000 >= SHOW_PROGRESS_AFTER:
+                    shown = True
+                    self.started.emit(query_class)
+                if shown:
+                    self.progress.emit(self.query_progress(conn))
+                if timeout and interrupted_after is None and elapsed > timeout:
+                    interrupted_after = timeout
+                    conn.interrupt()
+                app.processEvents(qc.QEventLoop.ProcessEventsFlag.AllEvents, 20)
+        finally:
+            app.removeEventFilter(self)
+            self.conn = None
+            self.worker = None
+            if shown:
+                self.finished.emit()
+            if self.deferred:
+                qc.QTimer.singleShot(0, self.run_deferred)
+
+        if "error" in outcome:
+            error = outcome["error"]
+            if isinstance(error, db.InterruptException):
+                if interrupted_after is not None:
+                    raise db.InterruptException(
+                        f"{query_class.capitalize()} query stopped after {interrupted_after}s"
+                    ) from error
+                if self.cancelled:
+                    raise db.InterruptException(
+                        f"{query_class.capitalize()} query cancelled"
+                    ) from error
+            raise error
+        return outcome.get("result")
+
+
+query_monitor = QueryMonitor()
@@ -17,22 +17,20 @@ class QueryTableModel(qc.QAbstractTableModel):
     def rowCount(self, parent):
         if parent.isValid():
             return 0
-        return len(self.query.get_data())
+        return self.query.get_loaded_row_count()
 
     def columnCount(self, parent):
         if parent.isValid():
             return 0
-        if self.query.get_data():
-            return len(self.query.get_data()[0])
-        return 0
+        return len(self.query.get_header())
 
     def data(self, index, role):
         if role == qc.Qt.ItemDataRole.DisplayRole:
-            if index.row() < 0 or index.row() >= len(self.query.get_data()):
+            if index.row() < 0 or index.row() >= self.query.get_loaded_row_count():
                 return None
-            if index.column() < 0 or index.column() >= len(self.query.get_data()[0]):
+            if index.column() < 0 or index.column() >= len(self.query.get_header()):
                 return None
-            return self.query.get_data()[index.row()][index.column()]
+            return self.query.get_cell(index.row(), index.column())
 
     def headerData(self, section, orientation, role):
         if section >= len(self.query.get_header()):
@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 
 
+import PySide6.QtCore as qc
 import PySide6.QtWidgets as qw
 
+from common_widgets.header_filter_bar import HeaderFilterBar
 from common_widgets.page_selector import PageSelector
 from query import Query
+from query_monitor import query_monitor
 from query_table_model import QueryTableModel
+from search_widget import SearchWidget
 
 
 class QueryTableWidget(qw.QWidget):
 
+    # Values of the row selected by column name, with its key fields (see get_row). None when no row is selected.
+    row_selected = qc.Signal(object)
+
     def __init__(self, query: Query, parent=None):
         super().__init__(parent)
 
@@ -27,11 +34,174 @@ class QueryTableWidget(qw.QWidget):
             True
         )  # Set last column to expand
         self.table_view.setModel(self.model)
+        self.table_view.selectionModel().selectionChanged.connect(self.on_selection_changed)
+        # A new page clears the selection
+        self.model.modelReset.connect(self.on_selection_changed)
+
+        # Hidden columns are not fetched at all, so hiding is done on the query, not on the view
+        self.table_view.horizontalHeader().setContextMenuPolicy(
+            qc.Qt.ContextMenuPolicy.CustomContextMenu
+        )
+        self.table_view.horizontalHeader().customContextMenuRequested.connect(
+            self.show_header_menu
+        )
+
+        # Sorting and filtering are pushed to the query, so they apply to the whole dataset, not just the page
+        header = self.table_view.horizontalHeader()
+        header.setSectionsClickable(True)
+        header.setSortIndicatorShown(True)
+        header.setSortIndicator(-1, qc.Qt.SortOrder.AscendingOrder)
+        header.sectionClicked.connect(self.on_header_clicked)
+
+        self.filter_bar = HeaderFilterBar(header, self)
+        self.filter_bar.filter_changed.connect(self.on_column_filter_changed)
+        self.table_view.horizontalScrollBar().valueChanged.connect(
+            self.filter_bar.update_geometries
+        )
+        self.filter_header = []
+        # Widths to apply once the columns they were saved for are shown, by column name
+        self.pending_column_widths = {}
+
+        self.query.query_changed.connect(self.on_query_changed)
 
         self.page_selector = PageSelector(query)
 
+        # Shown while a query runs (see query_monitor)
+        self.progress_bar = qw.QProgressBar()
+        self.cancel_button = qw.QPushButton("Cancel")
+        self.cancel_button.clicked.connect(query_monitor.cancel)
+        query_monitor.allow_input(self.cancel_button)
+        self.progress_widget = qw.QWidget()
+        progress_layout = qw.QHBoxLayout(self.progress_widget)
+        progress_layout.setContentsMargins(0, 0, 0, 0)
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.cancel_button)
+        self.progress_widget.hide()
+        query_monitor.started.connect(self.on_query_started)
+        query_monitor.progress.connect(self.on_query_progress)
+        query_monitor.finished.connect(self.progress_widget.hide)
+
+        self.search_widget = SearchWidget(query)
+
         layout = qw.QVBoxLayout()
+        layout.addWidget(self.search_widget)
+        layout.addWidget(self.filter_bar)
         layout.addWidget(self.table_view)
+        layout.addWidget(self.progress_widget)
         layout.addWidget(self.page_selector)
 
         self.setLayout(layout)
+
+    def show_header_menu(self, pos: qc.QPoint):
+        menu = qw.QMenu(self)
+        visible_count = len(self.query.get_visible_fields())
+        for field in self.query.get_fields():
+            name = str(field)
+            action = menu.addAction(name)
+            action.setCheckable(True)
+            action.setChecked(not self.query.is_field_hidden(name))
+            # Don't let the user hide the last visible column
+            if visible_count == 1 and action.isChecked():
+                action.setEnabled(False)
+            action.toggled.connect(
+                lambda checked, name=name: self.query.set_field_hidden(
+                    name, not checked
+                )
+            )
+        menu.exec(self.table_view.horizontalHeader().mapToGlobal(pos))
+
+    def on_header_clicked(self, section: int):
+        header = self.query.get_header()
+        if section >= len(header):
+            return
+        name = header[section]
+        # Cycle through ascending, descending, and back to the query's own order
+        current = dict(self.query.get_sort_order()).get(name)
+        if current is None:
+            self.query.set_sort_order([(name, "ASC")])
+        elif current == "ASC":
+            self.query.set_sort_order([(name, "DESC")])
+        else:
+            self.query.set_sort_order([])
+
+    def on_column_filter_changed(self, section: int, text: str):
+        header = self.query.get_header()
+        if section >= len(header):
+            return
+        if self.query.get_column_filters().get(header[section], "") == text:
+            return
+        self.query.set_column_filter(header[section], text)
+
+    def get_row(self, row: int) -> dict:
+        """Values of a row of the page by column name, and of its key fields (fetched even when hidden)"""
+        values = {
+            name: self.query.get_cell(row, column)
+            for column, name in enumerate(self.query.get_header())
+        }
+        values.update(self.query.get_row_key(row))
+        return values
+
+    def on_selection_changed(self):
+        rows = self.table_view.selectionModel().selectedRows()
+        self.row_selected.emit(self.get_row(rows[0].row()) if rows else None)
+
+    def on_query_started(self, query_class: str):
+        self.progress_bar.setFormat(f"Running {query_class} query... %p%")
+        # Busy indicator until DuckDB reports progress (which it never does before 1.0, see query_monitor)
+        self.progress_bar.setRange(0, 0)
+        self.progress_widget.show()
+
+    def on_query_progress(self, percentage: float):
+        if percentage < 0:
+            return
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(int(percentage))
+
+    def on_query_changed(self):
+        header = self.query.get_header()
+
+        sort_order = dict(self.query.get_sort_order())
+        view_header = self.table_view.horizontalHeader()
+        view_header.blockSignals(True)
+        for section, name in enumerate(header):
+            if name in sort_order:
+                view_header.setSortIndicator(
+                    section,
+                    (
+                        qc.Qt.SortOrder.AscendingOrder
+                        if sort_order[name] == "ASC"
+                        else qc.Qt.SortOrder.DescendingOrder
+                    ),
+                )
+                break
+        else:
+            view_header.setSortIndicator(-1, qc.Qt.SortOrder.AscendingOrder)
+        view_header.blockSignals(False)
+
+        if self.pending_column_widths:
+            for section, name in enumerate(header):
+                if name in self.pending_column_widths:
+                    view_header.resizeSection(
+                        section, self.pending_column_widths.pop(name)
+                    )
+
+        # Only recreate the filter line edits when the columns changed, not to lose focus while typing
+        if header != self.filter_header:
+            self.filter_header = list(header)
+            filters = self.query.get_column_filters()
+            self.filter_bar.set_texts(
+                {i: filters[name] for i, name in enumerate(header) if name in filters}
+            )
+
+    def get_column_widths(self) -> dict:
+        header = self.table_view.horizontalHeader()
+        return {
+            name: header.sectionSize(section)
+            for section, name in enumerate(self.query.get_header())
+        }
+
+    def set_column_widths(self, widths: dict):
+        """Column widths by column name, applied when (or as soon as) these columns are shown"""
+        self.pending_column_widths = dict(widths)
+        if self.query.get_header():
+            self.on_query_changed()
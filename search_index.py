@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import duckdb as db
+import pyarrow as pa
+import PySide6.QtCore as qc
+
+from commons import table_exists
+from query import Field, FilterExpression, FilterType, Query, expand_files
+from validation_model import annotation_tables
+
+# Written in the datalake, next to validation.db
+INDEX_FILE = "search_index.db"
+
+# Files searched, relative to the datalake
+INDEXED_FILES = ["genotypes/**/*.parquet", "aggregates/*.parquet"]
+
+# Text columns searched, when the files have them
+INDEXED_COLUMNS = ["snpeff_Gene_Name", "snpeff_Feature_ID", "transcript_ID"]
+
+# Name under which validation comments are indexed, as if they were a column
+COMMENT_COLUMN = "comment"
+
+# Distinct terms matched per column at most, to keep the resulting filter small
+MAX_MATCHES = 10_000
+
+
+def trigrams(text: str) -> List[str]:
+    text = text.lower()
+    return sorted({text[i : i + 3] for i in range(len(text) - 2)})
+
+
+class SearchIndex(qc.QObject):
+    """Trigram index of the distinct values of the text columns of the datalake files, and of the validation comments.
+
+    It lives in its own database in the datalake. Each file is indexed once, then again only when it changes
+    (modification time or size), and comments when their count changes (they are only ever appended).
+    A search returns the terms containing the text, found from the trigrams they share with it, never by scanning the files.
+    """
+
+    # Emitted once a refresh is done
+    refreshed = qc.Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.conn: db.DuckDBPyConnection = None
+        self.datalake_path: str = None
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+
+    def open(self, datalake_path: str):
+        with self.lock:
+            self.open_database(datalake_path)
+
+    def open_database(self, datalake_path: str):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.datalake_path = datalake_path
+        try:
+            self.conn = db.connect(str(Path(datalake_path) / INDEX_FILE))
+        except db.Error as e:
+            # Already opened by another viewer: no search
+            print(e)
+            return
+        self.conn.sql(
+            "CREATE TABLE IF NOT EXISTS sources (source TEXT, version TEXT)"
+        )
+        # Distinct values of each column, by file (or by validation for comments)
+        self.conn.sql(
+            "CREATE TABLE IF NOT EXISTS terms (source TEXT, column_name TEXT, term TEXT)"
+        )
+        self.conn.sql(
+            "CREATE TABLE IF NOT EXISTS term_trigrams (trigram TEXT, column_name TEXT, term TEXT)"
+        )
+        self.conn.sql(
+            "CREATE INDEX IF NOT EXISTS term_trigrams_by_trigram ON term_trigrams (trigram)"
+        )
+        # Rows the comments are on
+        self.conn.sql(
+            "CREATE TABLE IF NOT EXISTS comment_hashes (source TEXT, term TEXT, validation_hash UBIGINT)"
+        )
+
+    def file_version(self, path: str) -> str:
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def refresh(self, validations_conn: db.DuckDBPyConnection = None):
+        """Indexes the files and comments that changed since the last refresh, and drops those that are gone.
+        Paths are relative to the datalake, so this runs with it as working directory."""
+        with self.lock:
+            if self.conn is not None:
+                cursor = self.conn.cursor()
+                # All or nothing, so that sources are never recorded without their terms and trigrams
+                cursor.begin()
+                try:
+                    self.update_sources(cursor, validations_conn)
+                    cursor.commit()
+                except db.Error as e:
+                    print(e)
+                    cursor.rollback()
+        self.refreshed.emit()
+
+    def update_sources(self, cursor: db.DuckDBPyConnection, validations_conn: db.DuckDBPyConnection):
+        indexed = dict(cursor.sql("SELECT source, version FROM sources").fetchall())
+        current = {}
+        for path in expand_files(INDEXED_FILES):
+            try:
+                current[path] = self.file_version(path)
+            except OSError:
+                continue
+        comments = self.comment_sources(validations_conn) if validations_conn else {}
+        current.update({name: version for name, (version, _) in comments.items()})
+
+        changed = False
+        for source in indexed:
+            if source not in current:
+                self.drop_source(cursor, source)
+                changed = True
+        for source, version in current.items():
+            if indexed.get(source) == version:
+                continue
+            changed = True
+            self.drop_source(cursor, source)
+            try:
+                if source in comments:
+                    self.index_comments(cursor, source, validations_conn, comments[source][1])
+                else:
+                    self.index_file(cursor, source)
+            except db.Error as e:
+                print(e)
+                continue
+            cursor.execute("INSERT INTO sources VALUES (?, ?)", [source, version])
+
+        if changed:
+            self.update_trigrams(cursor)
+
+    def update_trigrams(self, cursor: db.DuckDBPyConnection):
+        # Trigrams of the new terms, and no more of the terms gone
+        cursor.sql(
+            """INSERT INTO term_trigrams SELECT DISTINCT substr(lower(t.term), i, 3), t.column_name, t.term
+            FROM (SELECT DISTINCT column_name, term FROM terms) t
+            ANTI JOIN (SELECT DISTINCT column_name, term FROM term_trigrams) k USING (column_name, term),
+            LATERAL (SELECT unnest(range(1, length(t.term) - 1)) AS i)"""
+        )
+        cursor.sql(
+            """DELETE FROM term_trigrams k WHERE NOT EXISTS (
+                SELECT 1 FROM terms t WHERE t.column_name = k.column_name AND t.term = k.term
+            )"""
+        )
+
+    def refresh_in_background(self, validations_conn: db.DuckDBPyConnection = None):
+        # A connection can't be shared between threads
+        cursor = validations_conn.cursor() if validations_conn else None
+        self.threads = [t for t in self.threads if t.is_alive()]
+        thread = threading.Thread(target=self.refresh, args=(cursor,), daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def wait(self):
+        """Waits for the refreshes running, DuckDB can't be left running at exit"""
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def drop_source(self, cursor: db.DuckDBPyConnection, source: str):
+        cursor.execute("DELETE FROM terms WHERE source = ?", [source])
+        cursor.execute("DELETE FROM comment_hashes WHERE source = ?", [source])
+        cursor.execute("DELETE FROM sources WHERE source = ?", [source])
+
+    def index_file(self, cursor: db.DuckDBPyConnection, path: str):
+        columns = [
+            row[0]
+            for row in cursor.execute("DESCRIBE SELECT * FROM read_parquet(?)", [path]).fetchall()
+            if row[0] in INDEXED_COLUMNS
+        ]
+        for column in columns:
+            cursor.execute(
+                f"""INSERT INTO terms SELECT DISTINCT ?, ?, CAST("{column}" AS TEXT) AS term FROM read_parquet(?) WHERE term IS NOT NULL""",
+                [path, column, path],
+            )
+
+    def comment_sources(self, validations_conn: db.DuckDBPyConnection) -> Dict[str, tuple]:
+        """Comment tables of the validations, by source name: their version (row count) and table name"""
+        sources = {}
+        if not table_exists(validations_conn, "validations"):
+            return sources
+        for (table_uuid,) in validations_conn.sql("SELECT table_uuid FROM validations").fetchall():
+            name = annotation_tables(table_uuid)["comments"]
+            if not table_exists(validations_conn, name):
+                continue
+            count = validations_conn.sql(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+            sources[f"{COMMENT_COLUMN}:{name}"] = (str(count), name)
+        return sources
+
+    def index_comments(
+        self,
+        cursor: db.DuckDBPyConnection,
+        source: str,
+        validations_conn: db.DuckDBPyConnection,
+        table: str,
+    ):
+        comments = validations_conn.sql(
+            f'SELECT comment AS term, validation_hash FROM "{table}" WHERE comment IS NOT NULL'
+        ).arrow()
+        cursor.register("new_comments", comments)
+        try:
+            cursor.execute(
+                "INSERT INTO terms SELECT DISTINCT ?, ?, term FROM new_comments", [source, COMMENT_COLUMN]
+            )
+            cursor.execute(
+                "INSERT INTO comment_hashes SELECT ?, term, validation_hash FROM new_comments", [source]
+            )
+        finally:
+            cursor.unregister("new_comments")
+
+    def search(self, text: str) -> Optional[Dict[str, List[str]]]:
+        """Terms containing the text (case insensitive), by column. None while the index is being refreshed."""
+        text = text.strip()
+        if self.conn is None or not text:
+            return {}
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        grams = trigrams(text)
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if grams:
+                # Terms having all the trigrams of the text, then checked for the text itself
+                rows = self.conn.execute(
+                    f"""SELECT column_name, term FROM (
+                        SELECT column_name, term FROM term_trigrams WHERE trigram IN ({', '.join('?' * len(grams))})
+                        GROUP BY column_name, term HAVING COUNT(DISTINCT trigram) = ?
+                    ) WHERE term ILIKE ? ESCAPE '\\'""",
+                    grams + [len(grams), pattern],
+                ).fetchall()
+            else:
+                # Too short for trigrams: the terms are scanned, not the files
+                rows = self.conn.execute(
+                    "SELECT DISTINCT column_name, term FROM terms WHERE term ILIKE ? ESCAPE '\\'",
+                    [pattern],
+                ).fetchall()
+        finally:
+            self.lock.release()
+        matches: Dict[str, List[str]] = {}
+        for column, term in rows:
+            terms = matches.setdefault(column, [])
+            if len(terms) < MAX_MATCHES:
+                terms.append(term)
+        return matches
+
+    def comment_hashes(self, comments: List[str]) -> List[int]:
+        with self.lock:
+            self.conn.register("comments", pa.table({"term": comments}))
+            try:
+                return [
+                    row[0]
+                    for row in self.conn.sql(
+                        "SELECT DISTINCT validation_hash FROM comment_hashes SEMI JOIN comments USING (term)"
+                    ).fetchall()
+                ]
+            finally:
+                self.conn.unregister("comments")
+
+    def search_filter(self, query: Query, text: str) -> Optional[FilterExpression]:
+        """A filter keeping the rows of the query main table having a value (or a comment) containing the text.
+        None while the index is being refreshed."""
+        matches = self.search(text)
+        if matches is None:
+            return None
+        columns = set(query.main_table_columns())
+        children = [
+            FilterExpression(field=Field(column, query.main_table), operator="IN", value=sorted(terms))
+            for column, terms in matches.items()
+            if column in columns
+        ]
+        if COMMENT_COLUMN in matches and "validation_hash" in columns:
+            children.append(
+                FilterExpression(
+                    field=Field("validation_hash", query.main_table),
+                    operator="IN",
+                    value=self.comment_hashes(matches[COMMENT_COLUMN]),
+                )
+            )
+        if not children:
+            # Nothing found: no row
+            return FilterExpression(constant=False)
+        return FilterExpression(FilterType.OR, children=children)
+
+
+search_index = SearchIndex()
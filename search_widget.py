@@ -0,0 +1,78 @@
+import PySide6.QtWidgets as qw
+
+from query import Query
+from search_index import search_index
+
+
+class SearchWidget(qw.QWidget):
+    """Search of the whole datalake (gene names, transcripts, comments), not just the page shown.
+    The rows found are kept by the search filter of the query."""
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+        # Text of the search applied (or waiting for the index)
+        self.text = ""
+        self.pending = False
+
+        self.line_edit = qw.QLineEdit()
+        self.line_edit.setPlaceholderText("Search the datalake (gene, transcript, comment)...")
+        self.line_edit.setClearButtonEnabled(True)
+        self.line_edit.returnPressed.connect(self.on_return_pressed)
+        self.line_edit.textChanged.connect(self.on_text_changed)
+        self.status_label = qw.QLabel("")
+
+        layout = qw.QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.line_edit)
+        layout.addWidget(self.status_label)
+
+        # Terms may have been added (or removed) since the search
+        search_index.refreshed.connect(self.apply)
+        self.query.query_changed.connect(self.on_query_changed)
+
+    def on_query_changed(self):
+        # The search may have been restored with a session, or reset with the query
+        text = self.query.get_search_text()
+        if text != self.text and not self.pending:
+            self.text = text
+            self.status_label.setText("")
+            self.line_edit.blockSignals(True)
+            self.line_edit.setText(text)
+            self.line_edit.blockSignals(False)
+
+    def on_return_pressed(self):
+        self.text = self.line_edit.text().strip()
+        if not self.text:
+            self.apply()
+            return
+        # Comments may have been added since the last refresh, the search runs once the index is up to date
+        self.pending = True
+        self.status_label.setText("Searching...")
+        search_index.refresh_in_background(self.query.conn)
+
+    def on_text_changed(self, text: str):
+        if not text and self.text:
+            self.text = ""
+            self.apply()
+
+    def apply(self):
+        self.pending = False
+        if not self.text:
+            self.status_label.setText("")
+            if self.query.get_search_filter():
+                self.query.set_search_filter(None)
+            return
+        if not self.query.main_table:
+            return
+        if search_index.conn is None:
+            self.status_label.setText("No search index")
+            return
+        filter = search_index.search_filter(self.query, self.text)
+        if filter is None:
+            # Applied once the index is refreshed
+            self.pending = True
+            self.status_label.setText("Indexing...")
+            return
+        self.status_label.setText("" if filter.constant is None else "Not found")
+        self.query.set_search_filter(filter, self.text)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import json
+from pathlib import Path
+
+from query import Query
+from query_cache import query_cache
+
+# Bump when the session layout changes: older sessions are then ignored rather than misread
+SESSION_VERSION = 2
+
+
+def save_session(filename: Path, query: Query, widgets: dict = None):
+    """Saves the query state, the row counts already computed, and any widget state (column widths, current validation...)
+
+    Args:
+        filename (Path): the session file (JSON)
+        query (Query): the query to save
+        widgets (dict, optional): widget states, by widget name. Must be JSON serializable. Defaults to None.
+    """
+    session = {
+        "version": SESSION_VERSION,
+        "query": query.to_json(),
+        # Keyed by count fingerprint, which changes with the files: stale counts are simply never hit.
+        # Only the counts of file backed selects: database tables are versioned per process, their fingerprints would be reused
+        "counts": query_cache.persistent_items("counts"),
+        "widgets": widgets or {},
+    }
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(session, f, default=str)
+
+
+def load_session(filename: Path) -> dict:
+    """Reads a session file. Returns None if there is none, or if it can't be used (older version, corrupted)"""
+    try:
+        with open(filename, "r") as f:
+            session = json.load(f)
+    except (OSError, ValueError) as e:
+        print(e)
+        return None
+    if not isinstance(session, dict) or session.get("version") != SESSION_VERSION:
+        return None
+    return session
+
+
+def restore_session(session: dict, query: Query):
+    """Restores the query from a session, without running it.
+
+    Row counts are put back in the cache, so the first update only runs the page query.
+    """
+    for key, count in session["counts"].items():
+        query_cache.put("counts", key, count, persistent=True)
+
+    query.mute()
+    try:
+        query.restore(session["query"])
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Could not restore previous session: {e}")
+        query.init_state()
+    query.unmute()
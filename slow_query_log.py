@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import atexit
+import contextlib
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+import duckdb as db
+import PySide6.QtCore as qc
+
+from query_monitor import query_monitor
+
+# Statements taking longer than this (in seconds) are logged. Overridden by the slow_query_threshold_s preference.
+DEFAULT_THRESHOLD = 1.0
+
+# Entries kept, the oldest are dropped first
+MAX_ENTRIES = 200
+
+
+def is_read_only(sql: str) -> bool:
+    """Whether a statement only reads, and can be run again to profile it"""
+    return sql.lstrip().upper().startswith(("SELECT", "WITH", "FROM"))
+
+
+def statement_fingerprint(sql: str) -> str:
+    """Identifies a statement independently of its parameters, so that runs of the same query can be grouped"""
+    return hashlib.sha256(" ".join(sql.split()).encode()).hexdigest()[:16]
+
+
+class SlowQueryLog(qc.QObject):
+    """Statements that took longer than the threshold, with their plan and timings per operator on request.
+
+    Statements are only timed: profiling every one of them would slow them all down. The plan of a slow statement
+    is obtained by running it again with DuckDB's profiler enabled (EXPLAIN ANALYZE doesn't accept parameters).
+    """
+
+    # Entries are passed as objects: a dict signal would pass a copy, that the profile wouldn't be stored in
+    entry_added = qc.Signal(object)
+    # Entry whose profile was just added
+    entry_changed = qc.Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.threshold = DEFAULT_THRESHOLD
+        self.entries = deque(maxlen=MAX_ENTRIES)
+        self.folder = Path(tempfile.gettempdir()) / f"parquetviewer-profiles-{os.getpid()}"
+        atexit.register(shutil.rmtree, self.folder, ignore_errors=True)
+
+    def profile(self, conn: db.DuckDBPyConnection, entry: dict) -> str:
+        """Runs the statement of an entry again with the profiler enabled, and stores its plan in the entry"""
+        path = self.folder / f"{id(conn)}.txt"
+        query_monitor.wait()
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            conn.sql("SET enable_profiling = 'query_tree'")
+            conn.sql(f"SET profiling_output = '{path}'")
+            try:
+                query_monitor.run(
+                    conn,
+                    lambda: conn.execute(entry["sql"], entry["params"]).fetch_arrow_table(),
+                    entry["query_class"],
+                )
+            finally:
+                conn.sql("PRAGMA disable_profiling")
+            with open(path, "r") as f:
+                entry["profile"] = f.read()
+        except (db.Error, OSError) as e:
+            entry["profile"] = f"Could not profile the statement: {e}"
+        finally:
+            path.unlink(missing_ok=True)
+        self.entry_changed.emit(entry)
+        return entry["profile"]
+
+    @contextlib.contextmanager
+    def timed(self, conn: db.DuckDBPyConnection, sql: str, query_class: str, params=()):
+        """Times the statement run in the block on conn, and records it if slow"""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                entry = {
+                    "time": datetime.datetime.now(),
+                    "query_class": query_class,
+                    "duration": duration,
+                    "fingerprint": statement_fingerprint(sql),
+                    "sql": sql,
+                    "params": list(params),
+                    "error": error,
+                    "profile": "",
+                }
+                self.entries.append(entry)
+                # Queued to the main thread when recorded from a background count
+                self.entry_added.emit(entry)
+
+    def clear(self):
+        self.entries.clear()
+
+
+slow_query_log = SlowQueryLog()
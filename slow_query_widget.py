@@ -0,0 +1,119 @@
+import PySide6.QtCore as qc
+import PySide6.QtGui as qg
+import PySide6.QtWidgets as qw
+
+from query import Query
+from slow_query_log import is_read_only, slow_query_log
+
+COLUMNS = ["Time", "Class", "Duration (s)", "Fingerprint", "Statement"]
+
+
+class SlowQueryWidget(qw.QWidget):
+    """Lists the statements recorded by the slow query log. Selecting one shows its SQL, parameters and plan (once profiled)."""
+
+    def __init__(self, query: Query, parent=None):
+        super().__init__(parent)
+        self.query = query
+
+        self.table = qw.QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.setSelectionBehavior(
+            qw.QAbstractItemView.SelectionBehavior.SelectRows
+        )
+        self.table.setSelectionMode(qw.QAbstractItemView.SelectionMode.SingleSelection)
+        self.table.setEditTriggers(qw.QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().hide()
+        self.table.itemSelectionChanged.connect(self.on_selection_changed)
+
+        self.details = qw.QPlainTextEdit()
+        self.details.setReadOnly(True)
+        self.details.setLineWrapMode(qw.QPlainTextEdit.LineWrapMode.NoWrap)
+        self.details.setFont(
+            qg.QFontDatabase.systemFont(qg.QFontDatabase.SystemFont.FixedFont)
+        )
+
+        splitter = qw.QSplitter(qc.Qt.Orientation.Vertical)
+        splitter.addWidget(self.table)
+        splitter.addWidget(self.details)
+
+        self.profile_button = qw.QPushButton("Profile")
+        self.profile_button.setToolTip("Run the statement again with the profiler, to get its plan and timings per operator")
+        self.profile_button.setEnabled(False)
+        self.profile_button.clicked.connect(self.on_profile_clicked)
+        self.clear_button = qw.QPushButton("Clear")
+        self.clear_button.clicked.connect(self.on_clear_clicked)
+
+        buttons = qw.QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.profile_button)
+        buttons.addWidget(self.clear_button)
+
+        layout = qw.QVBoxLayout()
+        layout.addWidget(splitter)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+        self.entries = []
+        for entry in slow_query_log.entries:
+            self.add_entry(entry)
+        slow_query_log.entry_added.connect(self.add_entry)
+        slow_query_log.entry_changed.connect(self.on_entry_changed)
+
+    def add_entry(self, entry: dict):
+        self.entries.append(entry)
+        # Don't keep more rows than the log does
+        if len(self.entries) > slow_query_log.entries.maxlen:
+            self.entries.pop(0)
+            self.table.removeRow(0)
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        values = [
+            entry["time"].strftime("%H:%M:%S"),
+            entry["query_class"],
+            f"{entry['duration']:.2f}",
+            entry["fingerprint"],
+            " ".join(entry["sql"].split()),
+        ]
+        for column, value in enumerate(values):
+            item = qw.QTableWidgetItem(value)
+            if entry["error"]:
+                item.setForeground(qg.QColor("red"))
+            self.table.setItem(row, column, item)
+
+    def selected_entry(self) -> dict:
+        rows = self.table.selectionModel().selectedRows()
+        return self.entries[rows[0].row()] if rows else None
+
+    def on_selection_changed(self):
+        entry = self.selected_entry()
+        # Only statements that read can be run again
+        self.profile_button.setEnabled(
+            entry is not None and is_read_only(entry["sql"]) and self.query.conn is not None
+        )
+        if entry is None:
+            self.details.clear()
+            return
+        text = entry["sql"]
+        if entry["params"]:
+            text += f"\n\nParameters: {entry['params']}"
+        if entry["error"]:
+            text += f"\n\nError: {entry['error']}"
+        text += "\n\n" + (entry["profile"] or "No plan yet, see Profile")
+        self.details.setPlainText(text)
+
+    def on_profile_clicked(self):
+        entry = self.selected_entry()
+        if entry is not None and self.query.conn is not None:
+            slow_query_log.profile(self.query.conn, entry)
+
+    def on_entry_changed(self, entry: dict):
+        if entry is self.selected_entry():
+            self.on_selection_changed()
+
+    def on_clear_clicked(self):
+        slow_query_log.clear()
+        self.entries = []
+        self.table.setRowCount(0)
+        self.details.clear()
+        self.profile_button.setEnabled(False)
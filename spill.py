@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import uuid
+from pathlib import Path
+from typing import List
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+# Results above this size (in bytes) are written to disk and memory-mapped rather than kept in memory
+DEFAULT_SPILL_THRESHOLD = 64 * 1024 * 1024
+
+_spill_folder = Path(tempfile.gettempdir()) / f"parquetviewer-spill-{os.getpid()}"
+_spill_files: List[Path] = []
+
+
+def spill_if_large(table: pa.Table, threshold: int = DEFAULT_SPILL_THRESHOLD) -> pa.Table:
+    """Returns the table itself if small enough, or an equivalent table memory-mapped from an Arrow IPC file.
+
+    Cells of a mapped table are read from the page cache on access, so resident memory doesn't grow with the row count.
+    """
+    if table is None or table.nbytes <= threshold:
+        return table
+
+    _spill_folder.mkdir(parents=True, exist_ok=True)
+    path = _spill_folder / f"{uuid.uuid4().hex}.arrow"
+    try:
+        with pa.OSFile(str(path), "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    except OSError as e:
+        # No room on disk: keep the table in memory
+        print(e)
+        return table
+    _spill_files.append(path)
+    return ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+
+
+def release_spill_files():
+    """Deletes the spill files. Files still mapped can't be deleted on every platform, those are retried next time."""
+    for path in list(_spill_files):
+        try:
+            path.unlink(missing_ok=True)
+            _spill_files.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from typing import Dict, List, Tuple
+
+import duckdb as db
+
+from commons import files_match, table_exists
+from method_compiler import DECISION_KEY, MAIN_TABLE_ALIAS, CompiledMethod
+from query import Table, bump_table_version, parquet_table, prune_partitions
+
+
+class StepResultCache:
+    """Materializes the rows surviving each validation step as temp tables.
+
+    A step declaring refines_previous then reads the survivors of the previous step instead of the run files.
+    Survivors are the rows of the run files matching the step filter, minus the ones rejected in the validation table.
+    Entries are keyed by validation table, method digest and step index, and must be invalidated when decisions change.
+    """
+
+    def __init__(self):
+        self.tables: Dict[Tuple[str, str, int], str] = {}
+        # What each entry was materialized from, to rebuild it when the run files change
+        self.sources: Dict[Tuple[str, str, int], Tuple[CompiledMethod, List[str]]] = {}
+
+    def get_main_table(
+        self,
+        conn: db.DuckDBPyConnection,
+        table_uuid: str,
+        method: CompiledMethod,
+        step_index: int,
+        parquet_files: List[str],
+    ) -> Table:
+        """Returns the table the given step should read from (the run files, or the survivors of the previous step)"""
+        if step_index == 0 or not method[step_index].refines_previous:
+            return parquet_table(parquet_files, MAIN_TABLE_ALIAS)
+        return Table(
+            self.materialize(conn, table_uuid, method, step_index - 1, parquet_files),
+            MAIN_TABLE_ALIAS,
+            quoted=True,
+        )
+
+    def materialize(
+        self,
+        conn: db.DuckDBPyConnection,
+        table_uuid: str,
+        method: CompiledMethod,
+        step_index: int,
+        parquet_files: List[str],
+    ) -> str:
+        """Creates (if needed) the temp table holding the survivors of a step, and returns its name"""
+        key = (table_uuid, method.digest, step_index)
+        name = self.tables.get(key)
+        # Temp tables only live as long as the connection, so the cache entry alone is not enough
+        if name and table_exists(conn, name):
+            return name
+
+        name = f"step_{table_uuid}_{method.digest[:12]}_{step_index}"
+        source = self.get_main_table(
+            conn, table_uuid, method, step_index, parquet_files
+        )
+        step = method[step_index]
+        if source.files:
+            # Only read the hive partitions the step filter may match
+            source = parquet_table(
+                prune_partitions(source.files, step.filter, MAIN_TABLE_ALIAS)
+                or source.files,
+                MAIN_TABLE_ALIAS,
+            )
+
+        joins = " ".join(str(join) for join in step.joins.values())
+        conditions = [
+            f"""{MAIN_TABLE_ALIAS}.{DECISION_KEY} NOT IN (SELECT {DECISION_KEY} FROM "{table_uuid}" WHERE accepted = FALSE AND {DECISION_KEY} IS NOT NULL)"""
+        ]
+        if step.filter:
+            conditions.insert(0, f"({step.filter:P})")
+
+        conn.execute(
+            f"""CREATE OR REPLACE TEMP TABLE "{name}" AS SELECT {MAIN_TABLE_ALIAS}.* FROM {source:s} {joins} WHERE {' AND '.join(conditions)}""",
+            step.filter.params() if step.filter else [],
+        )
+        self.tables[key] = name
+        self.sources[key] = (method, parquet_files)
+        bump_table_version(name)
+        return name
+
+    def refresh_files(self, conn: db.DuckDBPyConnection, paths: List[str]) -> List[str]:
+        """Rebuilds the steps materialized from any of the given files. Returns the names of the tables rebuilt."""
+        keys = sorted(
+            key
+            for key, (_, parquet_files) in self.sources.items()
+            if key in self.tables and files_match(paths, parquet_files)
+        )
+        # Forget them all first, so that each step reads the rebuilt previous step rather than the stale one
+        for key in keys:
+            del self.tables[key]
+        names = []
+        for key in keys:
+            method, parquet_files = self.sources[key]
+            if not conn:
+                continue
+            try:
+                names.append(self.materialize(conn, key[0], method, key[2], parquet_files))
+            except db.Error as e:
+                print(e)
+        return names
+
+    def invalidate(self, conn: db.DuckDBPyConnection, table_uuid: str):
+        """Drops every materialized step of a validation (to be called whenever one of its decisions changes)"""
+        for key in [key for key in self.tables if key[0] == table_uuid]:
+            name = self.tables.pop(key)
+            self.sources.pop(key, None)
+            if conn:
+                conn.sql(f'DROP TABLE IF EXISTS "{name}"')
+
+
+# Shared by the validation widget (reads) and the decision functions (invalidation)
+step_results = StepResultCache()
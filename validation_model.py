@@ -1,12 +1,20 @@
 import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional
 
 import duckdb as db
 import PySide6.QtCore as qc
 
-from commons import duck_db_literal_string_list
-from query import Query
+from commons import (
+    duck_db_literal_string_list,
+    duckdb_config,
+    get_datalake_settings,
+    table_exists,
+)
+from query import Field, FilterExpression, Query, bump_table_version
+from query_monitor import query_monitor
+from slow_query_log import slow_query_log
+from step_cache import step_results
 
 VALIDATION_TABLE_COLUMNS = {
     "parquet_files": 0,
@@ -20,21 +28,62 @@ VALIDATION_TABLE_COLUMNS = {
 }
 
 
-def initialize_database(database: Path):
+def initialize_database(database: Path, settings: dict = None):
+    """Connects to the validation database, with the datalake settings (threads, memory limit, temp directory)"""
+    config = duckdb_config(settings or {})
 
     # If the database already exists, we shouldn't initialize it
     if database.exists():
-        return db.connect(str(database))
-    conn = db.connect(str(database))
+        conn = db.connect(str(database), config=config)
+        # Databases created before the decision index get it built from their validations
+        ensure_decision_index(conn)
+        return conn
+    conn = db.connect(str(database), config=config)
     conn.sql(
         "CREATE TABLE validations (parquet_files TEXT[], sample_names TEXT[], username TEXT, validation_name TEXT, table_uuid TEXT, creation_date DATETIME, completed BOOLEAN, last_step INTEGER, validation_method TEXT)"
     )
     conn.sql(
         "CREATE TYPE COMMENT AS STRUCT(comment TEXT, username TEXT, creation_timestamp TIMESTAMP)"
     )
+    ensure_decision_index(conn)
     return conn
 
 
+# Decisions of all the validations, kept up to date by set_decision, add_tag and remove_tag
+DECISIONS_TABLE = "decisions"
+DECISION_TAGS_TABLE = "decision_tags"
+
+
+def ensure_decision_index(conn: db.DuckDBPyConnection):
+    """Creates the decision index if missing, filling it from the validation tables"""
+    if table_exists(conn, DECISIONS_TABLE):
+        return
+    # Hashes are unsigned 64 bits integers in the parquet files, as in the tables below
+    conn.sql(
+        f"CREATE TABLE {DECISIONS_TABLE} (validation_hash UBIGINT, table_uuid TEXT, sample_name TEXT, run_name TEXT, accepted BOOLEAN, PRIMARY KEY (validation_hash, table_uuid))"
+    )
+    conn.sql(
+        f"CREATE TABLE {DECISION_TAGS_TABLE} (tag TEXT, validation_hash UBIGINT, table_uuid TEXT, PRIMARY KEY (tag, validation_hash, table_uuid))"
+    )
+    # Tag filters look the tags up by tag. Decisions get no index on the verdict:
+    # a boolean is skipped through by zone maps, and a second index breaks INSERT OR REPLACE in DuckDB 0.10
+    conn.sql(f"CREATE INDEX {DECISION_TAGS_TABLE}_by_tag ON {DECISION_TAGS_TABLE} (tag)")
+
+    for (table_uuid,) in conn.sql("SELECT table_uuid FROM validations").fetchall():
+        if not table_exists(conn, table_uuid):
+            continue
+        ensure_annotation_tables(conn, table_uuid)
+        names = annotation_tables(table_uuid)
+        conn.execute(
+            f"""INSERT OR IGNORE INTO {DECISIONS_TABLE} SELECT validation_hash, ?, sample_name, run_name, accepted FROM "{table_uuid}" WHERE validation_hash IS NOT NULL""",
+            [table_uuid],
+        )
+        conn.execute(
+            f"""INSERT OR IGNORE INTO {DECISION_TAGS_TABLE} SELECT t.tag, p.validation_hash, ? FROM "{names['tag_postings']}" p JOIN "{names['tags']}" t USING (tag_id)""",
+            [table_uuid],
+        )
+
+
 def add_validation_table(
     conn: db.DuckDBPyConnection,
     validation_name: str,
@@ -47,20 +96,295 @@ def add_validation_table(
         conn.sql("SELECT ('validation_' || uuid()) as uuid").pl().to_dicts()[0]["uuid"]
     )
     try:
-        conn.sql(
-            f"INSERT INTO validations VALUES ({duck_db_literal_string_list(parquet_files)}, {duck_db_literal_string_list(sample_names)}, '{username}', '{validation_name}', '{table_uuid}', NOW(), FALSE, 0, '{validation_method}')"
-        )
-        conn.sql(
-            f"CREATE TABLE '{table_uuid}' (validation_hash BIGINT,sample_name TEXT,run_name TEXT,transcript_ID TEXT,accepted BOOLEAN,comment COMMENT[], tags TEXT[])"
-        )
+        for statement in (
+            f"INSERT INTO validations VALUES ({duck_db_literal_string_list(parquet_files)}, {duck_db_literal_string_list(sample_names)}, '{username}', '{validation_name}', '{table_uuid}', NOW(), FALSE, 0, '{validation_method}')",
+            f"CREATE TABLE '{table_uuid}' (validation_hash UBIGINT,sample_name TEXT,run_name TEXT,transcript_ID TEXT,accepted BOOLEAN)",
+        ):
+            with slow_query_log.timed(conn, statement, "wizard"):
+                conn.sql(statement)
+        create_annotation_tables(conn, table_uuid)
     except db.Error as e:
         print(e)
         # No matter what the exact error is, we should rollback the transaction
         # Manual rollback
         conn.sql(f"""DROP TABLE IF EXISTS "{table_uuid}" """)
+        drop_annotation_tables(conn, table_uuid)
         conn.sql(f"DELETE FROM validations WHERE table_uuid = '{table_uuid}'")
 
 
+def set_decision(
+    conn: db.DuckDBPyConnection,
+    table_uuid: str,
+    validation_hash: int,
+    sample_name: Optional[str],
+    run_name: Optional[str],
+    transcript_id: Optional[str],
+    accepted: bool,
+):
+    """Records whether a variant is accepted or rejected in a validation.
+    Sample, run and transcript are None when the run files don't have them: those already recorded are kept."""
+    existing = conn.execute(
+        f"""SELECT COUNT(*) FROM "{table_uuid}" WHERE validation_hash = ?""",
+        [validation_hash],
+    ).fetchone()[0]
+    if existing:
+        conn.execute(
+            f"""UPDATE "{table_uuid}" SET accepted = ?, sample_name = COALESCE(?, sample_name), run_name = COALESCE(?, run_name),
+            transcript_ID = COALESCE(?, transcript_ID) WHERE validation_hash = ?""",
+            [accepted, sample_name, run_name, transcript_id, validation_hash],
+        )
+    else:
+        conn.execute(
+            f"""INSERT INTO "{table_uuid}" (validation_hash, sample_name, run_name, transcript_ID, accepted) VALUES (?, ?, ?, ?, ?)""",
+            [validation_hash, sample_name, run_name, transcript_id, accepted],
+        )
+    conn.execute(
+        f"""INSERT INTO {DECISIONS_TABLE} VALUES (?, ?, ?, ?, ?) ON CONFLICT (validation_hash, table_uuid) DO UPDATE SET
+        sample_name = COALESCE(EXCLUDED.sample_name, sample_name), run_name = COALESCE(EXCLUDED.run_name, run_name), accepted = EXCLUDED.accepted""",
+        [validation_hash, table_uuid, sample_name, run_name, accepted],
+    )
+    # Cached queries reading the validation table are stale, and so are materialized step results (they exclude rejected variants)
+    bump_table_version(table_uuid)
+    bump_table_version(DECISIONS_TABLE)
+    step_results.invalidate(conn, table_uuid)
+
+
+def get_decision(
+    conn: db.DuckDBPyConnection, table_uuid: str, validation_hash: int
+) -> Optional[bool]:
+    """Whether a variant is accepted in a validation, None if not decided yet"""
+    res = conn.execute(
+        f"""SELECT accepted FROM "{table_uuid}" WHERE validation_hash = ?""",
+        [validation_hash],
+    ).fetchone()
+    return res[0] if res else None
+
+
+def annotation_tables(table_uuid: str) -> Dict[str, str]:
+    """Names of the side tables holding the comments and tags of a validation"""
+    return {
+        # One row per comment
+        "comments": f"{table_uuid}_comments",
+        # Comment count and last comment of each commented row, what the grid shows
+        "comment_summary": f"{table_uuid}_comment_summary",
+        # Tag dictionary, and the rows having each tag
+        "tags": f"{table_uuid}_tags",
+        "tag_ids": f"{table_uuid}_tag_ids",
+        "tag_postings": f"{table_uuid}_tag_postings",
+        # Tags of each tagged row, as a list
+        "tag_lists": f"{table_uuid}_tag_lists",
+    }
+
+
+def create_annotation_tables(conn: db.DuckDBPyConnection, table_uuid: str):
+    names = annotation_tables(table_uuid)
+    conn.sql(
+        f"""CREATE TABLE IF NOT EXISTS "{names['comments']}" (validation_hash UBIGINT, comment TEXT, username TEXT, creation_timestamp TIMESTAMP)"""
+    )
+    conn.sql(
+        f"""CREATE TABLE IF NOT EXISTS "{names['comment_summary']}" (validation_hash UBIGINT PRIMARY KEY, comment_count INTEGER, last_comment TEXT, last_comment_username TEXT, last_comment_timestamp TIMESTAMP)"""
+    )
+    conn.sql(f"""CREATE SEQUENCE IF NOT EXISTS "{names['tag_ids']}" """)
+    conn.sql(
+        f"""CREATE TABLE IF NOT EXISTS "{names['tags']}" (tag_id INTEGER PRIMARY KEY DEFAULT nextval('"{names['tag_ids']}"'), tag TEXT UNIQUE NOT NULL)"""
+    )
+    conn.sql(
+        f"""CREATE TABLE IF NOT EXISTS "{names['tag_postings']}" (tag_id INTEGER, validation_hash UBIGINT, PRIMARY KEY (tag_id, validation_hash))"""
+    )
+    # Tag filters look the postings up by tag
+    conn.sql(
+        f"""CREATE INDEX IF NOT EXISTS "{names['tag_postings']}_by_tag" ON "{names['tag_postings']}" (tag_id)"""
+    )
+    conn.sql(
+        f"""CREATE VIEW IF NOT EXISTS "{names['tag_lists']}" AS SELECT p.validation_hash, list(t.tag ORDER BY t.tag) AS tags FROM "{names['tag_postings']}" p JOIN "{names['tags']}" t USING (tag_id) GROUP BY p.validation_hash"""
+    )
+
+
+def drop_annotation_tables(conn: db.DuckDBPyConnection, table_uuid: str):
+    names = annotation_tables(table_uuid)
+    conn.sql(f"""DROP VIEW IF EXISTS "{names['tag_lists']}" """)
+    for name in ("comments", "comment_summary", "tag_postings", "tags"):
+        conn.sql(f"""DROP TABLE IF EXISTS "{names[name]}" """)
+    conn.sql(f"""DROP SEQUENCE IF EXISTS "{names['tag_ids']}" """)
+
+
+def ensure_annotation_tables(conn: db.DuckDBPyConnection, table_uuid: str):
+    """Creates the side tables of a validation, moving there the comments and tags of validations
+    created when they were stored in the validation table itself (comment COMMENT[] and tags TEXT[] columns)"""
+    query_monitor.wait()
+    create_annotation_tables(conn, table_uuid)
+    columns = {
+        row[0]
+        for row in conn.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+            [table_uuid],
+        ).fetchall()
+    }
+    if "comment" not in columns and "tags" not in columns:
+        return
+
+    names = annotation_tables(table_uuid)
+    # All or nothing: a failure halfway would leave annotations copied twice at the next attempt, or lost
+    conn.begin()
+    try:
+        if "comment" in columns:
+            conn.sql(
+                f"""INSERT INTO "{names['comments']}" SELECT validation_hash, c.comment, c.username, c.creation_timestamp FROM (SELECT validation_hash, unnest(comment) AS c FROM "{table_uuid}")"""
+            )
+            conn.sql(
+                f"""INSERT OR REPLACE INTO "{names['comment_summary']}" SELECT validation_hash, COUNT(*), arg_max(comment, creation_timestamp), arg_max(username, creation_timestamp), MAX(creation_timestamp) FROM "{names['comments']}" GROUP BY validation_hash"""
+            )
+            conn.sql(f"""ALTER TABLE "{table_uuid}" DROP COLUMN comment""")
+        if "tags" in columns:
+            conn.sql(
+                f"""INSERT INTO "{names['tags']}" (tag) SELECT DISTINCT unnest(tags) FROM "{table_uuid}" ON CONFLICT DO NOTHING"""
+            )
+            conn.sql(
+                f"""INSERT OR IGNORE INTO "{names['tag_postings']}" SELECT DISTINCT t.tag_id, v.validation_hash FROM (SELECT validation_hash, unnest(tags) AS tag FROM "{table_uuid}") v JOIN "{names['tags']}" t USING (tag)"""
+            )
+            conn.sql(f"""ALTER TABLE "{table_uuid}" DROP COLUMN tags""")
+        conn.commit()
+    except db.Error as e:
+        print(e)
+        conn.rollback()
+        return
+    bump_table_version(table_uuid)
+
+
+def add_comment(
+    conn: db.DuckDBPyConnection,
+    table_uuid: str,
+    validation_hash: int,
+    comment: str,
+    username: str,
+):
+    """Appends a comment to a row of a validation: one row inserted, and its summary updated in place"""
+    names = annotation_tables(table_uuid)
+    timestamp = datetime.datetime.now()
+    conn.execute(
+        f"""INSERT INTO "{names['comments']}" VALUES (?, ?, ?, ?)""",
+        [validation_hash, comment, username, timestamp],
+    )
+    conn.execute(
+        f"""INSERT INTO "{names['comment_summary']}" VALUES (?, 1, ?, ?, ?) ON CONFLICT (validation_hash) DO UPDATE SET comment_count = comment_count + 1, last_comment = EXCLUDED.last_comment, last_comment_username = EXCLUDED.last_comment_username, last_comment_timestamp = EXCLUDED.last_comment_timestamp""",
+        [validation_hash, comment, username, timestamp],
+    )
+    bump_table_version(names["comment_summary"])
+
+
+def get_comments(
+    conn: db.DuckDBPyConnection, table_uuid: str, validation_hash: int
+) -> List[dict]:
+    """All the comments of a row, oldest first"""
+    names = annotation_tables(table_uuid)
+    res = conn.execute(
+        f"""SELECT comment, username, creation_timestamp FROM "{names['comments']}" WHERE validation_hash = ? ORDER BY creation_timestamp""",
+        [validation_hash],
+    ).arrow()
+    return res.to_pylist()
+
+
+def get_tags(
+    conn: db.DuckDBPyConnection, table_uuid: str, validation_hash: int
+) -> List[str]:
+    """Tags of a row, sorted"""
+    names = annotation_tables(table_uuid)
+    res = conn.execute(
+        f"""SELECT tags FROM "{names['tag_lists']}" WHERE validation_hash = ?""",
+        [validation_hash],
+    ).fetchone()
+    return res[0] if res else []
+
+
+def add_tag(
+    conn: db.DuckDBPyConnection, table_uuid: str, validation_hash: int, tag: str
+):
+    names = annotation_tables(table_uuid)
+    conn.execute(
+        f"""INSERT INTO "{names['tags']}" (tag) VALUES (?) ON CONFLICT DO NOTHING""",
+        [tag],
+    )
+    conn.execute(
+        f"""INSERT OR IGNORE INTO "{names['tag_postings']}" SELECT tag_id, ? FROM "{names['tags']}" WHERE tag = ?""",
+        [validation_hash, tag],
+    )
+    conn.execute(
+        f"INSERT OR IGNORE INTO {DECISION_TAGS_TABLE} VALUES (?, ?, ?)",
+        [tag, validation_hash, table_uuid],
+    )
+    bump_table_version(names["tag_lists"])
+    bump_table_version(DECISION_TAGS_TABLE)
+
+
+def remove_tag(
+    conn: db.DuckDBPyConnection, table_uuid: str, validation_hash: int, tag: str
+):
+    names = annotation_tables(table_uuid)
+    conn.execute(
+        f"""DELETE FROM "{names['tag_postings']}" WHERE validation_hash = ? AND tag_id = (SELECT tag_id FROM "{names['tags']}" WHERE tag = ?)""",
+        [validation_hash, tag],
+    )
+    conn.execute(
+        f"DELETE FROM {DECISION_TAGS_TABLE} WHERE tag = ? AND validation_hash = ? AND table_uuid = ?",
+        [tag, validation_hash, table_uuid],
+    )
+    bump_table_version(names["tag_lists"])
+    bump_table_version(DECISION_TAGS_TABLE)
+
+
+def tag_filter(
+    conn: db.DuckDBPyConnection, table_uuid: str, field: Field, tag: str
+) -> FilterExpression:
+    """A filter keeping the rows having the tag, from its postings: no row of the validation is read.
+
+    Args:
+        field (Field): the validation_hash field of the table to filter
+    """
+    names = annotation_tables(table_uuid)
+    hashes = conn.execute(
+        f"""SELECT p.validation_hash FROM "{names['tag_postings']}" p JOIN "{names['tags']}" t USING (tag_id) WHERE t.tag = ?""",
+        [tag],
+    ).fetchall()
+    return FilterExpression(field=field, operator="IN", value=[h[0] for h in hashes])
+
+
+def find_decisions(
+    conn: db.DuckDBPyConnection, accepted: bool = None, tag: str = None
+) -> List[dict]:
+    """Decisions of all the validations, with the given verdict and/or tag, from the decision index"""
+    joins = ""
+    conditions = []
+    params = []
+    if tag is not None:
+        # Starts from the rows having the tag, found with the tag index
+        joins = f" JOIN {DECISION_TAGS_TABLE} t ON t.validation_hash = d.validation_hash AND t.table_uuid = d.table_uuid AND t.tag = ?"
+        params.append(tag)
+    if accepted is not None:
+        conditions.append("d.accepted = ?")
+        params.append(accepted)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return (
+        conn.execute(
+            f"""SELECT d.*, v.validation_name FROM {DECISIONS_TABLE} d JOIN validations v USING (table_uuid){joins}{where}""",
+            params,
+        )
+        .arrow()
+        .to_pylist()
+    )
+
+
+def decisions_filter(
+    conn: db.DuckDBPyConnection, field: Field, accepted: bool = None, tag: str = None
+) -> FilterExpression:
+    """A filter keeping the rows decided with the given verdict and/or tagged in any validation
+
+    Args:
+        field (Field): the validation_hash field of the table to filter
+    """
+    hashes = {d["validation_hash"] for d in find_decisions(conn, accepted, tag)}
+    return FilterExpression(field=field, operator="IN", value=sorted(hashes))
+
+
 def get_validation_from_table_uuid(
     conn: db.DuckDBPyConnection, table_uuid: str
 ) -> dict:
@@ -78,11 +402,13 @@ class ValidationModel(qc.QAbstractTableModel):
         self.query = query
         self.headers = []
         self._data = []
+        self.database_path = None
 
         self.query.query_changed.connect(self.on_datalake_changed)
         if self.query.datalake_path:
+            self.database_path = Path(self.query.datalake_path) / "validation.db"
             self.query.conn = initialize_database(
-                Path(self.query.datalake_path) / "validation.db"
+                self.database_path, get_datalake_settings(self.query.datalake_path)
             )
             self.update()
 
@@ -156,19 +482,27 @@ class ValidationModel(qc.QAbstractTableModel):
         self.update()
 
     def update(self) -> None:
+        if query_monitor.defer(self.update):
+            return
         self.beginResetModel()
         self.headers = []
         self._data = []
         if self.query.conn:
-            query_res = self.query.conn.sql("SELECT * FROM validations").pl()
+            sql = "SELECT * FROM validations"
+            with slow_query_log.timed(self.query.conn, sql, "validation"):
+                query_res = self.query.conn.sql(sql).pl()
             self.headers = query_res.columns
             self._data = [tuple(v for v in d.values()) for d in query_res.to_dicts()]
         self.endResetModel()
 
     def on_datalake_changed(self):
-        if not self.query.datalake_path:
+        if not self.query.datalake_path or query_monitor.defer(self.on_datalake_changed):
             return
-        self.query.conn = initialize_database(
-            Path(self.query.datalake_path) / "validation.db"
-        )
+        database_path = Path(self.query.datalake_path) / "validation.db"
+        # query_changed is emitted on every page: reconnecting each time would drop the temp tables of the connection
+        if database_path != self.database_path or not self.query.conn:
+            self.database_path = database_path
+            self.query.conn = initialize_database(
+                database_path, get_datalake_settings(self.query.datalake_path)
+            )
         self.update()
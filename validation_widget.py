@@ -1,6 +1,4 @@
-import json
 from pathlib import Path
-from typing import List
 
 import duckdb as db
 import PySide6.QtCore as qc
@@ -16,14 +14,46 @@ from commons import (
     get_config_folder,
     load_user_prefs,
     save_user_prefs,
+    table_exists,
 )
-from query import Field, Join, Query, Table
+from decision_lake import join_prior_decisions, merge_finished_validations
+from method_compiler import (
+    DECISION_KEY,
+    MAIN_TABLE_ALIAS,
+    CompiledMethod,
+    MethodError,
+    compile_method,
+)
+from query import Field, Query, Table, parquet_table
+from query_monitor import query_monitor
+from slow_query_log import slow_query_log
+from step_cache import step_results
 from validation_model import (
     VALIDATION_TABLE_COLUMNS,
     ValidationModel,
+    add_comment,
+    add_tag,
+    annotation_tables,
+    decisions_filter,
+    ensure_annotation_tables,
+    get_comments,
+    get_decision,
+    get_tags,
     get_validation_from_table_uuid,
+    remove_tag,
+    set_decision,
+    tag_filter,
 )
 
+# Rows kept by the decision filter of the validation widget: verdict passed to decisions_filter, or "tag" for
+# the rows having the tag in the current validation
+DECISION_FILTERS = {
+    "Tagged in this validation": "tag",
+    "Accepted in a validation": True,
+    "Rejected in a validation": False,
+    "Decided in a validation": None,
+}
+
 
 def finish_validation(conn: db.DuckDBPyConnection, table_uuid: str, step_count: int):
     conn.sql(
@@ -43,6 +73,7 @@ def show_finished_validation(query: Query, table_uuid: str):
         query.init_state()
 
         validation = get_validation_from_table_uuid(query.conn, table_uuid)
+        ensure_annotation_tables(query.conn, table_uuid)
 
         additional_tables = {}
         additional_tables["validation_table"] = Table(
@@ -58,6 +89,18 @@ def show_finished_validation(query: Query, table_uuid: str):
             Field("validation_hash", additional_tables["validation_table"]),
         )
 
+        # Comments and tags are read from their side tables, for the rows having some
+        names = annotation_tables(table_uuid)
+        for name in ("comment_summary", "tag_lists"):
+            additional_tables[name] = Table(names[name], name, quoted=True)
+            query.add_table(
+                name,
+                additional_tables[name],
+                Field("validation_hash", query.main_table),
+                Field("validation_hash", additional_tables[name]),
+                "LEFT JOIN",
+            )
+
         query.set_fields(
             [
                 Field("validation_hash", query.main_table),
@@ -69,8 +112,9 @@ def show_finished_validation(query: Query, table_uuid: str):
                 Field("alternate", query.main_table),
                 Field("snpeff_Gene_Name", query.main_table),
                 Field("accepted", additional_tables["validation_table"]),
-                Field("comment", additional_tables["validation_table"]),
-                Field("tags", additional_tables["validation_table"]),
+                Field("comment_count", additional_tables["comment_summary"]),
+                Field("last_comment", additional_tables["comment_summary"]),
+                Field("tags", additional_tables["tag_lists"]),
             ]
         )
         query.unmute()
@@ -197,6 +241,11 @@ class ValidationWidget(qw.QWidget):
 
         self.return_to_validation_button.clicked.connect(self.on_return_to_validation)
 
+        # Row selected in the query table, see set_current_row
+        self.current_row: dict = None
+        self.variant_box = self.create_variant_box()
+        self.filter_box = self.create_filter_box()
+
         qc.QCoreApplication.instance().aboutToQuit.connect(self.save_state)
 
         # Will be overwritten by load_state, but set to default values here in case load_state does nothing
@@ -205,9 +254,81 @@ class ValidationWidget(qw.QWidget):
 
         self.setup_layout()
 
+    def create_variant_box(self) -> qw.QGroupBox:
+        box = qw.QGroupBox("Variant", self)
+
+        self.row_label = qw.QLabel("")
+        self.decision_label = qw.QLabel("")
+        self.accept_button = qw.QPushButton("Accept")
+        self.accept_button.clicked.connect(lambda: self.on_decision_clicked(True))
+        self.reject_button = qw.QPushButton("Reject")
+        self.reject_button.clicked.connect(lambda: self.on_decision_clicked(False))
+
+        self.tags_label = qw.QLabel("")
+        self.tag_edit = qw.QLineEdit()
+        self.tag_edit.setPlaceholderText("Tag")
+        self.tag_edit.returnPressed.connect(self.on_add_tag_clicked)
+        self.add_tag_button = qw.QPushButton("Add tag")
+        self.add_tag_button.clicked.connect(self.on_add_tag_clicked)
+        self.remove_tag_button = qw.QPushButton("Remove tag")
+        self.remove_tag_button.clicked.connect(self.on_remove_tag_clicked)
+
+        self.comments_list = qw.QListWidget()
+        self.comment_edit = qw.QLineEdit()
+        self.comment_edit.setPlaceholderText("Comment")
+        self.comment_edit.returnPressed.connect(self.on_add_comment_clicked)
+        self.add_comment_button = qw.QPushButton("Add comment")
+        self.add_comment_button.clicked.connect(self.on_add_comment_clicked)
+
+        decision_layout = qw.QHBoxLayout()
+        decision_layout.addWidget(self.accept_button)
+        decision_layout.addWidget(self.reject_button)
+        tag_layout = qw.QHBoxLayout()
+        tag_layout.addWidget(self.tag_edit)
+        tag_layout.addWidget(self.add_tag_button)
+        tag_layout.addWidget(self.remove_tag_button)
+        comment_layout = qw.QHBoxLayout()
+        comment_layout.addWidget(self.comment_edit)
+        comment_layout.addWidget(self.add_comment_button)
+
+        layout = qw.QVBoxLayout(box)
+        layout.addWidget(self.row_label)
+        layout.addWidget(self.decision_label)
+        layout.addLayout(decision_layout)
+        layout.addWidget(self.tags_label)
+        layout.addLayout(tag_layout)
+        layout.addWidget(self.comments_list)
+        layout.addLayout(comment_layout)
+        return box
+
+    def create_filter_box(self) -> qw.QGroupBox:
+        box = qw.QGroupBox("Filter", self)
+
+        self.filter_combo = qw.QComboBox()
+        self.filter_combo.addItems(list(DECISION_FILTERS))
+        self.filter_tag_edit = qw.QLineEdit()
+        self.filter_tag_edit.setPlaceholderText("Tag (optional for decisions)")
+        self.filter_tag_edit.returnPressed.connect(self.on_filter_clicked)
+        self.filter_button = qw.QPushButton("Filter")
+        self.filter_button.clicked.connect(self.on_filter_clicked)
+        self.clear_filter_button = qw.QPushButton("Clear filter")
+        self.clear_filter_button.clicked.connect(self.on_clear_filter_clicked)
+
+        button_layout = qw.QHBoxLayout()
+        button_layout.addWidget(self.filter_button)
+        button_layout.addWidget(self.clear_filter_button)
+
+        layout = qw.QVBoxLayout(box)
+        layout.addWidget(self.filter_combo)
+        layout.addWidget(self.filter_tag_edit)
+        layout.addLayout(button_layout)
+        return box
+
     def setup_layout(self):
         self._layout.addWidget(self.title_label)
         self._layout.addWidget(self.description_text)
+        self._layout.addWidget(self.variant_box)
+        self._layout.addWidget(self.filter_box)
 
         # Add vertical spacer
         self._layout.addStretch()
@@ -221,8 +342,8 @@ class ValidationWidget(qw.QWidget):
         # The current step index
         self.current_step_id = 0
 
-        # The method array (a list of steps, each step being a dict with fields, tables, joins, etc.)
-        self.method = None
+        # The compiled method (a list of steps, each step holding its fields, tables, joins, etc.)
+        self.method: CompiledMethod = None
 
         # The table uuid of the selected validation
         self.validation_table_uuid = None
@@ -234,15 +355,209 @@ class ValidationWidget(qw.QWidget):
 
         self.is_finished = False
 
+        self.show_current_row()
+
+    def can_annotate(self) -> bool:
+        return bool(
+            self.current_row is not None
+            and self.validation_table_uuid
+            and self.query
+            and self.query.conn
+        )
+
+    def set_current_row(self, row: dict):
+        """Shows the decision, tags and comments of the row selected in the query table"""
+        if query_monitor.defer(self.set_current_row, row):
+            return
+        self.current_row = row if row and row.get(DECISION_KEY) is not None else None
+        self.show_current_row()
+
+    def show_current_row(self):
+        enabled = self.can_annotate()
+        for widget in (
+            self.accept_button,
+            self.reject_button,
+            self.tag_edit,
+            self.add_tag_button,
+            self.remove_tag_button,
+            self.comment_edit,
+            self.add_comment_button,
+        ):
+            widget.setEnabled(enabled)
+        self.filter_box.setEnabled(bool(self.validation_table_uuid))
+        self.comments_list.clear()
+        if not enabled:
+            self.row_label.setText("Aucun variant sélectionné")
+            self.decision_label.setText("")
+            self.tags_label.setText("")
+            return
+
+        row = self.current_row
+        self.row_label.setText(
+            " - ".join(
+                str(row[name])
+                for name in ("sample_name", "run_name", "snpeff_Gene_Name")
+                if row.get(name) is not None
+            )
+        )
+        validation_hash = row[DECISION_KEY]
+        try:
+            accepted = get_decision(
+                self.query.conn, self.validation_table_uuid, validation_hash
+            )
+            tags = get_tags(self.query.conn, self.validation_table_uuid, validation_hash)
+            comments = get_comments(
+                self.query.conn, self.validation_table_uuid, validation_hash
+            )
+        except db.Error as e:
+            print(e)
+            return
+        self.decision_label.setText(
+            "Décision: "
+            + {True: "accepté", False: "rejeté", None: "aucune"}[accepted]
+        )
+        self.tags_label.setText("Tags: " + (", ".join(tags) or "aucun"))
+        for comment in comments:
+            self.comments_list.addItem(
+                f"{comment['creation_timestamp']:%d/%m/%Y %H:%M} {comment['username']}: {comment['comment']}"
+            )
+
+    def on_decision_clicked(self, accepted: bool):
+        if not self.can_annotate():
+            return
+        row = self.current_row
+        try:
+            set_decision(
+                self.query.conn,
+                self.validation_table_uuid,
+                row[DECISION_KEY],
+                row.get("sample_name"),
+                row.get("run_name"),
+                row.get("transcript_ID", row.get("snpeff_Feature_ID")),
+                accepted,
+            )
+        except db.Error as e:
+            print(e)
+            return
+        self.reload_main_table()
+
+    def reload_main_table(self):
+        """Decisions drop the materialized steps of the validation (see step_results): the current one is read again"""
+        if not self.is_finished and self.method and 0 <= self.current_step_id < len(self.method):
+            self.query.mute()
+            self.query.set_main_table(
+                step_results.get_main_table(
+                    self.query.conn,
+                    self.validation_table_uuid,
+                    self.method,
+                    self.current_step_id,
+                    self.validation_parquet_files,
+                )
+            )
+            self.query.unmute()
+        self.query.update()
+
+    def on_add_tag_clicked(self):
+        tag = self.tag_edit.text().strip()
+        if not tag or not self.can_annotate():
+            return
+        try:
+            add_tag(
+                self.query.conn,
+                self.validation_table_uuid,
+                self.current_row[DECISION_KEY],
+                tag,
+            )
+        except db.Error as e:
+            print(e)
+            return
+        self.tag_edit.clear()
+        self.on_annotation_added()
+
+    def on_remove_tag_clicked(self):
+        tag = self.tag_edit.text().strip()
+        if not tag or not self.can_annotate():
+            return
+        try:
+            remove_tag(
+                self.query.conn,
+                self.validation_table_uuid,
+                self.current_row[DECISION_KEY],
+                tag,
+            )
+        except db.Error as e:
+            print(e)
+            return
+        self.tag_edit.clear()
+        self.on_annotation_added()
+
+    def on_add_comment_clicked(self):
+        comment = self.comment_edit.text().strip()
+        if not comment or not self.can_annotate():
+            return
+        try:
+            add_comment(
+                self.query.conn,
+                self.validation_table_uuid,
+                self.current_row[DECISION_KEY],
+                comment,
+                Path.home().name,
+            )
+        except db.Error as e:
+            print(e)
+            return
+        self.comment_edit.clear()
+        self.on_annotation_added()
+
+    def on_annotation_added(self):
+        self.show_current_row()
+        # Only the results of a finished validation show the comments and tags
+        if self.is_finished:
+            self.query.update()
+
+    def on_filter_clicked(self):
+        if not self.validation_table_uuid or not self.query.conn or not self.query.main_table:
+            return
+        field = Field(DECISION_KEY, self.query.main_table)
+        tag = self.filter_tag_edit.text().strip() or None
+        verdict = DECISION_FILTERS[self.filter_combo.currentText()]
+        # The rows are looked up once: decisions made afterwards only show when filtering again
+        try:
+            if verdict == "tag":
+                if not tag:
+                    qw.QMessageBox.warning(self, "Filtre", "Veuillez saisir un tag.")
+                    return
+                filter = tag_filter(
+                    self.query.conn, self.validation_table_uuid, field, tag
+                )
+            else:
+                filter = decisions_filter(self.query.conn, field, verdict, tag)
+        except db.Error as e:
+            print(e)
+            return
+        self.query.set_decision_filter(filter)
+
+    def on_clear_filter_clicked(self):
+        self.filter_tag_edit.clear()
+        if self.query.get_decision_filter():
+            self.query.set_decision_filter(None)
+
     def on_finish(self):
+        self.show_finished_labels()
+
+        finish_validation(self.query.conn, self.validation_table_uuid, len(self.method))
+        try:
+            merge_finished_validations(self.query.conn)
+        except (db.Error, OSError) as e:
+            print(e)
+        show_finished_validation(self.query, self.validation_table_uuid)
+
+    def show_finished_labels(self):
         self.is_finished = True
         self.title_label.setText("Validation terminée")
         self.description_text.text_edit.setText(
             "Validation terminée.\nLes résultats sont présentés dans la table ci-contre.\nVous pouvez exporter les résultats vers Genno en cliquant sur le bouton ci-dessous."
         )
-
-        finish_validation(self.query.conn, self.validation_table_uuid, len(self.method))
-        show_finished_validation(self.query, self.validation_table_uuid)
         self.next_step_button.setText("Export to Genno")
 
     def on_return_to_validation(self):
@@ -286,8 +601,7 @@ class ValidationWidget(qw.QWidget):
             self.setup_step()
 
     def set_method_path(self, method_path: Path):
-        with open(method_path, "r") as f:
-            self.method = json.load(f)
+        self.method = compile_method(method_path)
 
     def setup_step(self):
         """Modifies the query to match the current step definition."""
@@ -302,48 +616,23 @@ class ValidationWidget(qw.QWidget):
         ):
             return
 
-        step_definition: List[dict] = self.method[self.current_step_id]
-
-        self.title_label.setText(step_definition["title"])
-        self.description_text.text_edit.setText(step_definition["description"])
-
-        self.query.set_main_files(self.validation_parquet_files)
+        step = self.method[self.current_step_id]
 
-        tables = {}
-        joins = {}
-        fields = []
-
-        tables["main_table"] = self.query.main_table
-
-        for table_def in step_definition["tables"]:
-            tables[table_def["alias"]] = Table(
-                table_def["name"],
-                table_def["alias"],
-                quoted=table_def.get("quoted", False),
-            )
-            joins[table_def["alias"]] = Join(
-                tables[table_def["alias"]],
-                left_on=Field(
-                    table_def["join"]["left_on"],
-                    tables[table_def["join"]["left_table"]],
-                ),
-                right_on=Field(
-                    table_def["join"]["right_on"], tables[table_def["alias"]]
-                ),
-            )
-
-        for field in step_definition["fields"]:
-            fields.append(
-                Field(
-                    field["name"],
-                    tables[field["table"]],
-                    is_expression=field["is_expression"],
-                ),
-            )
+        self.title_label.setText(step.title)
+        self.description_text.text_edit.setText(step.description)
 
         self.query.mute()
-        self.query.set_additional_tables(joins)
-        self.query.set_fields(fields)
+        self.query.set_main_table(
+            step_results.get_main_table(
+                self.query.conn,
+                self.validation_table_uuid,
+                self.method,
+                self.current_step_id,
+                self.validation_parquet_files,
+            )
+        )
+        step.apply(self.query)
+        join_prior_decisions(self.query)
 
         self.query.unmute()
         self.query.update()
@@ -351,9 +640,10 @@ class ValidationWidget(qw.QWidget):
         if not self.query.is_valid():
             print(self.query.to_do())
 
-    def start_validation(self, selected_validation: dict):
+    def load_validation(self, selected_validation: dict) -> bool:
+        """Loads the validation and its method, without touching the query. Returns whether it succeeded."""
         if not self.query or not self.query.conn:
-            return
+            return False
 
         self.validation_name = selected_validation["validation_name"]
         self.validation_parquet_files = selected_validation["parquet_files"]
@@ -365,14 +655,28 @@ class ValidationWidget(qw.QWidget):
                 "Erreur",
                 "Pas de dossier de configuration sélectionné, abandon.",
             )
-            return
+            return False
 
         self.validation_table_uuid = selected_validation["table_uuid"]
-        self.set_method_path(
-            Path(config_folder)
-            / "validation_methods"
-            / (selected_validation["validation_method"] + ".json")
-        )
+        ensure_annotation_tables(self.query.conn, self.validation_table_uuid)
+        try:
+            self.set_method_path(
+                Path(config_folder)
+                / "validation_methods"
+                / (selected_validation["validation_method"] + ".json")
+            )
+        except (OSError, MethodError) as e:
+            qw.QMessageBox.critical(
+                self,
+                "Erreur",
+                f"Méthode de validation invalide: {e}",
+            )
+            return False
+        return True
+
+    def start_validation(self, selected_validation: dict):
+        if not self.load_validation(selected_validation):
+            return
         try:
             self.current_step_id = (
                 self.query.conn.sql(
@@ -388,6 +692,36 @@ class ValidationWidget(qw.QWidget):
         except IndexError:
             self.current_step_id = 0
 
+    def resume_validation(self, selected_validation: dict, step_id: int):
+        """Shows the given step of a validation, the query being already restored (from a session)"""
+        if not self.load_validation(selected_validation):
+            return
+        self.current_step_id = step_id
+        if self.current_step_id >= len(self.method):
+            self.show_finished_labels()
+        elif self.current_step_id >= 0:
+            step = self.method[self.current_step_id]
+            self.title_label.setText(step.title)
+            self.description_text.text_edit.setText(step.description)
+            # Steps refining the previous one read a temp table, gone with the previous connection: materialize it again
+            self.query.mute()
+            try:
+                self.query.set_main_table(
+                    step_results.get_main_table(
+                        self.query.conn,
+                        self.validation_table_uuid,
+                        self.method,
+                        self.current_step_id,
+                        self.validation_parquet_files,
+                    )
+                )
+            except db.Error as e:
+                print(e)
+                self.query.set_main_table(
+                    parquet_table(self.validation_parquet_files, MAIN_TABLE_ALIAS)
+                )
+            self.query.unmute()
+
     def save_state(self):
         if self.validation_table_uuid:
             save_user_prefs(
@@ -480,6 +814,35 @@ class ValidationWidgetContainer(qw.QWidget):
         if "last_widget_shown" in userprefs:
             self.multi_widget.set_current_widget(userprefs["last_widget_shown"])
 
+    def get_session_state(self) -> dict:
+        if (
+            self.multi_widget.get_current_widget_name() != "validation"
+            or not self.validation_widget.validation_table_uuid
+        ):
+            return None
+        return {
+            "table_uuid": self.validation_widget.validation_table_uuid,
+            "step": self.validation_widget.current_step_id,
+        }
+
+    def restore_session_state(self, state: dict):
+        if not state or not self.query.conn:
+            return
+        try:
+            validation = get_validation_from_table_uuid(
+                self.query.conn, state["table_uuid"]
+            )
+        except (IndexError, db.Error):
+            # The validation was deleted since, and its materialized steps with it
+            main_table = self.query.main_table
+            if main_table and not main_table.files and not table_exists(self.query.conn, main_table.name):
+                self.query.mute()
+                self.query.init_state()
+                self.query.unmute()
+            return
+        self.multi_widget.set_current_widget("validation")
+        self.validation_widget.resume_validation(validation, state["step"])
+
     def on_close(self):
         save_user_prefs(
             {"last_widget_shown": self.multi_widget.get_current_widget_name()}
@@ -631,14 +994,9 @@ class SamplesSelectPage(qw.QWizardPage):
 
     def on_select_samples_clicked(self):
         is_complete_before = self.isComplete()
-        samples_names = [
-            d["sample_name"]
-            for d in db.sql(
-                f"SELECT DISTINCT sample_name FROM read_parquet({duck_db_literal_string_list(self.data['file_names'])})"
-            )
-            .pl()
-            .to_dicts()
-        ]
+        sql = f"SELECT DISTINCT sample_name FROM read_parquet({duck_db_literal_string_list(self.data['file_names'])})"
+        with slow_query_log.timed(db.default_connection, sql, "wizard"):
+            samples_names = [d["sample_name"] for d in db.sql(sql).pl().to_dicts()]
         sample_selector = StringListChooser(samples_names, self)
         if sample_selector.exec() == qw.QDialog.DialogCode.Accepted:
             self.data["sample_names"] = sample_selector.get_selected()
@@ -7,10 +7,27 @@ import PySide6.QtCore as qc
 import PySide6.QtGui as qg
 import PySide6.QtWidgets as qw
 
-from commons import get_user_prefs_file, load_user_prefs, save_user_prefs
+from commons import (
+    apply_duckdb_settings,
+    get_datalake_settings,
+    get_user_prefs_file,
+    load_user_prefs,
+    save_datalake_settings,
+    save_user_prefs,
+    user_prefs,
+)
+from datalake_settings_dialog import DatalakeSettingsDialog
+from datalake_watcher import DatalakeWatcher
+from disk_cache import DiskCache
 from inspector import Inspector
 from query import Query
+from query_cache import query_cache
+from query_monitor import query_monitor
+from slow_query_log import slow_query_log
 from query_table_widget import QueryTableWidget
+from search_index import search_index
+from session import load_session, restore_session, save_session
+from spill import release_spill_files
 
 
 class MainWindow(qw.QMainWindow):
@@ -18,11 +35,20 @@ class MainWindow(qw.QMainWindow):
     def __init__(self):
         super().__init__()
 
+        self.setup_disk_cache()
+        self.setup_query_monitor()
+
         # Avoid creating a new query if we already have one
         self.load_previous_session()
+        self.datalake_watcher = DatalakeWatcher(self.query, self)
+        self.setup_search_index()
 
         self.query_table_widget = QueryTableWidget(self.query)
         self.inspector = Inspector(self.query)
+        # Decisions, tags and comments are recorded on the row selected
+        self.query_table_widget.row_selected.connect(
+            self.inspector.validation_widget.validation_widget.set_current_row
+        )
 
         self.database = None
 
@@ -36,25 +62,83 @@ class MainWindow(qw.QMainWindow):
 
         self.file_menu = self.menu.addMenu("File")
         self.file_menu.addAction("Open datalake", self.open_datalake)
+        self.file_menu.addAction("Datalake settings...", self.edit_datalake_settings)
+
+        self.restore_widgets()
 
         self.query.update()
 
+    def setup_query_monitor(self):
+        query_monitor.default_timeouts.update(user_prefs.get("query_timeouts", {}))
+        query_monitor.set_timeouts({})
+        slow_query_log.threshold = user_prefs.get(
+            "slow_query_threshold_s", slow_query_log.threshold
+        )
+
+    def setup_search_index(self):
+        self.query.datalake_changed.connect(self.on_datalake_changed)
+        self.datalake_watcher.files_changed.connect(self.refresh_search_index)
+        qc.QCoreApplication.instance().aboutToQuit.connect(search_index.wait)
+        if self.query.datalake_path:
+            self.on_datalake_changed()
+
+    def on_datalake_changed(self):
+        search_index.open(self.query.datalake_path)
+        # The validation database of the datalake is connected once the query changes
+        qc.QTimer.singleShot(0, self.refresh_search_index)
+
+    def refresh_search_index(self):
+        # A cursor is taken from the connection, which a statement may be using
+        if query_monitor.defer(self.refresh_search_index):
+            return
+        search_index.refresh_in_background(self.query.conn)
+
+    def setup_disk_cache(self):
+        if not user_prefs.get("disk_cache_enabled", True):
+            return
+        query_cache.set_disk_cache(
+            DiskCache(
+                get_user_prefs_file().parent / "cache",
+                user_prefs.get("disk_cache_max_size_mb", 512) * 1024 * 1024,
+            )
+        )
+        qc.QCoreApplication.instance().aboutToQuit.connect(query_cache.disk.flush)
+
     def load_previous_session(self):
-        prefs = self.get_user_prefs()
-        if "last_query" not in prefs:
-            self.query = Query()
-        else:
-            self.query = Query.load(Path(prefs["last_query"]))
+        self.query = Query()
+        if user_prefs.get("spill_threshold_mb") is not None:
+            self.query.spill_threshold = user_prefs.get("spill_threshold_mb") * 1024 * 1024
+        self.session = None
+        if user_prefs.get("last_session"):
+            self.session = load_session(Path(user_prefs.get("last_session")))
+        if self.session:
+            restore_session(self.session, self.query)
         self.query.query_changed.connect(self.on_query_changed)
+        qc.QCoreApplication.instance().aboutToQuit.connect(release_spill_files)
+
+    def restore_widgets(self):
+        if not self.session:
+            return
+        widgets = self.session["widgets"]
+        self.query_table_widget.set_column_widths(widgets.get("column_widths", {}))
+        self.inspector.validation_widget.restore_session_state(
+            widgets.get("validation")
+        )
 
     def closeEvent(self, event: qg.QCloseEvent):
         user_prefs_folder = get_user_prefs_file().parent
-        user_prefs_folder.mkdir(parents=True, exist_ok=True)
 
-        # Save last query
-        self.query.save(user_prefs_folder / "last_query.pickle")
+        # Save last session
+        save_session(
+            user_prefs_folder / "last_session.json",
+            self.query,
+            {
+                "column_widths": self.query_table_widget.get_column_widths(),
+                "validation": self.inspector.validation_widget.get_session_state(),
+            },
+        )
         self.save_user_prefs(
-            {"last_query": str(user_prefs_folder / "last_query.pickle")}
+            {"last_session": str(user_prefs_folder / "last_session.json")}
         )
         event.accept()
 
@@ -70,20 +154,30 @@ class MainWindow(qw.QMainWindow):
         return load_user_prefs()
 
     def open_datalake(self):
-        if "last_datalake" in self.get_user_prefs():
-            last_datalake = self.get_user_prefs()["last_datalake"]
-            datalake_folder = qw.QFileDialog.getExistingDirectory(
-                self, "Open datalake", last_datalake
-            )
-        else:
-            datalake_folder = qw.QFileDialog.getExistingDirectory(
-                self, "Open datalake", str(Path.home())
-            )
-            self.save_user_prefs({"last_datalake": datalake_folder})
+        last_datalake = user_prefs.get("last_datalake", str(Path.home()))
+        datalake_folder = qw.QFileDialog.getExistingDirectory(
+            self, "Open datalake", last_datalake
+        )
         if not datalake_folder:
             return
+        self.save_user_prefs({"last_datalake": datalake_folder})
         self.query.set_datalake_path(datalake_folder)
 
+    def edit_datalake_settings(self):
+        if not self.query.datalake_path:
+            qw.QMessageBox.information(self, "Datalake settings", "Please open a datalake first")
+            return
+        dialog = DatalakeSettingsDialog(
+            get_datalake_settings(self.query.datalake_path), self
+        )
+        if dialog.exec() != qw.QDialog.DialogCode.Accepted:
+            return
+        settings = dialog.get_settings()
+        save_datalake_settings(self.query.datalake_path, settings)
+        if self.query.conn:
+            apply_duckdb_settings(self.query.conn, settings)
+        self.query.set_datalake_settings(settings)
+
 
 if __name__ == "__main__":
     app = qw.QApplication([])